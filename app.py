@@ -5,13 +5,48 @@ from functools import wraps
 import io
 import csv
 import random
-import traceback
+import math
 import calendar
+import threading
+import time
+import json
+import gzip
+import hashlib
+import hmac
+import secrets
+import mimetypes
+import re
+import sys
+import base64
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import datetime  # вверху файла, если ещё не импортирован
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 
-import requests
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # без Pillow сайт просто отдаёт оригиналы
+    Image = None
+
+try:
+    import brotli
+except ImportError:  # без brotli отдаём только gzip
+    brotli = None
+
+try:
+    import openpyxl
+except ImportError:  # без openpyxl импорт учеников принимает только CSV
+    openpyxl = None
+
+import click
+from markupsafe import Markup
 from flask import (
     Flask,
     render_template,
@@ -22,7 +57,16 @@ from flask import (
     session,
     send_file,
     flash,
+    g,
+    has_app_context,
+    make_response,
+    has_request_context,
+    send_from_directory,
+    stream_with_context,
 )
+from flask.logging import default_handler as flask_default_log_handler
+
+from telegram_api import TelegramClient, TelegramError
 
 # ==== ФИЛЬТР ДЛЯ АБЗАЦЕВ ==== 
 def format_paragraphs(text: str) -> str:
@@ -43,7 +87,146 @@ app.jinja_env.filters["paragraphs"] = format_paragraphs
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "soul.db")
+# SOUL_DB_PATH — чтобы гонять бенчмарки на отдельной базе
+DB_PATH = os.getenv("SOUL_DB_PATH") or os.path.join(BASE_DIR, "soul.db")
+
+# ================== ЛОГИ ==================
+# Строка лога — JSON с request_id и временем от начала запроса. Сам вывод
+# делает QueueListener в отдельном потоке: поток запроса только кладёт
+# готовую строку в очередь и никогда не ждёт stdout. Если очередь
+# переполнена, строка выбрасывается — лучше потерять лог, чем ответ.
+#
+# LOG_LEVEL — общий уровень (INFO), LOG_LEVELS — по модулям:
+#     LOG_LEVELS="soul.telegram=DEBUG,werkzeug=WARNING"
+# LOG_FORMAT=text — обычный текст вместо JSON (удобно локально).
+
+LOG_QUEUE_SIZE = 10000
+
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "request_id", "elapsed_ms",
+}
+
+
+class RequestContextFilter(logging.Filter):
+    """Добавляет к записи request_id и elapsed_ms текущего запроса."""
+
+    def filter(self, record):
+        if has_request_context() and "request_id" in g:
+            record.request_id = g.request_id
+            record.elapsed_ms = round((time.perf_counter() - g.request_started) * 1000, 1)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+            entry["elapsed_ms"] = record.elapsed_ms
+        # всё, что передали через extra=
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS and not key.startswith("_"):
+                entry.setdefault(key, value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, "request_id", None):
+            line = f"{line} [{record.request_id} +{record.elapsed_ms}ms]"
+        return line
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """QueueHandler со своим QueueListener; после fork заводит новый."""
+
+    def __init__(self, target):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.target = target
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with _log_start_lock:
+            if self._pid == os.getpid():
+                return
+            # очередь родителя могла остаться с чужими записями и замками
+            self.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+
+_log_start_lock = threading.Lock()
+
+
+def setup_logging():
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+
+    handler = AsyncLogHandler(stream)
+    handler.addFilter(RequestContextFilter())
+    if os.getenv("LOG_FORMAT", "json") == "text":
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for item in filter(None, os.getenv("LOG_LEVELS", "").split(",")):
+        name, _, level = item.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    # у Flask свой обработчик в stderr — пусть всё идёт через общий
+    app.logger.removeHandler(flask_default_log_handler)
+    atexit.register(handler.stop)
+    return handler
+
+
+log_handler = setup_logging()
+log = logging.getLogger("soul")
+
+
+@app.before_request
+def start_request_log():
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:12]
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def finish_request_log(response):
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+        log.debug(
+            "%s %s -> %s", request.method, request.path, response.status_code,
+            extra={"status": response.status_code},
+        )
+    return response
+
 
 # ================== НАСТРОЙКИ ==================
 
@@ -61,8 +244,138 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 ADMIN_USER = os.getenv("ADMIN_USER")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")  # ОБЯЗАТЕЛЬНО поменяй
 
+# Сколько прокси перед сайтом дописывают X-Forwarded-For (nginx с
+# proxy_add_x_forwarded_for — один). Адрес берётся на столько шагов с конца
+# заголовка: первые записи присылает сам клиент, верить им нельзя.
+# 0 — сайт смотрит в интернет напрямую, заголовок игнорируется.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "1"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
 # Анти-спам по заявкам
 ENROLL_SPAM_SECONDS = 60  # интервал между заявками с одного IP (в секундах)
+REVIEW_SPAM_SECONDS = 300  # и между отзывами
+
+# ================== СТАТИКА ==================
+# Файлы из static/ (кроме uploads/) отдаются по адресам с хэшем
+# содержимого: style_light.3f2a9c1b.css. url_for('static') подставляет
+# такой адрес сам, поэтому кэшировать можно навсегда (immutable).
+# Рядом лежат .gz/.br копии — отдаём их по Accept-Encoding.
+
+app.config["STATIC_FINGERPRINT"] = os.getenv("STATIC_FINGERPRINT", "1") != "0"
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+STATIC_SKIP_DIRS = {"uploads"}
+STATIC_COMPRESS_EXT = {"css", "js", "svg", "html", "txt", "json", "map"}
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+_static_manifest = {}   # style_light.css -> style_light.3f2a9c1b.css
+_static_reverse = {}    # обратно
+
+
+def _static_files():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        rel_root = os.path.relpath(root, STATIC_DIR)
+        if rel_root == ".":
+            dirs[:] = [d for d in dirs if d not in STATIC_SKIP_DIRS]
+        for name in files:
+            if name.endswith((".gz", ".br")) or name.startswith("."):
+                continue
+            rel = name if rel_root == "." else f"{rel_root}/{name}".replace(os.sep, "/")
+            yield rel
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def precompress_static(rel, force=False):
+    """Создаёт .gz (и .br, если есть brotli) рядом с файлом, если их нет или они старые."""
+    if rel.rsplit(".", 1)[-1].lower() not in STATIC_COMPRESS_EXT:
+        return
+    src = os.path.join(STATIC_DIR, rel)
+    mtime = os.path.getmtime(src)
+    data = None
+    encoders = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encoders.append((".br", lambda d: brotli.compress(d, quality=11)))
+    for suffix, encode in encoders:
+        target = src + suffix
+        if not force and os.path.exists(target) and os.path.getmtime(target) >= mtime:
+            continue
+        if data is None:
+            with open(src, "rb") as f:
+                data = f.read()
+        _write_atomic(target, encode(data))
+
+
+def build_static_manifest(compress=True, force=False):
+    manifest = {}
+    for rel in _static_files():
+        with open(os.path.join(STATIC_DIR, rel), "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:10]
+        stem, dot, ext = rel.rpartition(".")
+        manifest[rel] = f"{stem}.{digest}.{ext}" if dot else f"{rel}.{digest}"
+        if compress:
+            precompress_static(rel, force=force)
+    _static_manifest.clear()
+    _static_manifest.update(manifest)
+    _static_reverse.clear()
+    _static_reverse.update({v: k for k, v in manifest.items()})
+    return manifest
+
+
+@app.template_global()
+def css_bundle(name, fallback):
+    """Урезанный бандл из build_css.py, если он собран, иначе исходный CSS целиком."""
+    filename = f"dist/{name}.min.css"
+    if not os.path.exists(os.path.join(STATIC_DIR, filename)):
+        filename = fallback
+    return url_for("static", filename=filename)
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == "static" and app.config["STATIC_FINGERPRINT"]:
+        hashed = _static_manifest.get(values.get("filename"))
+        if hashed:
+            values["filename"] = hashed
+
+
+def fingerprinted_static(filename):
+    real = _static_reverse.get(filename)
+    if real is None:
+        # uploads/ и старые ссылки без хэша — как раньше
+        return app.send_static_file(filename)
+
+    encoding = None
+    accepted = request.accept_encodings
+    for enc, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accepted[enc] and os.path.exists(os.path.join(STATIC_DIR, real + suffix)):
+            encoding = enc
+            break
+
+    if encoding:
+        response = send_from_directory(
+            STATIC_DIR, real + (".br" if encoding == "br" else ".gz"),
+            mimetype=mimetypes.guess_type(real)[0] or "application/octet-stream",
+            max_age=STATIC_MAX_AGE,
+        )
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = send_from_directory(STATIC_DIR, real, max_age=STATIC_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+app.view_functions["static"] = fingerprinted_static
+
+if app.config["STATIC_FINGERPRINT"]:
+    build_static_manifest()
+
 
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
 TEACHER_UPLOAD = os.path.join(UPLOAD_FOLDER, "teachers")
@@ -97,36 +410,581 @@ def save_upload(file, folder):
     filename = f"{datetime.utcnow().timestamp()}.{ext}"
     filepath = os.path.join(folder, filename)
     file.save(filepath)
+    if Image is not None:
+        try:
+            strip_image_metadata(filepath)
+        except Exception:
+            # Pillow не смог открыть — значит, это не картинка
+            images_log.warning("rejected upload %s: not an image", file.filename)
+            os.remove(filepath)
+            return None
     return filename
 
 
-def generate_student_code():
-    """Генерирует уникальный 6-значный код типа 038421."""
-    conn = get_db()
-    while True:
-        code = f"{random.randint(0, 999999):06d}"
-        exists = conn.execute(
-            "SELECT 1 FROM student_accounts WHERE public_code = ?",
-            (code,),
+# ---- АДАПТИВНЫЕ КАРТИНКИ ----
+# После загрузки фото в фоне режем варианты под srcset: WebP + JPEG для
+# старых браузеров, EXIF выкидывается при пересохранении. Имена вариантов
+# пишутся в колонку photo_variants (JSON), пока их нет — шаблон
+# показывает оригинал.
+
+IMAGE_VARIANTS = (
+    ("thumb", 320),      # каскад галереи
+    ("card", 640),       # карточки преподавателей и курсов
+    ("lightbox", 1600),  # просмотр фото целиком
+)
+images_log = logging.getLogger("soul.images")
+
+IMAGE_TABLES = {
+    TEACHER_UPLOAD: "teachers",
+    COURSE_UPLOAD: "courses",
+    GALLERY_UPLOAD: "gallery",
+}
+
+_image_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IMAGE_WORKERS", "2")),
+    thread_name_prefix="image-variants",
+)
+
+
+# что оставить при пересохранении оригинала; остальное (EXIF с GPS, XMP,
+# комментарии, текстовые чанки PNG) выкидываем
+IMAGE_KEEP_INFO = ("icc_profile", "transparency", "dpi")
+# служебные поля, которые Pillow кладёт в info и у чистого файла
+IMAGE_PLAIN_INFO = IMAGE_KEEP_INFO + (
+    "jfif", "jfif_version", "jfif_unit", "jfif_density", "adobe", "adobe_transform",
+    "progressive", "progression", "loop", "background", "duration", "gamma", "srgb",
+)
+IMAGE_SAVE_OPTIONS = {
+    "JPEG": {"quality": 95, "optimize": True},
+    "WEBP": {"quality": 90},
+    "PNG": {"optimize": True},
+}
+
+
+def strip_image_metadata(path):
+    """
+    Оригинал отдаётся из static как есть, поэтому EXIF (GPS, модель
+    телефона) вырезаем сразу при загрузке: поворот из EXIF применяем,
+    файл пересохраняем без метаданных. Чистый файл не трогаем.
+    Возвращает True, если файл переписан.
+    """
+    with Image.open(path) as original:
+        fmt = original.format
+        if not original.getexif() and all(k in IMAGE_PLAIN_INFO for k in original.info):
+            return False
+        im = ImageOps.exif_transpose(original)
+    keep = {k: v for k, v in im.info.items() if k in IMAGE_KEEP_INFO}
+    im.info = {}
+    tmp = path + ".tmp"
+    im.save(tmp, fmt, **keep, **IMAGE_SAVE_OPTIONS.get(fmt, {}))
+    os.replace(tmp, path)
+    return True
+
+
+def _flatten_for_jpeg(im):
+    if im.mode in ("RGBA", "LA", "P"):
+        im = im.convert("RGBA")
+        bg = Image.new("RGB", im.size, (255, 255, 255))
+        bg.paste(im, mask=im.getchannel("A"))
+        return bg
+    return im.convert("RGB")
+
+
+def build_image_variants(folder, filename):
+    """Режет варианты для одного файла, возвращает словарь для photo_variants."""
+    stem = filename.rsplit(".", 1)[0]
+    variants = {}
+    with Image.open(os.path.join(folder, filename)) as original:
+        im = ImageOps.exif_transpose(original)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+
+        last = None
+        for name, width in IMAGE_VARIANTS:
+            w = min(width, im.width)
+            # картинку не растягиваем: если оригинал узкий, варианты совпадают
+            if last and last["w"] == w:
+                variants[name] = last
+                continue
+            h = max(1, round(im.height * w / im.width))
+            resized = im.resize((w, h), Image.LANCZOS)
+
+            webp_name = f"{stem}_{name}.webp"
+            jpg_name = f"{stem}_{name}.jpg"
+            resized.save(os.path.join(folder, webp_name), "WEBP", quality=80, method=4)
+            _flatten_for_jpeg(resized).save(
+                os.path.join(folder, jpg_name), "JPEG",
+                quality=82, optimize=True, progressive=True,
+            )
+            last = variants[name] = {"w": w, "h": h, "webp": webp_name, "jpg": jpg_name}
+    return variants
+
+
+def _image_variants_job(folder, filename):
+    try:
+        variants = build_image_variants(folder, filename)
+        conn = get_db()
+        conn.execute(
+            f"UPDATE {IMAGE_TABLES[folder]} SET photo_variants = ? WHERE photo = ?",
+            (json.dumps(variants), filename),
+        )
+        conn.commit()
+        conn.close()
+        bump_content_version()
+    except Exception:
+        images_log.exception("image variants failed for %s", filename)
+
+
+def schedule_image_variants(folder, filename):
+    """Зовём после commit строки с новым фото — POST не ждёт ресайза."""
+    if Image is None or not filename:
+        return
+    _image_pool.submit(_image_variants_job, folder, filename)
+
+
+def _variants(value):
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {}
+
+
+def _static_upload_url(folder, filename):
+    return url_for("static", filename=f"uploads/{folder}/{filename}")
+
+
+@app.template_global()
+def responsive_img(folder, photo, variants, alt="", sizes="100vw", default="card", **attrs):
+    """<picture> с WebP/JPEG srcset, либо обычный <img> на оригинал."""
+    extra = "".join(f' {k.replace("_", "-")}="{Markup.escape(v)}"' for k, v in attrs.items())
+    alt = Markup.escape(alt or "")
+    variants = _variants(variants)
+    if not variants:
+        return Markup(f'<img src="{_static_upload_url(folder, photo)}" alt="{alt}"{extra} />')
+
+    def srcset(fmt):
+        seen = {}
+        for v in variants.values():
+            seen[v[fmt]] = f"{_static_upload_url(folder, v[fmt])} {v['w']}w"
+        return ", ".join(seen.values())
+
+    main = variants.get(default) or list(variants.values())[-1]
+    return Markup(
+        '<picture style="display: contents">'
+        f'<source type="image/webp" srcset="{srcset("webp")}" sizes="{sizes}" />'
+        f'<img src="{_static_upload_url(folder, main["jpg"])}" srcset="{srcset("jpg")}" '
+        f'sizes="{sizes}" width="{main["w"]}" height="{main["h"]}" alt="{alt}" '
+        f'loading="lazy" decoding="async"{extra} />'
+        "</picture>"
+    )
+
+
+@app.template_global()
+def image_variant_url(folder, photo, variants, name="lightbox", fmt="webp"):
+    variant = _variants(variants).get(name)
+    return _static_upload_url(folder, variant[fmt] if variant else photo)
+
+
+STUDENT_CODE_SPACE = 1_000_000  # коды 000000–999999
+STUDENT_CODE_ROUNDS = 6
+
+
+def student_code_for(key, index):
+    """
+    index-й код ключевой перестановки 000000–999999: сеть Фейстеля на двух
+    половинах по 000–999. Каждый раунд обратим, поэтому разные index дают
+    разные коды, а без ключа следующий код по предыдущему не угадать.
+    """
+    secret = key.encode()
+    left, right = divmod(index, 1000)
+    for rnd in range(STUDENT_CODE_ROUNDS):
+        digest = hmac.new(secret, f"{rnd}:{right}".encode(), hashlib.sha256).digest()
+        left, right = right, (left + int.from_bytes(digest[:4], "big")) % 1000
+    return f"{left * 1000 + right:06d}"
+
+
+def allocate_student_codes(conn, n):
+    """
+    n новых кодов: счётчик student_code_allocator сдвигается одним
+    UPDATE ... RETURNING (запись в SQLite сериализована, так что у двух
+    воркеров диапазоны не пересекаются), коды — перестановка номеров из
+    диапазона. Один запрос на пачку независимо от заполненности.
+    Коды, выданные до перестановки случайным перебором, могут совпасть —
+    такие номера пропускаются; каждый старый код мешает не больше одного раза.
+    Счётчик откатывается вместе с транзакцией вызывающего, если INSERT не прошёл.
+    """
+    codes = []
+    while len(codes) < n:
+        need = n - len(codes)
+        row = conn.execute(
+            """
+            UPDATE student_code_allocator SET issued = issued + ?
+            WHERE id = 1 AND issued + ? <= ?
+            RETURNING key, issued
+            """,
+            (need, need, STUDENT_CODE_SPACE),
         ).fetchone()
-        if not exists:
+        if row is None:
+            raise ValueError(f"свободных кодов меньше {need}")
+        key, issued = row[0], row[1]
+        candidates = [student_code_for(key, i) for i in range(issued - need, issued)]
+        taken = {
+            r[0] for r in conn.execute(
+                """
+                SELECT public_code FROM student_accounts
+                WHERE public_code IN (SELECT value FROM json_each(?))
+                """,
+                (json.dumps(candidates),),
+            )
+        }
+        codes.extend(c for c in candidates if c not in taken)
+    return codes
+
+
+def generate_student_code(conn=None):
+    """
+    Генерирует уникальный 6-значный код типа 038421. Со своим соединением
+    сдвиг счётчика коммитится сразу, с чужим — вместе с транзакцией вызывающего.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    try:
+        code = allocate_student_codes(conn, 1)[0]
+        if own_conn:
+            conn.commit()
+        return code
+    finally:
+        if own_conn:
             conn.close()
-            return code
 
 
+def student_code_usage(conn):
+    """Сколько кодов выдано по счётчику и сколько сейчас у учеников."""
+    issued = conn.execute("SELECT issued FROM student_code_allocator").fetchone()[0]
+    active = conn.execute("SELECT COUNT(*) FROM student_accounts").fetchone()[0]
+    return {
+        "space": STUDENT_CODE_SPACE,
+        "issued": issued,
+        "active": active,
+        "left": STUDENT_CODE_SPACE - issued,
+        "used_pct": round(100 * issued / STUDENT_CODE_SPACE, 2),
+    }
 
 
 # ================== БАЗА ДАННЫХ ==================
 
+# Пул соединений: одно долгоживущее соединение на поток воркера.
+# DB_POOL=0 возвращает старое поведение (новый connect на каждый get_db()),
+# чтобы можно было сравнить задержки.
+app.config["DB_POOL"] = os.getenv("DB_POOL", "1") != "0"
+
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))   # секунды
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # 16 МБ страничного кэша
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))  # 128 МБ
+
+_db_local = threading.local()
+
+# ---- SQL-СТАТИСТИКА ----
+# Каждый запрос через get_db() замеряется: время, строки, endpoint.
+# Медленные (дольше SQL_SLOW_MS) пишутся в лог вместе с EXPLAIN QUERY PLAN.
+# Агрегаты живут в памяти воркера и видны на /admin/sql-stats.
+app.config["SQL_STATS"] = os.getenv("SQL_STATS", "1") != "0"
+sql_log = logging.getLogger("soul.sql")
+app.config["SQL_SLOW_MS"] = float(os.getenv("SQL_SLOW_MS", "100"))
+
+SQL_STATS_MAX_STATEMENTS = 50  # на один endpoint, чтобы память не росла
+
+_sql_stats = {}
+_sql_stats_lock = threading.Lock()
+_sql_stats_since = datetime.utcnow()
+
+
+def _sql_endpoint():
+    if has_request_context():
+        return request.endpoint or request.path
+    return "-"
+
+
+def _sql_endpoint_entry(endpoint):
+    """Агрегат по endpoint-у. Звать под локом."""
+    ep = _sql_stats.get(endpoint)
+    if ep is None:
+        ep = _sql_stats[endpoint] = {
+            "requests": 0, "queries": 0, "total_ms": 0.0,
+            "max_request_ms": 0.0, "rows": 0, "statements": {},
+        }
+    return ep
+
+
+def _sql_statement_entry(endpoint, sql):
+    """Запись статистики для пары (endpoint, текст запроса). Звать под локом."""
+    ep = _sql_endpoint_entry(endpoint)
+    key = " ".join(sql.split())[:300]
+    st = ep["statements"].get(key)
+    if st is None:
+        if len(ep["statements"]) >= SQL_STATS_MAX_STATEMENTS:
+            key = "(прочие запросы)"
+            st = ep["statements"].get(key)
+        if st is None:
+            st = ep["statements"][key] = {
+                "count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+            }
+    return ep, st
+
+
+def _sql_explain(conn, sql, params):
+    head = sql.lstrip()[:6].upper()
+    if head not in ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH"):
+        return ""
+    try:
+        # базовый курсор — чтобы EXPLAIN сам не попадал в статистику
+        rows = conn.cursor(sqlite3.Cursor).execute(
+            "EXPLAIN QUERY PLAN " + sql, params
+        ).fetchall()
+    except sqlite3.Error as e:
+        return f"(explain failed: {e})"
+    return "\n".join(f"  {r[3]}" for r in rows)
+
+
+class SoulCursor(sqlite3.Cursor):
+    """Курсор, который считает время и строки для SQL-статистики."""
+
+    _sql_entry = None
+
+    def _sql_start(self, sql, params, elapsed):
+        self._sql_text = sql
+        self._sql_params = params
+        self._sql_elapsed = elapsed
+        self._sql_logged = False
+        rows = self.rowcount if self.rowcount > 0 else 0
+        endpoint = _sql_endpoint()
+        with _sql_stats_lock:
+            ep, st = _sql_statement_entry(endpoint, sql)
+            ep["queries"] += 1
+            ep["total_ms"] += elapsed
+            ep["rows"] += rows
+            st["count"] += 1
+            st["total_ms"] += elapsed
+            st["rows"] += rows
+            st["max_ms"] = max(st["max_ms"], elapsed)
+        self._sql_entry = (ep, st)
+        if has_app_context():
+            g.sql_queries = g.get("sql_queries", 0) + 1
+            g.sql_ms = g.get("sql_ms", 0.0) + elapsed
+        self._sql_check_slow()
+
+    def _sql_fetched(self, rows, elapsed):
+        if self._sql_entry is None:
+            return
+        ep, st = self._sql_entry
+        self._sql_elapsed += elapsed
+        with _sql_stats_lock:
+            ep["total_ms"] += elapsed
+            ep["rows"] += rows
+            st["total_ms"] += elapsed
+            st["rows"] += rows
+            st["max_ms"] = max(st["max_ms"], self._sql_elapsed)
+        if has_app_context():
+            g.sql_ms = g.get("sql_ms", 0.0) + elapsed
+        self._sql_check_slow()
+
+    def _sql_check_slow(self):
+        if self._sql_logged or self._sql_elapsed < app.config["SQL_SLOW_MS"]:
+            return
+        self._sql_logged = True
+        sql_log.warning(
+            "slow sql %.1f ms [%s]: %s\nplan:\n%s",
+            self._sql_elapsed,
+            _sql_endpoint(),
+            " ".join(self._sql_text.split()),
+            _sql_explain(self.connection, self._sql_text, self._sql_params),
+        )
+
+    def execute(self, sql, params=()):
+        if not app.config["SQL_STATS"]:
+            return super().execute(sql, params)
+        t0 = time.perf_counter()
+        super().execute(sql, params)
+        self._sql_start(sql, params, (time.perf_counter() - t0) * 1000)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        if not app.config["SQL_STATS"]:
+            return super().executemany(sql, seq_of_params)
+        t0 = time.perf_counter()
+        super().executemany(sql, seq_of_params)
+        # EXPLAIN для executemany не делаем — параметров там много
+        self._sql_start(sql, (), (time.perf_counter() - t0) * 1000)
+        self._sql_logged = True
+        return self
+
+    def fetchone(self):
+        if self._sql_entry is None:
+            return super().fetchone()
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        self._sql_fetched(0 if row is None else 1, (time.perf_counter() - t0) * 1000)
+        return row
+
+    def fetchmany(self, size=None):
+        if self._sql_entry is None:
+            return super().fetchmany(self.arraysize if size is None else size)
+        t0 = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._sql_fetched(len(rows), (time.perf_counter() - t0) * 1000)
+        return rows
+
+    def fetchall(self):
+        if self._sql_entry is None:
+            return super().fetchall()
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._sql_fetched(len(rows), (time.perf_counter() - t0) * 1000)
+        return rows
+
+    def __next__(self):
+        if self._sql_entry is None:
+            return super().__next__()
+        t0 = time.perf_counter()
+        row = super().__next__()  # StopIteration пробрасываем как есть
+        self._sql_fetched(1, (time.perf_counter() - t0) * 1000)
+        return row
+
+
+@app.teardown_request
+def collect_sql_stats(exc):
+    queries = g.pop("sql_queries", 0)
+    sql_ms = g.pop("sql_ms", 0.0)
+    if not queries:
+        return
+    endpoint = _sql_endpoint()
+    with _sql_stats_lock:
+        ep = _sql_endpoint_entry(endpoint)
+        ep["requests"] += 1
+        ep["max_request_ms"] = max(ep["max_request_ms"], sql_ms)
+
+
+def sql_stats_snapshot():
+    """Копия агрегатов для админки: endpoint-ы по суммарному времени."""
+    with _sql_stats_lock:
+        result = []
+        for endpoint, ep in _sql_stats.items():
+            statements = sorted(
+                ({"sql": sql, **st} for sql, st in ep["statements"].items()),
+                key=lambda st: st["total_ms"],
+                reverse=True,
+            )
+            result.append({
+                "endpoint": endpoint,
+                **{k: v for k, v in ep.items() if k != "statements"},
+                "statements": statements,
+            })
+    result.sort(key=lambda ep: ep["total_ms"], reverse=True)
+    return result
+
+
+class SoulConnection(sqlite3.Connection):
+    """
+    Соединение, которое умеет «возвращаться в пул».
+    Роуты по старинке зовут conn.close() — для пулового соединения это
+    просто откат незакоммиченной транзакции, а не закрытие файла.
+    """
+
+    pooled = False
+
+    def close(self):
+        if self.pooled:
+            if self.in_transaction:
+                self.rollback()
+            return
+        super().close()
+
+    def close_for_real(self):
+        super().close()
+
+    def cursor(self, factory=SoulCursor):
+        return super().cursor(factory)
+
+    # встроенные execute/executemany создают базовый курсор в обход cursor(),
+    # поэтому перенаправляем их явно — так замеряется каждый запрос
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def _apply_pragmas(conn):
+    # journal_mode хранится в самом файле БД, остальное — настройки соединения.
+    # Базовый курсор — настройка соединения не должна попадать в SQL-статистику.
+    cur = conn.cursor(sqlite3.Cursor)
+    cur.execute("PRAGMA journal_mode = WAL")
+    cur.execute("PRAGMA synchronous = NORMAL")
+    cur.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    cur.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    cur.execute("PRAGMA temp_store = MEMORY")
+
+
+def _connect(pooled=False):
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        factory=SoulConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    if pooled:
+        _apply_pragmas(conn)
+        conn.pooled = True
+        conn.owner_pid = os.getpid()
+    return conn
+
+
+def _pooled_connection():
+    conn = getattr(_db_local, "conn", None)
+    # после fork (gunicorn --preload) унаследованное соединение не трогаем
+    if conn is None or conn.owner_pid != os.getpid():
+        conn = _connect(pooled=True)
+        _db_local.conn = conn
+    return conn
+
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    if not app.config["DB_POOL"] or not has_app_context():
+        return _connect()
+
+    conn = g.get("db")
+    if conn is None:
+        conn = _pooled_connection()
+        g.db = conn
     conn.row_factory = sqlite3.Row
     return conn
 
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+# ---- МИГРАЦИИ ----
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция применяется
+# ровно один раз; новые миграции только дописываются в конец списка.
+
+def _add_column(cur, table, column, decl):
+    """ALTER TABLE ... ADD COLUMN, только если колонки ещё нет."""
+    cols = {r[1] for r in cur.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def migration_001_base_schema(cur):
+    """Базовая схема. На старых базах таблицы уже есть — докидываем колонки."""
 
     # ---- REVIEWS ----
     cur.execute("""
@@ -154,16 +1012,8 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
     """)
-    try:
-        cur.execute("ALTER TABLE enrolls ADD COLUMN is_bot INTEGER DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
-
-    try:
-        cur.execute("ALTER TABLE enrolls ADD COLUMN admin_note TEXT")
-    except sqlite3.OperationalError:
-        pass
-
+    _add_column(cur, "enrolls", "is_bot", "INTEGER DEFAULT 0")
+    _add_column(cur, "enrolls", "admin_note", "TEXT")
 
     # ---- TEACHERS ----
     cur.execute("""
@@ -176,18 +1026,9 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
     """)
-
-    # новые поля под "Основное" и ачивки
-    try:
-        cur.execute("ALTER TABLE teachers ADD COLUMN highlights TEXT")
-    except sqlite3.OperationalError:
-        pass
-
-    try:
-        cur.execute("ALTER TABLE teachers ADD COLUMN badges TEXT")
-    except sqlite3.OperationalError:
-        pass
-
+    # поля под "Основное" и ачивки
+    _add_column(cur, "teachers", "highlights", "TEXT")
+    _add_column(cur, "teachers", "badges", "TEXT")
 
     # ---- COURSES ----
     cur.execute("""
@@ -201,10 +1042,8 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
     """)
-    try:
-        cur.execute("ALTER TABLE courses ADD COLUMN hero_tags TEXT")
-    except sqlite3.OperationalError:
-        pass
+    _add_column(cur, "courses", "hero_tags", "TEXT")
+
     # ---- GALLERY ----
     cur.execute("""
         CREATE TABLE IF NOT EXISTS gallery (
@@ -215,6 +1054,7 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
     """)
+
     # ---- STUDENT ACCOUNTS ----
     cur.execute("""
         CREATE TABLE IF NOT EXISTS student_accounts (
@@ -230,15 +1070,9 @@ def init_db():
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
     """)
-    # привязка ученика к преподавателю (может уже существовать)
-    try:
-        cur.execute("""
-            ALTER TABLE student_accounts
-            ADD COLUMN teacher_id INTEGER REFERENCES teachers(id)
-        """)
-    except sqlite3.OperationalError:
-        # колонка уже есть — просто игнорируем ошибку
-        pass
+    # привязка ученика к преподавателю
+    _add_column(cur, "student_accounts", "teacher_id", "INTEGER REFERENCES teachers(id)")
+
     # ---- STUDENT LESSONS (расписание) ----
     cur.execute("""
         CREATE TABLE IF NOT EXISTS student_lessons (
@@ -253,6 +1087,7 @@ def init_db():
             FOREIGN KEY (student_id) REFERENCES student_accounts(id) ON DELETE CASCADE
         );
     """)
+
     # ---- STUDENT HOMEWORK ----
     cur.execute("""
         CREATE TABLE IF NOT EXISTS student_homework (
@@ -271,109 +1106,1804 @@ def init_db():
             FOREIGN KEY(student_id) REFERENCES student_accounts(id)
         );
     """)
+    _add_column(cur, "student_homework", "teacher_file_name", "TEXT")
+    _add_column(cur, "student_homework", "teacher_file_path", "TEXT")
+
+
+def migration_002_hot_indexes(cur):
+    """Индексы под горячие запросы (раньше всё было full scan)."""
+    # анти-спам в /enroll и список заявок в админке
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_enrolls_ip_created ON enrolls(ip, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_enrolls_created ON enrolls(created_at)")
+    # расписание ученика и календарь препода
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_lessons_student_start ON student_lessons(student_id, start_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_accounts_teacher ON student_accounts(teacher_id)")
+    # домашки: кабинет ученика и список у препода
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_homework_student_status_created
+        ON student_homework(student_id, status, created_at)
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_homework_created ON student_homework(created_at)")
+    # отзывы на главной и в модерации
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_approved_created ON reviews(approved, created_at)")
+
+
+# таблицы, за изменениями которых следят счётчики data_versions
+VERSIONED_TABLES = (
+    "reviews", "enrolls", "teachers", "courses", "gallery",
+    "student_accounts", "student_lessons", "student_homework",
+)
+
+
+def migration_003_change_counters(cur):
+    """
+    Счётчики изменений для ETag/Last-Modified. Их ведут триггеры, так что
+    любая запись (из роутов, скриптов, руками в sqlite3) меняет версию.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,             -- имя таблицы
+            version INTEGER NOT NULL DEFAULT 0,
+            changed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS student_versions (
+            student_id INTEGER PRIMARY KEY,    -- всё, что видно в кабинете ученика
+            version INTEGER NOT NULL DEFAULT 0,
+            changed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    bump_table = """
+        INSERT INTO data_versions (name, version, changed_at)
+        VALUES ('{table}', 1, CURRENT_TIMESTAMP)
+        ON CONFLICT(name) DO UPDATE
+        SET version = version + 1, changed_at = CURRENT_TIMESTAMP;
+    """
+    bump_student = """
+        INSERT INTO student_versions (student_id, version, changed_at)
+        VALUES ({ref}, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT(student_id) DO UPDATE
+        SET version = version + 1, changed_at = CURRENT_TIMESTAMP;
+    """
+
+    for table in VERSIONED_TABLES:
+        cur.execute(f"INSERT OR IGNORE INTO data_versions (name) VALUES ('{table}')")
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            body = bump_table.format(table=table)
+            if table in ("student_lessons", "student_homework"):
+                if event != "DELETE":
+                    body += bump_student.format(ref="NEW.student_id")
+                if event != "INSERT":
+                    body += bump_student.format(ref="OLD.student_id")
+            elif table == "student_accounts" and event == "UPDATE":
+                body += bump_student.format(ref="NEW.id")
+            elif table == "student_accounts" and event == "DELETE":
+                body += "DELETE FROM student_versions WHERE student_id = OLD.id;"
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                AFTER {event} ON {table}
+                BEGIN
+                    {body}
+                END
+            """)
+
+
+def migration_004_photo_variants(cur):
+    """Имена адаптивных вариантов фото (JSON), см. build_image_variants()."""
+    for table in ("teachers", "courses", "gallery"):
+        _add_column(cur, table, "photo_variants", "TEXT")
+
+
+def migration_005_notification_outbox(cur):
+    """Очередь уведомлений в Telegram, см. enqueue_notification()."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,                      -- enroll / review
+            payload TEXT NOT NULL,                   -- JSON
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / sent / dead
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,           -- unix time; у pending — когда пробовать
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_status_next
+        ON notification_outbox(status, next_attempt_at)
+    """)
+
+
+def _fts_index(cur, table, columns):
+    """
+    External content FTS5-индекс {table}_fts: текст хранится только в
+    table, индекс ведут триггеры. Если SQLite собран без FTS5, таблицы не
+    будет и поиск упадёт обратно на LIKE (см. has_fts).
+    """
+    fts = f"{table}_fts"
+    cols = ", ".join(columns)
+    new = ", ".join(f"NEW.{c}" for c in columns)
+    old = ", ".join(f"OLD.{c}" for c in columns)
     try:
-        cur.execute("ALTER TABLE student_homework ADD COLUMN teacher_file_name TEXT")
-    except sqlite3.OperationalError:
-        pass
+        cur.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {cols},
+                content = '{table}', content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        log.warning("FTS5 недоступен, поиск по %s будет через LIKE: %s", table, e)
+        return
+
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new});
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old});
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old});
+            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new});
+        END
+    """)
+    cur.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def migration_006_enrolls_search(cur):
+    """Полнотекстовый поиск по заявкам в админке."""
+    _fts_index(cur, "enrolls", ["name", "contact", "comment", "admin_note"])
+
+
+def migration_007_enroll_changes(cur):
+    """
+    Курсор изменений для дельта-экспорта заявок. Любая вставка или правка
+    строки (в т.ч. admin_note / is_bot) выдаёт ей следующий change_seq из
+    счётчика sequences, удаление оставляет запись в enroll_deletions с
+    тем же счётчиком. «Что изменилось после N» — диапазон по индексу.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS enroll_deletions (
+            change_seq INTEGER PRIMARY KEY,
+            enroll_id INTEGER NOT NULL,
+            deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    _add_column(cur, "enrolls", "change_seq", "INTEGER")
+
+    # существующие строки: порядок изменений = порядок вставки
+    cur.execute("UPDATE enrolls SET change_seq = id WHERE change_seq IS NULL")
+    cur.execute("""
+        INSERT OR IGNORE INTO sequences (name, value)
+        SELECT 'enrolls', COALESCE(MAX(id), 0) FROM enrolls
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_enrolls_change_seq ON enrolls(change_seq)")
+
+    next_seq = """
+        UPDATE sequences SET value = value + 1 WHERE name = 'enrolls';
+    """
+    stamp = """
+        UPDATE enrolls
+        SET change_seq = (SELECT value FROM sequences WHERE name = 'enrolls')
+        WHERE id = NEW.id;
+    """
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS enrolls_change_insert AFTER INSERT ON enrolls BEGIN
+            {next_seq}
+            {stamp}
+        END
+    """)
+    # change_seq в списке колонок нет — собственный UPDATE триггер не зацикливает
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS enrolls_change_update
+        AFTER UPDATE OF ip, name, contact, tariff, level, comment, created_at,
+                        admin_note, is_bot
+        ON enrolls BEGIN
+            {next_seq}
+            {stamp}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS enrolls_change_delete AFTER DELETE ON enrolls BEGIN
+            {next_seq}
+            INSERT INTO enroll_deletions (change_seq, enroll_id)
+            VALUES ((SELECT value FROM sequences WHERE name = 'enrolls'), OLD.id);
+        END
+    """)
+
+
+def migration_008_reviews_search(cur):
+    """Поиск в очереди модерации отзывов."""
+    _fts_index(cur, "reviews", ["name", "package", "text"])
+    # страницы очереди идут по (approved, created_at, id) — id в индексе уже есть как rowid
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_approved_created ON reviews(approved, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_created ON reviews(created_at)")
+
+
+def rebuild_analytics(cur):
+    """Пересчитать сводные таблицы аналитики с нуля (внутри текущей транзакции)."""
+    cur.execute("DELETE FROM enroll_daily")
+    cur.execute("""
+        INSERT INTO enroll_daily (day, tariff, level, is_bot, n)
+        SELECT date(created_at), COALESCE(tariff, ''), COALESCE(level, ''),
+               COALESCE(is_bot, 0), COUNT(*)
+        FROM enrolls
+        GROUP BY 1, 2, 3, 4
+    """)
+    cur.execute("DELETE FROM review_ratings")
+    cur.execute("""
+        INSERT INTO review_ratings (package, approved, rating, n)
+        SELECT COALESCE(package, ''), COALESCE(approved, 0), COALESCE(rating, 0), COUNT(*)
+        FROM reviews
+        GROUP BY 1, 2, 3
+    """)
+
+
+ANALYTICS_TRIGGERS = [
+    ("enrolls", "INSERT", ""),
+    ("enrolls", "DELETE", ""),
+    ("enrolls", "UPDATE", "OF created_at, tariff, level, is_bot"),
+    ("reviews", "INSERT", ""),
+    ("reviews", "DELETE", ""),
+    ("reviews", "UPDATE", "OF package, approved, rating"),
+]
+
+
+def create_analytics_triggers(cur):
+    """
+    Триггеры сводок аналитики: ±1 к строке своей комбинации. Строка, которую
+    вычитание довело до нуля, удаляется — иначе после массовых правок копятся
+    пустые (день, пакет, уровень), которые никто не показывает.
+    """
+    def enroll_delta(ref, sign):
+        key = f"""date({ref}.created_at), COALESCE({ref}.tariff, ''),
+                  COALESCE({ref}.level, ''), COALESCE({ref}.is_bot, 0)"""
+        sql = f"""
+            INSERT INTO enroll_daily (day, tariff, level, is_bot, n)
+            VALUES ({key}, {sign}1)
+            ON CONFLICT (day, tariff, level, is_bot) DO UPDATE SET n = n {sign} 1;
+        """
+        if sign == "-":
+            sql += f"""
+                DELETE FROM enroll_daily
+                WHERE (day, tariff, level, is_bot) = ({key}) AND n <= 0;
+            """
+        return sql
+
+    def review_delta(ref, sign):
+        key = f"""COALESCE({ref}.package, ''), COALESCE({ref}.approved, 0),
+                  COALESCE({ref}.rating, 0)"""
+        sql = f"""
+            INSERT INTO review_ratings (package, approved, rating, n)
+            VALUES ({key}, {sign}1)
+            ON CONFLICT (package, approved, rating) DO UPDATE SET n = n {sign} 1;
+        """
+        if sign == "-":
+            sql += f"""
+                DELETE FROM review_ratings
+                WHERE (package, approved, rating) = ({key}) AND n <= 0;
+            """
+        return sql
+
+    deltas = {"enrolls": enroll_delta, "reviews": review_delta}
+    for table, event, columns in ANALYTICS_TRIGGERS:
+        delta = deltas[table]
+        if event == "INSERT":
+            body = delta("NEW", "+")
+        elif event == "DELETE":
+            body = delta("OLD", "-")
+        else:
+            body = delta("OLD", "-") + delta("NEW", "+")
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_analytics_{event.lower()}
+            AFTER {event} {columns} ON {table} BEGIN
+                {body}
+            END
+        """)
+
+
+def migration_009_analytics(cur):
+    """
+    Сводки для страницы аналитики: заявки по дням × пакет × уровень × бот
+    и гистограмма оценок по пакетам. Их ведут триггеры — так в сводку
+    попадает любая запись: /enroll, отзывы, модерация, массовая разметка.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS enroll_daily (
+            day TEXT NOT NULL,          -- YYYY-MM-DD (UTC, как created_at)
+            tariff TEXT NOT NULL,       -- '' — не выбран
+            level TEXT NOT NULL,
+            is_bot INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (day, tariff, level, is_bot)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS review_ratings (
+            package TEXT NOT NULL,
+            approved INTEGER NOT NULL,
+            rating INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (package, approved, rating)
+        ) WITHOUT ROWID
+    """)
+
+    create_analytics_triggers(cur)
+    rebuild_analytics(cur)
+
+
+STUDENT_STATS_SQL = """
+    SELECT
+        s.id AS student_id,
+        COALESCE(l.lessons_done, 0) AS lessons_done,
+        COALESCE(l.lessons_planned, 0) AS lessons_planned,
+        l.next_lesson_at,
+        COALESCE(h.hw_new, 0) AS hw_new,
+        COALESCE(h.hw_assigned, 0) AS hw_assigned
+    FROM student_accounts s
+    LEFT JOIN (
+        SELECT student_id,
+               SUM(status = 'done') AS lessons_done,
+               SUM(status = 'planned') AS lessons_planned,
+               MIN(CASE WHEN status = 'planned' THEN start_at END) AS next_lesson_at
+        FROM student_lessons GROUP BY student_id
+    ) l ON l.student_id = s.id
+    LEFT JOIN (
+        SELECT student_id,
+               SUM(status = 'new') AS hw_new,
+               SUM(status = 'assigned') AS hw_assigned
+        FROM student_homework GROUP BY student_id
+    ) h ON h.student_id = s.id
+"""
+
+
+def rebuild_student_stats(cur):
+    """Пересчитать student_stats с нуля (внутри текущей транзакции)."""
+    cur.execute("DELETE FROM student_stats")
+    cur.execute(f"""
+        INSERT INTO student_stats (
+            student_id, lessons_done, lessons_planned, next_lesson_at, hw_new, hw_assigned
+        )
+        {STUDENT_STATS_SQL}
+    """)
+
+
+def migration_010_student_stats(cur):
+    """
+    Счётчики для списка учеников: проведено / запланировано занятий,
+    ближайшее запланированное, домашки на проверке и выданные. Их ведут
+    триггеры: счётчики ±1, ближайшее занятие — MIN по индексу
+    (student_id, status, start_at), то есть O(log n) на запись.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS student_stats (
+            student_id INTEGER PRIMARY KEY,
+            lessons_done INTEGER NOT NULL DEFAULT 0,
+            lessons_planned INTEGER NOT NULL DEFAULT 0,
+            next_lesson_at TEXT,                -- самое раннее занятие в статусе planned
+            hw_new INTEGER NOT NULL DEFAULT 0,  -- сдано, ждёт проверки
+            hw_assigned INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lessons_student_status_start
+        ON student_lessons(student_id, status, start_at)
+    """)
+
+    def lessons_delta(ref, sign):
+        return f"""
+            INSERT INTO student_stats (student_id) VALUES ({ref}.student_id)
+            ON CONFLICT (student_id) DO NOTHING;
+            UPDATE student_stats
+            SET lessons_done = lessons_done {sign} ({ref}.status = 'done'),
+                lessons_planned = lessons_planned {sign} ({ref}.status = 'planned')
+            WHERE student_id = {ref}.student_id;
+        """
+
+    def next_lesson(ref):
+        return f"""
+            UPDATE student_stats
+            SET next_lesson_at = (
+                SELECT MIN(start_at) FROM student_lessons
+                WHERE student_id = {ref}.student_id AND status = 'planned'
+            )
+            WHERE student_id = {ref}.student_id;
+        """
+
+    def homework_delta(ref, sign):
+        return f"""
+            INSERT INTO student_stats (student_id) VALUES ({ref}.student_id)
+            ON CONFLICT (student_id) DO NOTHING;
+            UPDATE student_stats
+            SET hw_new = hw_new {sign} ({ref}.status = 'new'),
+                hw_assigned = hw_assigned {sign} ({ref}.status = 'assigned')
+            WHERE student_id = {ref}.student_id;
+        """
+
+    triggers = {
+        ("student_lessons", "INSERT", ""): lessons_delta("NEW", "+") + next_lesson("NEW"),
+        ("student_lessons", "DELETE", ""): lessons_delta("OLD", "-") + next_lesson("OLD"),
+        ("student_lessons", "UPDATE", "OF student_id, status, start_at"):
+            lessons_delta("OLD", "-") + lessons_delta("NEW", "+")
+            + next_lesson("OLD") + next_lesson("NEW"),
+        ("student_homework", "INSERT", ""): homework_delta("NEW", "+"),
+        ("student_homework", "DELETE", ""): homework_delta("OLD", "-"),
+        ("student_homework", "UPDATE", "OF student_id, status"):
+            homework_delta("OLD", "-") + homework_delta("NEW", "+"),
+    }
+    for (table, event, columns), body in triggers.items():
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_stats_{event.lower()}
+            AFTER {event} {columns} ON {table} BEGIN
+                {body}
+            END
+        """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS student_accounts_stats_delete
+        AFTER DELETE ON student_accounts BEGIN
+            DELETE FROM student_stats WHERE student_id = OLD.id;
+        END
+    """)
+
+    rebuild_student_stats(cur)
+
+
+def migration_011_student_codes(cur):
+    """
+    Коды учеников выдаются по счётчику через ключевую перестановку
+    (student_code_for), а не случайным перебором с SELECT на каждую
+    попытку. Ключ генерируется один раз и живёт в базе: смени его —
+    перестановка станет другой и начнёт задевать уже выданные коды.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS student_code_allocator (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            key TEXT NOT NULL,
+            issued INTEGER NOT NULL DEFAULT 0   -- сколько номеров перестановки выдано
+        )
+    """)
+    cur.execute(
+        "INSERT OR IGNORE INTO student_code_allocator (id, key) VALUES (1, ?)",
+        (secrets.token_hex(16),),
+    )
+
+
+def migration_012_student_changes(cur):
+    """
+    Курсор изменений для опроса кабинета (/api/student?since=...), как у
+    заявок в migration_007: вставка или правка урока / домашки выдаёт строке
+    следующий change_seq из sequences['student_items'], удаление пишется
+    в student_item_deletions. Старые строки остаются с NULL — они старше
+    любого курсора, который можно получить.
+    """
+    cur.execute("INSERT OR IGNORE INTO sequences (name, value) VALUES ('student_items', 0)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS student_item_deletions (
+            change_seq INTEGER PRIMARY KEY,
+            student_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,              -- lesson / homework
+            item_id INTEGER NOT NULL,
+            deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_student_item_deletions_student
+        ON student_item_deletions(student_id, change_seq)
+    """)
+
+    next_seq = "UPDATE sequences SET value = value + 1 WHERE name = 'student_items';"
+    tables = {
+        "student_lessons": (
+            "lesson",
+            "student_id, start_at, status, rescheduled_to, topic, comment, updated_at",
+        ),
+        "student_homework": (
+            "homework",
+            "student_id, title, comment, file_name, file_path, status, "
+            "teacher_comment, teacher_file_name, teacher_file_path, checked_at",
+        ),
+    }
+    for table, (kind, columns) in tables.items():
+        _add_column(cur, table, "change_seq", "INTEGER")
+        cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{table}_change_seq
+            ON {table}(student_id, change_seq)
+        """)
+        stamp = f"""
+            UPDATE {table}
+            SET change_seq = (SELECT value FROM sequences WHERE name = 'student_items')
+            WHERE id = NEW.id;
+        """
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_change_insert AFTER INSERT ON {table} BEGIN
+                {next_seq}
+                {stamp}
+            END
+        """)
+        # change_seq в списке колонок нет — собственный UPDATE триггер не зацикливает
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_change_update
+            AFTER UPDATE OF {columns} ON {table} BEGIN
+                {next_seq}
+                {stamp}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_change_delete AFTER DELETE ON {table} BEGIN
+                {next_seq}
+                INSERT INTO student_item_deletions (change_seq, student_id, kind, item_id)
+                VALUES (
+                    (SELECT value FROM sequences WHERE name = 'student_items'),
+                    OLD.student_id, '{kind}', OLD.id
+                );
+            END
+        """)
+
+
+def rebuild_archive_stats(cur):
+    """student_stats.lessons_archived из архива (после rebuild_student_stats он обнулён)."""
+    cur.execute("""
+        UPDATE student_stats
+        SET lessons_archived = (
+            SELECT COUNT(*) FROM student_lessons_archive a
+            WHERE a.student_id = student_stats.student_id AND a.status = 'done'
+        )
+    """)
+    cur.execute("""
+        INSERT INTO student_stats (student_id, lessons_archived)
+        SELECT student_id, SUM(status = 'done') FROM student_lessons_archive
+        WHERE student_id NOT IN (SELECT student_id FROM student_stats)
+        GROUP BY student_id
+    """)
+
+
+def migration_013_lessons_archive(cur):
+    """
+    Архив давно прошедших занятий, см. archive_lessons(): проведённые и
+    отменённые старше LESSON_ARCHIVE_DAYS переезжают сюда с тем же id,
+    чтобы горячая student_lessons и её индексы не росли годами. История
+    (lesson_history) читает обе таблицы. student_stats.lessons_done по-прежнему
+    считает только горячую таблицу, переехавшие проведённые — в lessons_archived.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS student_lessons_archive (
+            id INTEGER PRIMARY KEY,             -- тот же id, что был в student_lessons
+            student_id INTEGER NOT NULL,
+            start_at TEXT NOT NULL,
+            status TEXT NOT NULL,
+            rescheduled_to TEXT,
+            topic TEXT,
+            comment TEXT,
+            updated_at DATETIME,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lessons_archive_student_start
+        ON student_lessons_archive(student_id, start_at)
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS student_accounts_archive_delete
+        AFTER DELETE ON student_accounts BEGIN
+            DELETE FROM student_lessons_archive WHERE student_id = OLD.id;
+        END
+    """)
+    _add_column(cur, "student_stats", "lessons_archived", "INTEGER NOT NULL DEFAULT 0")
+    rebuild_archive_stats(cur)
+
+
+def migration_014_analytics_prune(cur):
+    """
+    Триггеры из 009 оставляли в сводках строки с n = 0 — пересоздаём их с
+    удалением обнулившихся и вычищаем то, что уже накопилось.
+    """
+    for table, event, _ in ANALYTICS_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_analytics_{event.lower()}")
+    create_analytics_triggers(cur)
+    cur.execute("DELETE FROM enroll_daily WHERE n <= 0")
+    cur.execute("DELETE FROM review_ratings WHERE n <= 0")
+
+
+def migration_015_student_stats_rows(cur):
+    """
+    Строку student_stats заводили только триггеры уроков и домашек, и у
+    нового ученика без них её не было — student-stats считал это
+    расхождением. Теперь строка появляется вместе с учеником.
+    """
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS student_accounts_stats_insert
+        AFTER INSERT ON student_accounts BEGIN
+            INSERT INTO student_stats (student_id) VALUES (NEW.id)
+            ON CONFLICT (student_id) DO NOTHING;
+        END
+    """)
+    cur.execute("""
+        INSERT INTO student_stats (student_id)
+        SELECT id FROM student_accounts
+        WHERE id NOT IN (SELECT student_id FROM student_stats)
+    """)
+
+
+MIGRATIONS = [
+    migration_001_base_schema,
+    migration_002_hot_indexes,
+    migration_003_change_counters,
+    migration_004_photo_variants,
+    migration_005_notification_outbox,
+    migration_006_enrolls_search,
+    migration_007_enroll_changes,
+    migration_008_reviews_search,
+    migration_009_analytics,
+    migration_010_student_stats,
+    migration_011_student_codes,
+    migration_012_student_changes,
+    migration_013_lessons_archive,
+    migration_014_analytics_prune,
+    migration_015_student_stats_rows,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def init_db():
+    """
+    Доводит схему до SCHEMA_VERSION. Если база уже актуальна —
+    один PRAGMA и выход, без DDL.
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # несколько воркеров стартуют одновременно — мигрирует первый,
+        # остальные ждут блокировку и видят уже новую версию
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        cur = conn.cursor()
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number > version:
+                migration(cur)
+                cur.execute(f"PRAGMA user_version = {number}")
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+init_db()
+
+
+# ================== ХЕЛПЕРЫ ==================
+
+def login_required(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not session.get("admin_logged_in"):
+            return redirect(url_for("admin_login"))
+        return f(*args, **kwargs)
+    return wrapper
+
+# Преподаватель = тот же админ, отдельная авторизация не нужна
+teacher_login_required = login_required
+
+
+CSV_BATCH_ROWS = 500
+
+
+def csv_columns(spec, selected=None):
+    """
+    spec — [(ключ, заголовок), ...]. selected — 'id,name,...' из query string;
+    неизвестные ключи отбрасываются, пустой выбор — все колонки.
+    """
+    keys = [k.strip() for k in (selected or "").split(",") if k.strip()]
+    known = dict(spec)
+    picked = [(k, known[k]) for k in keys if k in known]
+    return picked or list(spec)
+
+
+def stream_csv(conn, sql, params, columns, filename):
+    """
+    CSV-ответ, который пишется по мере чтения курсора: fetchmany пачками,
+    в памяти только одна пачка, BOM (чтобы Excel понял UTF-8) — один раз
+    в начале. columns — [(ключ в строке, заголовок), ...].
+    """
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf, delimiter=";")
+        try:
+            cur = conn.execute(sql, params)
+            writer.writerow([title for _, title in columns])
+            yield "\ufeff" + buf.getvalue()
+            while True:
+                rows = cur.fetchmany(CSV_BATCH_ROWS)
+                if not rows:
+                    break
+                buf.seek(0)
+                buf.truncate()
+                for r in rows:
+                    writer.writerow([
+                        "" if r[key] is None else r[key] for key, _ in columns
+                    ])
+                yield buf.getvalue()
+        finally:
+            conn.close()
+
+    resp = app.response_class(
+        stream_with_context(generate()),
+        mimetype="text/csv",
+    )
+    resp.headers["Content-Type"] = "text/csv; charset=utf-8"
+    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return resp
+
+
+def client_ip():
+    """IP посетителя. X-Forwarded-For уже разобрал ProxyFix (см. TRUSTED_PROXIES)."""
+    return request.remote_addr or "unknown"
+
+
+# ================== TELEGRAM ==================
+# Сам клиент Bot API — в telegram_api.py (TELEGRAM_API_URL тоже там).
+
+telegram_log = logging.getLogger("soul.telegram")
+
+
+def telegram_configured() -> bool:
+    return bool(
+        TELEGRAM_BOT_TOKEN
+        and TELEGRAM_CHAT_ID
+        and "YOUR_TELEGRAM_BOT_TOKEN_HERE" not in TELEGRAM_BOT_TOKEN
+    )
+
+
+def telegram_escape(value) -> str:
+    """
+    Экранирует пользовательский текст для parse_mode=Markdown: иначе
+    «@ivan_petrov» открывает курсив, который не закрывается, и Telegram
+    отвечает 400 — а повторять такое бессмысленно.
+    """
+    return re.sub(r"([_*`\[])", r"\\\1", str(value))
+
+
+def telegram_truncate(text: str, limit: int) -> str:
+    """Обрезает, не оставляя на конце половину экранирования."""
+    text = text[:limit]
+    return text[:-1] if text.endswith("\\") else text
+
+
+def format_enroll_message(payload: dict) -> str:
+    esc = telegram_escape
+    text_lines = [
+        "📝 *Новая заявка на занятия*",
+        "",
+        f"👤 Имя: {esc(payload.get('name') or '-')}",
+        f"📨 Контакт: {esc(payload.get('contact') or '-')}",
+        f"📦 Пакет: {esc(payload.get('tariff') or 'не выбран')}",
+        f"📊 Уровень: {esc(payload.get('level') or '-')}",
+    ]
+
+    comment = payload.get("comment")
+    if comment:
+        text_lines.append("")
+        text_lines.append(f"💬 Комментарий:\n{esc(comment)}")
+
+    return "\n".join(text_lines)
+
+
+def format_review_message(review: dict) -> str:
+    text_lines = [
+        "⭐ *Новый отзыв на модерации*",
+        "",
+        f"👤 Имя: {telegram_escape(review.get('name') or '-')}",
+        f"📦 Пакет: {telegram_escape(review.get('package') or 'не указан')}",
+        f"★ Оценка: {telegram_escape(review.get('rating') or '-')}",
+        "",
+        telegram_escape(review.get("text") or ""),
+    ]
+    return "\n".join(text_lines)
+
+
+telegram_client = TelegramClient(TELEGRAM_BOT_TOKEN)
+
+
+def telegram_send_message(text: str):
+    """Шлёт сообщение админу. Бросает TelegramError, если не получилось."""
+    telegram_client.send_message(TELEGRAM_CHAT_ID, text)
+
+
+def send_enroll_to_telegram(payload: dict):
+    """
+    Синхронно отправляет уведомление о новой записи в Telegram (админу).
+    payload: name, contact, tariff, level, comment
+    Роуты так больше не делают — см. enqueue_notification().
+    """
+    if not telegram_configured():
+        telegram_log.debug("TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID is missing or placeholder")
+        return
+    try:
+        telegram_send_message(format_enroll_message(payload))
+    except TelegramError as e:
+        telegram_log.error("telegram request failed: %s", e)
+
+
+def send_review_to_telegram(review: dict):
+    """
+    Синхронно отправляет уведомление о новом отзыве (в очередь модерации).
+    review: name, package, rating, text
+    Роуты так не делают — см. enqueue_notification().
+    """
+    if not telegram_configured():
+        return
+    try:
+        telegram_send_message(format_review_message(review))
+    except TelegramError as e:
+        telegram_log.error("telegram request failed: %s", e)
+
+
+# ---- OUTBOX ----
+# Уведомление пишется в notification_outbox в той же транзакции, что и
+# сама заявка, а доставляет его фоновый поток. Посетитель не ждёт
+# Telegram, а упавшая отправка повторяется с экспоненциальной паузой.
+# Строку «захватывают», сдвигая next_attempt_at вперёд на время аренды:
+# если воркер умер посреди отправки, аренда истечёт и строку возьмёт
+# другой воркер.
+
+outbox_log = logging.getLogger("soul.outbox")
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = 5        # секунд до второй попытки, дальше ×2
+OUTBOX_BACKOFF_MAX = 3600
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_KEEP_SENT_DAYS = 30
+app.config["OUTBOX_DISPATCHER"] = os.getenv("OUTBOX_DISPATCHER", "1") != "0"
+# режим дайджеста: всё, что пришло за N секунд после первого уведомления,
+# уходит одним сообщением. 0 — каждое уведомление отдельно.
+app.config["TELEGRAM_DIGEST_SECONDS"] = float(os.getenv("TELEGRAM_DIGEST_SECONDS", "0"))
+TELEGRAM_MAX_TEXT = 4000  # лимит Telegram — 4096 символов
+
+# как превратить уведомление каждого вида в текст
+OUTBOX_FORMATTERS = {
+    "enroll": format_enroll_message,
+    "review": format_review_message,
+}
+
+_outbox_wake = threading.Event()
+_outbox_thread = None
+_outbox_lock = threading.Lock()
+_outbox_metrics = {
+    "sent": 0, "messages": 0, "failed": 0, "dead": 0,
+    "send_ms_total": 0.0, "last_error": None, "last_sent_at": None,
+}
+
+
+def enqueue_notification(conn, kind: str, payload: dict):
+    """Кладёт уведомление в outbox. Коммитит вызывающий — вместе со своей записью."""
+    conn.execute(
+        "INSERT INTO notification_outbox (kind, payload, next_attempt_at) VALUES (?, ?, ?)",
+        (
+            kind,
+            json.dumps(payload, ensure_ascii=False),
+            time.time() + app.config["TELEGRAM_DIGEST_SECONDS"],
+        ),
+    )
+
+
+def group_for_digest(items):
+    """
+    items — пары (строка outbox, текст). Склеивает тексты в сообщения не
+    длиннее TELEGRAM_MAX_TEXT; возвращает [(текст сообщения, [строки]), ...].
+    """
+    separator = "\n\n— — —\n\n"
+    groups, rows, texts = [], [], []
+    for row, text in items:
+        text = telegram_truncate(text, TELEGRAM_MAX_TEXT - 100)
+        if texts and len(separator.join(texts + [text])) > TELEGRAM_MAX_TEXT - 100:
+            groups.append((rows, texts))
+            rows, texts = [], []
+        rows.append(row)
+        texts.append(text)
+    if rows:
+        groups.append((rows, texts))
+    return [
+        (f"📬 *Уведомлений: {len(t)}*\n\n" + separator.join(t) if len(t) > 1 else t[0], r)
+        for r, t in groups
+    ]
+
+
+def outbox_backoff(attempts: int) -> float:
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _outbox_claim(conn, row, now):
+    """Атомарно забирает строку себе. False — её уже взял другой воркер."""
+    cur = conn.execute(
+        """
+        UPDATE notification_outbox
+        SET attempts = attempts + 1, next_attempt_at = ?
+        WHERE id = ? AND status = 'pending' AND next_attempt_at = ?
+        """,
+        (now + OUTBOX_LEASE_SECONDS, row["id"], row["next_attempt_at"]),
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def _outbox_failed(conn, rows, error, delay=None):
+    """Строки не доставлены: назначить повтор или отправить в недоставленные."""
+    retryable = getattr(error, "retryable", True)
+    for row in rows:
+        attempts = row["attempts"] + 1
+        dead = not retryable or attempts >= OUTBOX_MAX_ATTEMPTS
+        # на 429 Telegram сам говорит, сколько ждать
+        wait = 0 if dead else (delay or outbox_backoff(attempts))
+        conn.execute(
+            """
+            UPDATE notification_outbox
+            SET status = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+            """,
+            ("dead" if dead else "pending", time.time() + wait, str(error)[:500], row["id"]),
+        )
+        with _outbox_lock:
+            _outbox_metrics["dead" if dead else "failed"] += 1
+            _outbox_metrics["last_error"] = str(error)[:500]
+        outbox_log.warning(
+            "outbox #%s (%s) attempt %s failed%s: %s",
+            row["id"], row["kind"], attempts, ", dead-lettered" if dead else "", error,
+        )
+    conn.commit()
+
+
+def dispatch_outbox(limit=20) -> int:
+    """Один проход по готовым к отправке уведомлениям. Возвращает число отправленных."""
+    if not telegram_configured():
+        return 0
+
+    conn = get_db()
+    sent = 0
+    digest = app.config["TELEGRAM_DIGEST_SECONDS"]
+    try:
+        now = time.time()
+        # в режиме дайджеста к готовым добавляем свежие, ещё ждущие своего окна
+        rows = conn.execute(
+            """
+            SELECT id, kind, payload, attempts, next_attempt_at
+            FROM notification_outbox
+            WHERE status = 'pending'
+              AND (next_attempt_at <= ? OR (attempts = 0 AND next_attempt_at <= ?))
+            ORDER BY next_attempt_at
+            LIMIT ?
+            """,
+            (now, now + digest, limit),
+        ).fetchall()
+        if not rows or rows[0]["next_attempt_at"] > now:
+            rows = []
+
+        items = []
+        for row in rows:
+            if not _outbox_claim(conn, row, now):
+                continue
+            formatter = OUTBOX_FORMATTERS.get(row["kind"])
+            if formatter is None:
+                _outbox_failed(
+                    conn, [row], TelegramError(f"unknown kind {row['kind']!r}", retryable=False)
+                )
+                continue
+            items.append((row, formatter(json.loads(row["payload"]))))
+
+        if digest:
+            messages = group_for_digest(items)
+        else:
+            messages = [(text, [row]) for row, text in items]
+
+        texts = {row["id"]: text for row, text in items}
+        i = 0
+        while i < len(messages):
+            text, group = messages[i]
+            i += 1
+            t0 = time.perf_counter()
+            try:
+                telegram_send_message(text)
+            except Exception as e:
+                if len(group) > 1 and not getattr(e, "retryable", True):
+                    # дайджест отвергнут целиком (400) — виновата одна заметка,
+                    # остальные не хороним: шлём их тут же по одной
+                    messages[i:i] = [(texts[row["id"]], [row]) for row in group]
+                    continue
+                _outbox_failed(conn, group, e, delay=getattr(e, "retry_after", None))
+                if getattr(e, "retry_after", None):
+                    # Telegram просит подождать — остальное тоже откладываем,
+                    # попытку им не засчитываем
+                    for _, rest in messages[i:]:
+                        conn.executemany(
+                            """
+                            UPDATE notification_outbox
+                            SET attempts = attempts - 1, next_attempt_at = ?
+                            WHERE id = ?
+                            """,
+                            [(time.time() + e.retry_after, row["id"]) for row in rest],
+                        )
+                    conn.commit()
+                    break
+                continue
+
+            conn.executemany(
+                """
+                UPDATE notification_outbox
+                SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL
+                WHERE id = ?
+                """,
+                [(row["id"],) for row in group],
+            )
+            conn.commit()
+            sent += len(group)
+            with _outbox_lock:
+                _outbox_metrics["sent"] += len(group)
+                _outbox_metrics["messages"] += 1
+                _outbox_metrics["send_ms_total"] += (time.perf_counter() - t0) * 1000
+                _outbox_metrics["last_sent_at"] = datetime.utcnow()
+
+        # next_attempt_at у отправленных — время последней попытки
+        conn.execute(
+            "DELETE FROM notification_outbox WHERE status = 'sent' AND next_attempt_at < ?",
+            (now - OUTBOX_KEEP_SENT_DAYS * 86400,),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return sent
+
+
+def _outbox_loop():
+    while True:
+        _outbox_wake.wait(OUTBOX_POLL_SECONDS)
+        _outbox_wake.clear()
+        try:
+            # разгребаем пачками, пока есть что слать
+            while dispatch_outbox() > 0:
+                pass
+        except Exception:
+            outbox_log.exception("outbox dispatcher failed")
+
+
+def outbox_wakeup():
+    """Будит диспетчер этого процесса (и запускает его, если ещё не запущен)."""
+    global _outbox_thread
+    if not app.config["OUTBOX_DISPATCHER"]:
+        return
+    # поток стартуем лениво: после fork (gunicorn --preload) его в воркере нет
+    if _outbox_thread is None or _outbox_thread.pid != os.getpid() or not _outbox_thread.is_alive():
+        with _outbox_lock:
+            if _outbox_thread is None or _outbox_thread.pid != os.getpid() or not _outbox_thread.is_alive():
+                _outbox_thread = threading.Thread(
+                    target=_outbox_loop, name="outbox-dispatcher", daemon=True
+                )
+                _outbox_thread.pid = os.getpid()
+                _outbox_thread.start()
+    _outbox_wake.set()
+
+
+@app.before_request
+def start_outbox_dispatcher():
+    # первый запрос воркера поднимает диспетчер: иначе то, что осталось
+    # pending с прошлого запуска, ждало бы следующей записи в очередь
+    if _outbox_thread is None or _outbox_thread.pid != os.getpid():
+        outbox_wakeup()
+
+
+def outbox_stats(conn):
+    counts = {
+        r["status"]: r["n"]
+        for r in conn.execute(
+            "SELECT status, COUNT(*) AS n FROM notification_outbox GROUP BY status"
+        ).fetchall()
+    }
+    with _outbox_lock:
+        metrics = dict(_outbox_metrics)
+    metrics["avg_send_ms"] = (
+        metrics["send_ms_total"] / metrics["messages"] if metrics["messages"] else 0.0
+    )
+    return counts, metrics
+
+
+def send_enroll_email_to_user(payload: dict):
+    """
+    Заготовка под отправку email пользователю (сейчас не делает ничего).
+    """
+    log.debug("send_enroll_email_to_user called (stub)")
+    return
+
+#Раздлеление тегов в описании курса
+def split_tags(s: str):
+    if not s:
+        return []
+    return [t.strip() for t in s.split(",") if t.strip()]
+
+
+# ================== КЭШ ГЛАВНОЙ ==================
+# Отзывы, преподаватели, курсы и галерея меняются только из админки.
+# Версия контента — файл рядом с БД: админские роуты после commit
+# атомарно подменяют его (os.replace → новый inode), а каждый воркер
+# сверяет (inode, mtime) через os.stat. Так кэш корректен между
+# процессами gunicorn, а попадание в кэш не трогает SQLite вообще.
+
+app.config["PAGE_CACHE"] = os.getenv("PAGE_CACHE", "1") != "0"
+CONTENT_VERSION_PATH = DB_PATH + ".content-version"
+
+_page_cache = {}
+
+
+def bump_content_version():
+    """Зовём после commit любой правки, которая видна на главной."""
+    tmp_path = f"{CONTENT_VERSION_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(datetime.utcnow().isoformat())
+    os.replace(tmp_path, CONTENT_VERSION_PATH)
+
+
+def content_version():
+    try:
+        st = os.stat(CONTENT_VERSION_PATH)
+    except FileNotFoundError:
+        bump_content_version()
+        st = os.stat(CONTENT_VERSION_PATH)
+    return st.st_ino, st.st_mtime_ns
+
+
+def page_cached(key):
+    """Кэширует отрендеренную страницу до следующего bump_content_version()."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config["PAGE_CACHE"]:
+                return view(*args, **kwargs)
+            # версию читаем ДО рендера: если админ поменял данные посреди
+            # рендера, страница уйдёт в кэш под старой версией и сразу протухнет
+            version = content_version()
+            cached = _page_cache.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            html = view(*args, **kwargs)
+            _page_cache[key] = (version, html)
+            return html
+        return wrapper
+    return decorator
+
+
+# ================== УСЛОВНЫЕ GET (ETag / Last-Modified) ==================
+# Валидаторы считаются из версий данных (файл версии контента для главной,
+# счётчики data_versions/student_versions для остального), а не из хэша
+# отрендеренного HTML — поэтому 304 отдаётся до рендера шаблона.
+
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+
+
+def _build_stamp():
+    """Меняется при деплое: иначе новый шаблон прятался бы за старым ETag."""
+    paths = [__file__] + [
+        os.path.join(TEMPLATES_DIR, name) for name in os.listdir(TEMPLATES_DIR)
+    ]
+    stamp = format(int(max(os.path.getmtime(p) for p in paths)), "x")
+    # хэши статики тоже входят: в HTML зашиты адреса вида style.<хэш>.css
+    if _static_manifest:
+        digest = hashlib.sha256(repr(sorted(_static_manifest.items())).encode()).hexdigest()
+        stamp += "." + digest[:8]
+    return stamp
+
+
+BUILD_STAMP = _build_stamp()
+
+
+def _parse_db_timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def table_versions(*tables):
+    """
+    Валидатор по счётчикам таблиц: ("reviews:12.teachers:3", последнее изменение).
+    Один запрос по первичному ключу data_versions.
+    """
+    qmarks = ",".join("?" for _ in tables)
+    rows = get_db().execute(
+        f"SELECT name, version, changed_at FROM data_versions WHERE name IN ({qmarks})",
+        tables,
+    ).fetchall()
+    versions = {r["name"]: r for r in rows}
+    tag = ".".join(
+        f"{t}:{versions[t]['version'] if t in versions else 0}" for t in tables
+    )
+    changed = [_parse_db_timestamp(r["changed_at"]) for r in rows]
+    changed = [c for c in changed if c]
+    return tag, max(changed) if changed else None
+
+
+def student_version(student_id=None, public_code=None, now=None):
+    """
+    Валидатор кабинета одного ученика (уроки, домашки, карточка):
+    ("student:<id>:<версия>[.<слот>]", последнее изменение).
+
+    Раскладка занятий зависит от часов: перенесённый слот, чьё время
+    прошло, уезжает в историю (LESSON_PAST_SQL). Поэтому в ключ входит
+    ближайший такой слот — когда он пройдёт, ключ сменится сам, — а
+    прошедший слот сдвигает «последнее изменение».
+    """
+    now = now or lesson_now()
+    column, value = ("s.id", student_id) if public_code is None else ("s.public_code", public_code)
+    row = get_db().execute(
+        f"""
+        SELECT s.id, COALESCE(v.version, 0) AS version,
+               COALESCE(v.changed_at, s.updated_at) AS changed_at,
+               (SELECT MIN(start_at) FROM student_lessons
+                WHERE student_id = s.id AND status = 'rescheduled' AND start_at >= :now
+               ) AS layout_until,
+               (SELECT MAX(start_at) FROM student_lessons
+                WHERE student_id = s.id AND status = 'rescheduled' AND start_at < :now
+               ) AS layout_changed
+        FROM student_accounts s
+        LEFT JOIN student_versions v ON v.student_id = s.id
+        WHERE {column} = :value
+        """,
+        {"now": now, "value": value},
+    ).fetchone()
+    if not row:
+        return None
+    key = f"student:{row['id']}:{row['version']}"
+    if row["layout_until"]:
+        key += "." + re.sub(r"\D", "", row["layout_until"])
+    changed = [_parse_db_timestamp(row["changed_at"]), lesson_time_utc(row["layout_changed"])]
+    changed = [c for c in changed if c]
+    return key, max(changed) if changed else None
+
+
+def student_version_layout(key):
+    """Часть ключа student_version про раскладку по часам ('' — нет будущих переносов)."""
+    return key.partition(".")[2]
+
+
+def conditional_get(validator, private=False):
+    """
+    validator(*args, **kwargs) -> (ключ версии, datetime последнего изменения)
+    или None, если страницу так кэшировать нельзя. Совпал If-None-Match /
+    If-Modified-Since — отдаём 304, сам view не вызывается.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # flash-сообщения одноразовые — такую страницу не валидируем
+            if request.method not in ("GET", "HEAD") or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            validated = validator(*args, **kwargs)
+            if validated is None:
+                return view(*args, **kwargs)
+
+            key, last_modified = validated
+            etag = f"{view.__name__}-{BUILD_STAMP}-{key}"
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            elif request.if_modified_since and last_modified:
+                not_modified = last_modified.replace(microsecond=0) <= \
+                    request.if_modified_since.replace(tzinfo=None)
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # кэшировать можно, но перед показом — всегда перепроверить
+            response.headers["Cache-Control"] = ("private, " if private else "") + "no-cache"
+            return response
+        return wrapper
+    return decorator
+
+
+def index_validator():
+    ino, mtime_ns = content_version()
+    return f"{ino:x}.{mtime_ns:x}", datetime.utcfromtimestamp(mtime_ns / 1e9)
+
+
+def teacher_students_validator():
+    """
+    Список учеников: карточки, преподаватели и счётчики из student_stats
+    (их двигают уроки и домашки). «⚠︎ в прошлом» у ближайшего занятия
+    зависит от текущей минуты — она тоже входит в версию.
+    """
+    key, changed = table_versions(
+        "student_accounts", "teachers", "student_lessons", "student_homework"
+    )
+    minute = datetime.utcnow().replace(second=0, microsecond=0)
+    return f"{key}.{minute:%Y%m%d%H%M}", max(changed, minute) if changed else minute
+
+
+def student_dashboard_validator():
+    code = (request.args.get("code") or "").strip()
+    if not code:
+        return None
+    # /api/student зовёт валидатор ещё раз из самого view — второй раз без SQL
+    if "student_validated" not in g:
+        cached = student_cache.get(code) if app.config["STUDENT_CACHE"] else None
+        g.student_validated = cached["version"] if cached else student_version(public_code=code)
+    return g.student_validated
+
+
+# ================== ИСТОРИЯ ЗАНЯТИЙ И АРХИВ ==================
+# Кабинет и страница занятий у преподавателя показывают все предстоящие
+# (planned / rescheduled) и окно из LESSON_HISTORY_PAGE последних прошедших,
+# дальше — «показать ещё» по курсору start_at~id. Прошедшие — done, canceled
+# и rescheduled, чей старый слот уже позади: иначе перенесённые копились бы
+# в «предстоящих» навсегда. Прошедшие старше LESSON_ARCHIVE_DAYS раз в сутки
+# (cron → flask archive-lessons) уезжают в student_lessons_archive.
+
+LESSON_HISTORY_PAGE = 20
+LESSON_ARCHIVE_DAYS = int(os.getenv("LESSON_ARCHIVE_DAYS", "180"))
+LESSON_ARCHIVE_BATCH = 2000
+LESSON_PAST_STATUSES = ("done", "canceled")
+# прошедшее занятие в SQL; параметр — текущее время в формате start_at
+LESSON_PAST_SQL = "(status IN ('done', 'canceled') OR (status = 'rescheduled' AND start_at < ?))"
+
+LESSON_COLUMNS = "id, student_id, start_at, status, rescheduled_to, topic, comment, updated_at"
+
+
+def lesson_now():
+    """Текущее время в формате start_at — для сравнения строк."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M")
+
+
+def lesson_time_utc(value):
+    """start_at (местное время, YYYY-MM-DD HH:MM) → naive UTC datetime или None."""
+    try:
+        local = datetime.strptime((value or "")[:16], "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+    return datetime.utcfromtimestamp(local.timestamp())
+
+
+def lesson_section(row, now=None):
+    """Секция кабинета для занятия: planned / rescheduled / history."""
+    status = (row["status"] or "").lower()
+    if status in LESSON_PAST_STATUSES:
+        return "history"
+    if status == "rescheduled" and (row["start_at"] or "") < (now or lesson_now()):
+        return "history"
+    # нет статуса или неизвестный — считаем запланированным
+    return "rescheduled" if status == "rescheduled" else "planned"
+
+
+def upcoming_lessons(conn, student_id, now=None):
+    """Всё, что ещё не прошло (planned / будущие rescheduled), по дате."""
+    return conn.execute(
+        f"""
+        SELECT {LESSON_COLUMNS}, 0 AS archived
+        FROM student_lessons
+        WHERE student_id = ? AND NOT {LESSON_PAST_SQL}
+        ORDER BY start_at
+        """,
+        (student_id, now or lesson_now()),
+    ).fetchall()
+
+
+def lesson_history(conn, student_id, before=None, limit=LESSON_HISTORY_PAGE, now=None):
+    """
+    Прошедшие занятия (done / canceled / прошедшие rescheduled), новые
+    сверху, из горячей таблицы и архива вместе. before — (start_at, id)
+    из decode_cursor.
+    Возвращает (строки, курсор следующей страницы или None).
+    """
+    keyset, params = "", []
+    if before:
+        keyset = "AND (start_at < ? OR (start_at = ? AND id < ?))"
+        params = [before[0], before[0], before[1]]
+    # каждая половина берёт не больше limit + 1 по своему индексу,
+    # общий ORDER BY сортирует уже только их
+    rows = conn.execute(
+        f"""
+        SELECT * FROM (
+            SELECT {LESSON_COLUMNS}, 0 AS archived
+            FROM student_lessons
+            WHERE student_id = ? AND {LESSON_PAST_SQL} {keyset}
+            ORDER BY start_at DESC, id DESC
+            LIMIT ?
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT {LESSON_COLUMNS}, 1 AS archived
+            FROM student_lessons_archive
+            WHERE student_id = ? {keyset}
+            ORDER BY start_at DESC, id DESC
+            LIMIT ?
+        )
+        ORDER BY start_at DESC, id DESC
+        LIMIT ?
+        """,
+        [
+            student_id, now or lesson_now(), *params, limit + 1,
+            student_id, *params, limit + 1,
+            limit + 1,
+        ],
+    ).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last["start_at"], last["id"])
 
-    try:
-        cur.execute("ALTER TABLE student_homework ADD COLUMN teacher_file_path TEXT")
-    except sqlite3.OperationalError:
-        pass
 
+def archive_lessons(conn, older_than_days=LESSON_ARCHIVE_DAYS, batch=LESSON_ARCHIVE_BATCH):
+    """
+    Переносит прошедшие занятия старше older_than_days в архив пачками по
+    batch: каждая пачка — своя короткая транзакция, сайт между ними пишет.
+    Пачки идут по возрастанию id, так что таблица читается за один проход.
+    Возвращает (сколько перенесено, скольких учеников задело).
+    """
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime("%Y-%m-%d %H:%M")
+    moved, students, last_id = 0, set(), 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                """
+                SELECT id, student_id, status FROM student_lessons
+                -- cutoff в прошлом, так что и rescheduled тут — уже прошедший слот
+                WHERE id > ? AND status IN ('done', 'canceled', 'rescheduled') AND start_at < ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (last_id, cutoff, batch),
+            ).fetchall()
+            if not rows:
+                conn.rollback()
+                break
+            last_id = rows[-1]["id"]
+            seq_before = current_change_seq(conn, "student_items")
+            ids = json.dumps([r["id"] for r in rows])
+            conn.execute(
+                f"""
+                INSERT INTO student_lessons_archive ({LESSON_COLUMNS})
+                SELECT {LESSON_COLUMNS} FROM student_lessons
+                WHERE id IN (SELECT value FROM json_each(?))
+                """,
+                (ids,),
+            )
+            conn.execute(
+                "DELETE FROM student_lessons WHERE id IN (SELECT value FROM json_each(?))",
+                (ids,),
+            )
+            # переезд в архив — не удаление: курсорам /api/student знать о нём не нужно
+            conn.execute(
+                "DELETE FROM student_item_deletions WHERE change_seq > ? AND kind = 'lesson'",
+                (seq_before,),
+            )
+            done = Counter(r["student_id"] for r in rows if r["status"] == "done")
+            conn.executemany(
+                "UPDATE student_stats SET lessons_archived = lessons_archived + ? WHERE student_id = ?",
+                [(n, sid) for sid, n in done.items()],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        moved += len(rows)
+        students.update(r["student_id"] for r in rows)
 
-    conn.commit()
-    conn.close()
+    for sid in students:
+        invalidate_student(sid)
+    return moved, len(students)
 
 
-init_db()
+# ================== КЭШ КАБИНЕТА УЧЕНИКА ==================
+# Собранный кабинет (карточка, уроки по статусам, домашки) хранится в памяти
+# воркера по public_code: LRU на STUDENT_CACHE_SIZE учеников, каждая запись
+# живёт не дольше STUDENT_CACHE_TTL. Свежесть — как у кэша главной, только
+# поштучно: в файле рядом с БД у каждого ученика 8 байт «штампа» по смещению
+# id * 8. Роуты, которые меняют уроки, домашки или карточку, после commit
+# пишут туда новый штамп (invalidate_student), а попадание в кэш сверяет
+# штамп одним pread — без SQL, и правка в одном воркере видна во всех.
+# TTL страхует от правок в обход роутов (скрипты, ручной SQL).
 
+app.config["STUDENT_CACHE"] = os.getenv("STUDENT_CACHE", "1") != "0"
+STUDENT_CACHE_SIZE = int(os.getenv("STUDENT_CACHE_SIZE", "2000"))
+STUDENT_CACHE_TTL = float(os.getenv("STUDENT_CACHE_TTL", "300"))  # секунды
+STUDENT_STAMPS_PATH = DB_PATH + ".student-stamps"
 
-# ================== ХЕЛПЕРЫ ==================
+_student_stamps_fd = None
+_student_stamps_lock = threading.Lock()
 
-def login_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if not session.get("admin_logged_in"):
-            return redirect(url_for("admin_login"))
-        return f(*args, **kwargs)
-    return wrapper
 
-# Преподаватель = тот же админ, отдельная авторизация не нужна
-teacher_login_required = login_required
+def _stamps_fd():
+    global _student_stamps_fd
+    if _student_stamps_fd is None:
+        with _student_stamps_lock:
+            if _student_stamps_fd is None:
+                _student_stamps_fd = os.open(STUDENT_STAMPS_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    return _student_stamps_fd
 
 
-# ================== TELEGRAM ==================
+def student_stamp(student_id):
+    return os.pread(_stamps_fd(), 8, student_id * 8)
 
-def send_enroll_to_telegram(payload: dict):
+
+def invalidate_student(student_id):
+    """Зовём после commit любой правки уроков, домашек или карточки ученика."""
+    if student_id is None:
+        return
+    os.pwrite(_stamps_fd(), time.time_ns().to_bytes(8, "little"), int(student_id) * 8)
+
+
+class StudentDashboardCache:
+    def __init__(self, max_size=STUDENT_CACHE_SIZE, ttl=STUDENT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # public_code -> (student_id, штамп, до какого времени, данные)
+        self._lock = threading.Lock()
+
+    def get(self, code):
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None:
+                return None
+            student_id, stamp, expires, payload = entry
+            if time.monotonic() > expires or student_stamp(student_id) != stamp:
+                del self._entries[code]
+                return None
+            self._entries.move_to_end(code)
+            return payload
+
+    def put(self, code, student_id, stamp, payload, until=None):
+        """until — datetime UTC, позже которого запись протухает раньше TTL."""
+        ttl = self.ttl
+        if until is not None:
+            ttl = min(ttl, max(0.0, (until - datetime.utcnow()).total_seconds()))
+        with self._lock:
+            self._entries[code] = (student_id, stamp, time.monotonic() + ttl, payload)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+student_cache = StudentDashboardCache()
+
+
+def load_student_dashboard(conn, student_id):
     """
-    Отправляет уведомление о новой записи на занятие в Telegram (админу).
-    payload: name, contact, tariff, level, comment
+    Карточка, предстоящие уроки по статусам, окно прошедших и домашки
+    ученика — то, что видит /student.
     """
-    print("DEBUG: send_enroll_to_telegram called with:", payload)
+    # версию и курсор берём ДО выборки: правка посреди неё даст лишний
+    # повтор при следующем опросе, но не потеряется
+    now = lesson_now()
+    version = student_version(student_id=student_id, now=now)
+    cursor = encode_student_cursor(version[0], current_change_seq(conn, "student_items")) \
+        if version else None
+    student = conn.execute(
+        "SELECT * FROM student_accounts WHERE id = ?",
+        (student_id,),
+    ).fetchone()
+    if not student:
+        return None
 
-    if (not TELEGRAM_BOT_TOKEN
-            or not TELEGRAM_CHAT_ID
-            or "YOUR_TELEGRAM_BOT_TOKEN_HERE" in TELEGRAM_BOT_TOKEN):
-        print("DEBUG: TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID is missing or placeholder")
-        return
+    lessons = {"planned": [], "rescheduled": []}
+    for r in upcoming_lessons(conn, student_id, now=now):
+        lessons[lesson_section(r, now)].append(r)
+    history, history_next = lesson_history(conn, student_id, now=now)
+    stats = conn.execute(
+        "SELECT lessons_done + lessons_archived FROM student_stats WHERE student_id = ?",
+        (student_id,),
+    ).fetchone()
 
-    text_lines = [
-        "📝 *Новая заявка на занятия*",
-        "",
-        f"👤 Имя: {payload.get('name') or '-'}",
-        f"📨 Контакт: {payload.get('contact') or '-'}",
-        f"📦 Пакет: {payload.get('tariff') or 'не выбран'}",
-        f"📊 Уровень: {payload.get('level') or '-'}",
-    ]
+    homework_list = conn.execute(
+        """
+        SELECT *
+        FROM student_homework
+        WHERE student_id = ?
+        ORDER BY created_at DESC
+        """,
+        (student_id,),
+    ).fetchall()
 
-    comment = payload.get("comment")
-    if comment:
-        text_lines.append("")
-        text_lines.append(f"💬 Комментарий:\n{comment}")
+    return {
+        "student": student,
+        "lessons_planned": lessons["planned"],
+        "lessons_rescheduled": lessons["rescheduled"],
+        "lessons_history": history,
+        "history_next": history_next,
+        "lessons_done_total": stats[0] if stats else 0,
+        "homework_list": homework_list,
+        "version": version,
+        "cursor": cursor,
+    }
 
-    text = "\n".join(text_lines)
-    print("DEBUG: Telegram text:\n", text)
 
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+def student_dashboard_data(conn, code):
+    """Кабинет по public_code: из кэша, если штамп не менялся, иначе из базы."""
+    if app.config["STUDENT_CACHE"]:
+        cached = student_cache.get(code)
+        if cached is not None:
+            return cached
 
-    try:
-        resp = requests.post(
-            url,
-            json={"chat_id": TELEGRAM_CHAT_ID, "text": text, "parse_mode": "Markdown"},
-            timeout=10,
-        )
-        print("DEBUG: telegram response:", resp.status_code, resp.text)
-    except requests.RequestException as e:
-        print("ERROR: telegram request failed:", e)
+    row = conn.execute(
+        "SELECT id FROM student_accounts WHERE public_code = ?",
+        (code,),
+    ).fetchone()
+    if not row:
+        return None
+    # штамп читаем ДО выборки: правка посреди неё оставит запись уже протухшей
+    stamp = student_stamp(row["id"])
+    payload = load_student_dashboard(conn, row["id"])
+    if payload is not None and app.config["STUDENT_CACHE"]:
+        # ближайший перенесённый слот уйдёт в историю — тогда и протухнуть
+        layout_until = min((r["start_at"] for r in payload["lessons_rescheduled"]), default=None)
+        student_cache.put(code, row["id"], stamp, payload, until=lesson_time_utc(layout_until))
+    return payload
+
+
+# ================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ==================
+# Token bucket на ключ (обычно IP): ёмкость burst, пополняется со скоростью
+# rate токенов в секунду. По умолчанию корзины живут в памяти процесса, с
+# LRU-вытеснением давно не приходивших ключей. При нескольких воркерах
+# gunicorn у каждого свои корзины, поэтому RATE_LIMIT_BACKEND=sqlite
+# переносит их в отдельный маленький файл рядом с БД (не в soul.db):
+# одна UPSERT-запись на запрос, общая для всех воркеров.
+
+app.config["RATE_LIMIT"] = os.getenv("RATE_LIMIT", "1") != "0"
+ratelimit_log = logging.getLogger("soul.ratelimit")
+app.config["RATE_LIMIT_BACKEND"] = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_KEYS = 10000
+RATE_LIMIT_DB_PATH = DB_PATH + ".ratelimit"
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """Списывает токен. Возвращает 0, если можно, иначе сколько секунд ждать."""
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class SqliteBuckets:
+    def __init__(self, path=RATE_LIMIT_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")  # счётчики не жалко потерять
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, rate, burst, now):
+        conn = self._conn()
+        # пополнение и списание одним атомарным UPSERT; если токена нет,
+        # WHERE не пропускает UPDATE и RETURNING ничего не отдаёт
+        row = conn.execute(
+            """
+            INSERT INTO buckets (key, tokens, updated_at) VALUES (:key, :burst - 1, :now)
+            ON CONFLICT(key) DO UPDATE
+            SET tokens = min(:burst, tokens + (:now - updated_at) * :rate) - 1,
+                updated_at = :now
+            WHERE min(:burst, tokens + (:now - updated_at) * :rate) >= 1
+            RETURNING tokens
+            """,
+            {"key": key, "burst": burst, "now": now, "rate": rate},
+        ).fetchone()
+        if row is not None:
+            if random.random() < 0.001:
+                # полные корзины хранить незачем
+                conn.execute(
+                    "DELETE FROM buckets WHERE updated_at < ?", (now - 86400,)
+                )
+            return 0.0
+        tokens, updated = conn.execute(
+            "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+        ).fetchone()
+        return (1 - min(burst, tokens + (now - updated) * rate)) / rate
 
 
-def send_review_to_telegram(review: dict):
-    """
-    При желании — уведомление о новом отзыве (в очередь модерации).
-    Пока заглушка.
-    """
-    print("DEBUG: send_review_to_telegram called (заглушка). Review:", review)
-    return
+_rate_buckets = {}
 
 
-def send_enroll_email_to_user(payload: dict):
+def rate_buckets():
+    backend = app.config["RATE_LIMIT_BACKEND"]
+    if backend not in _rate_buckets:
+        _rate_buckets[backend] = SqliteBuckets() if backend == "sqlite" else MemoryBuckets()
+    return _rate_buckets[backend]
+
+
+def rate_limited(name, per_seconds, burst=1, on_limit=None, counts=None):
     """
-    Заготовка под отправку email пользователю (сейчас не делает ничего).
+    Не больше burst запросов подряд с одного IP, дальше — один за per_seconds.
+    on_limit(retry_after) — что вернуть вместо вьюхи; по умолчанию 429.
+    counts() -> False — запрос не тратит токен (форма не прошла проверку,
+    вьюха её и так отбросит, а исправленную отправку резать нельзя).
     """
-    print("DEBUG: send_enroll_email_to_user called (stub). Payload:", payload)
-    return
-
-#Раздлеление тегов в описании курса
-def split_tags(s: str):
-    if not s:
-        return []
-    return [t.strip() for t in s.split(",") if t.strip()]
+    rate = 1.0 / per_seconds
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if app.config["RATE_LIMIT"] and (counts is None or counts()):
+                key = f"{name}:{client_ip()}"
+                wait = rate_buckets().take(key, rate, burst, time.time())
+                if wait > 0:
+                    ratelimit_log.info("rate limit %s, retry in %.0fs", key, wait)
+                    if on_limit is not None:
+                        return on_limit(wait)
+                    resp = make_response("Too Many Requests", 429)
+                    resp.headers["Retry-After"] = str(int(wait) + 1)
+                    return resp
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _form_filled(*fields):
+    """Все поля формы непустые — та же проверка, что делает сама вьюха."""
+    return all((request.form.get(f) or "").strip() for f in fields)
+
+
+def _json_too_many(retry_after):
+    resp = jsonify({"ok": False, "error": "too many requests"})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(int(retry_after) + 1)
+    return resp
 
 
 # ================== ПУБЛИЧНАЯ ЧАСТЬ ==================
 
 @app.route("/")
+@conditional_get(index_validator)
+@page_cached("index")
 def index():
     conn = get_db()
 
@@ -409,6 +2939,9 @@ def index():
 
 
 @app.post("/add-review")
+@rate_limited("review", REVIEW_SPAM_SECONDS, burst=2,
+              on_limit=lambda wait: redirect(url_for("index")),
+              counts=lambda: _form_filled("name", "text"))
 def add_review():
     name = request.form.get("name", "").strip()
     package = request.form.get("package", "").strip()
@@ -430,17 +2963,19 @@ def add_review():
         "INSERT INTO reviews (name, package, rating, text, approved) VALUES (?, ?, ?, ?, 0)",
         (name, package or None, rating, text),
     )
+    review = {"name": name, "package": package, "rating": rating, "text": text}
+    enqueue_notification(conn, "review", review)
     conn.commit()
     conn.close()
-
-    review = {"name": name, "package": package, "rating": rating, "text": text}
-    send_review_to_telegram(review)
+    outbox_wakeup()
 
     # отзыв ушёл в очередь модерации
     return redirect(url_for("index"))
 
 
 @app.post("/api/telegram/review")
+# бот шлёт отзывы разных людей с одного адреса — лимит мягче
+@rate_limited("api_review", 2, burst=30, on_limit=_json_too_many)
 def api_telegram_review():
     """
     Пример endpoint-а для Telegram-бота, чтобы создавать отзывы.
@@ -472,16 +3007,19 @@ def api_telegram_review():
         "INSERT INTO reviews (name, package, rating, text, approved) VALUES (?, ?, ?, ?, 0)",
         (name, package or None, rating, text),
     )
+    review = {"name": name, "package": package, "rating": rating, "text": text}
+    enqueue_notification(conn, "review", review)
     conn.commit()
     conn.close()
-
-    review = {"name": name, "package": package, "rating": rating, "text": text}
-    send_review_to_telegram(review)
+    outbox_wakeup()
 
     return jsonify({"ok": True})
 
 
 @app.post("/enroll")
+@rate_limited("enroll", ENROLL_SPAM_SECONDS,
+              on_limit=lambda wait: redirect(url_for("thank_you")),
+              counts=lambda: _form_filled("name", "contact"))
 def enroll():
     """
     Обработка формы записи на занятие.
@@ -492,38 +3030,19 @@ def enroll():
     level = (request.form.get("level") or "").strip()
     comment = (request.form.get("comment") or "").strip()
 
-    print("DEBUG: enroll() called, form data:", {
-        "name": name,
-        "contact": contact,
-        "tariff": tariff,
-        "level": level,
-        "comment": comment,
-    })
+    # контакты и комментарий в лог не пишем
+    log.debug(
+        "enroll received",
+        extra={"tariff": tariff, "student_level": level, "has_comment": bool(comment)},
+    )
 
     if not name or not contact:
         return redirect(url_for("index"))
 
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr or "unknown")
-    now = datetime.utcnow()
+    ip = client_ip()
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT created_at FROM enrolls WHERE ip = ? ORDER BY created_at DESC LIMIT 1",
-        (ip,),
-    )
-    row = cur.fetchone()
-    if row and row["created_at"]:
-        try:
-            last_dt = datetime.strptime(row["created_at"], "%Y-%m-%d %H:%M:%S")
-            diff = now - last_dt
-            if diff < timedelta(seconds=ENROLL_SPAM_SECONDS):
-                print(f"DEBUG: spam protection triggered for IP {ip}, diff={diff}")
-                conn.close()
-                return redirect(url_for("thank_you"))
-        except ValueError:
-            pass
-
     cur.execute(
         """
         INSERT INTO enrolls (ip, name, contact, tariff, level, comment)
@@ -531,8 +3050,6 @@ def enroll():
         """,
         (ip, name, contact, tariff or None, level or None, comment or None),
     )
-    conn.commit()
-    conn.close()
 
     payload = {
         "name": name,
@@ -541,7 +3058,12 @@ def enroll():
         "level": level,
         "comment": comment,
     }
-    send_enroll_to_telegram(payload)
+    # уведомление — в той же транзакции, отправит фоновый диспетчер
+    enqueue_notification(conn, "enroll", payload)
+    conn.commit()
+    conn.close()
+    outbox_wakeup()
+
     send_enroll_email_to_user(payload)
 
     return redirect(url_for("thank_you"))
@@ -584,99 +3106,496 @@ def admin_index():
     return redirect(url_for("admin_enrolls"))
 
 
+# ================== АДМИНКА: SQL-СТАТИСТИКА ==================
+
+@app.get("/admin/sql-stats")
+@login_required
+def admin_sql_stats():
+    return render_template(
+        "admin_sql_stats.html",
+        stats=sql_stats_snapshot(),
+        since=_sql_stats_since,
+        slow_ms=app.config["SQL_SLOW_MS"],
+        pid=os.getpid(),
+    )
+
+
+@app.post("/admin/sql-stats/reset")
+@login_required
+def admin_sql_stats_reset():
+    global _sql_stats_since
+    with _sql_stats_lock:
+        _sql_stats.clear()
+        _sql_stats_since = datetime.utcnow()
+    return redirect(url_for("admin_sql_stats"))
+
+
+# ================== АДМИНКА: УВЕДОМЛЕНИЯ ==================
+
+@app.get("/admin/outbox")
+@login_required
+def admin_outbox():
+    conn = get_db()
+    counts, metrics = outbox_stats(conn)
+    rows = conn.execute(
+        """
+        SELECT id, kind, payload, status, attempts, next_attempt_at, last_error, created_at
+        FROM notification_outbox
+        WHERE status IN ('pending', 'dead')
+        ORDER BY id DESC
+        LIMIT 100
+        """
+    ).fetchall()
+    conn.close()
+    return render_template(
+        "admin_outbox.html",
+        counts=counts,
+        metrics=metrics,
+        rows=rows,
+        configured=telegram_configured(),
+        now=time.time(),
+    )
+
+
+@app.post("/admin/outbox/retry")
+@login_required
+def admin_outbox_retry():
+    """Вернуть в очередь мёртвые уведомления (все или одно по id)."""
+    outbox_id = request.form.get("id")
+    conn = get_db()
+    if outbox_id:
+        conn.execute(
+            """
+            UPDATE notification_outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = ?
+            WHERE id = ? AND status = 'dead'
+            """,
+            (time.time(), int(outbox_id)),
+        )
+    else:
+        conn.execute(
+            """
+            UPDATE notification_outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = ?
+            WHERE status = 'dead'
+            """,
+            (time.time(),),
+        )
+    conn.commit()
+    conn.close()
+    outbox_wakeup()
+    return redirect(url_for("admin_outbox"))
+
+
+# ================== АДМИНКА: АНАЛИТИКА ==================
+# Всё читается из сводок enroll_daily / review_ratings (migration 009):
+# стоимость — число дней в периоде, а не число заявок.
+
+@app.get("/admin/analytics")
+@login_required
+def admin_analytics():
+    today = datetime.utcnow().date()
+    date_from = request.args.get("date_from") or today.replace(day=1).isoformat()
+    date_to = request.args.get("date_to") or today.isoformat()
+    period = (date_from, date_to)
+
+    conn = get_db()
+    days = conn.execute(
+        """
+        SELECT day,
+               SUM(CASE WHEN is_bot = 0 THEN n ELSE 0 END) AS leads,
+               SUM(CASE WHEN is_bot = 1 THEN n ELSE 0 END) AS bots
+        FROM enroll_daily
+        WHERE day BETWEEN ? AND ?
+        GROUP BY day
+        ORDER BY day
+        """,
+        period,
+    ).fetchall()
+    tariffs = conn.execute(
+        """
+        SELECT tariff, SUM(n) AS n
+        FROM enroll_daily
+        WHERE day BETWEEN ? AND ? AND is_bot = 0
+        GROUP BY tariff
+        ORDER BY n DESC
+        """,
+        period,
+    ).fetchall()
+    levels = conn.execute(
+        """
+        SELECT level, SUM(n) AS n
+        FROM enroll_daily
+        WHERE day BETWEEN ? AND ? AND is_bot = 0
+        GROUP BY level
+        ORDER BY n DESC
+        """,
+        period,
+    ).fetchall()
+    rating_rows = conn.execute(
+        """
+        SELECT package, rating, SUM(n) AS n, SUM(CASE WHEN approved = 1 THEN n ELSE 0 END) AS published
+        FROM review_ratings
+        GROUP BY package, rating
+        """
+    ).fetchall()
+    conn.close()
+
+    # гистограмма 1..5 по пакету
+    ratings = {}
+    for r in rating_rows:
+        item = ratings.setdefault(
+            r["package"], {"package": r["package"], "hist": [0] * 5, "total": 0, "sum": 0, "published": 0}
+        )
+        if 1 <= r["rating"] <= 5:
+            item["hist"][r["rating"] - 1] += r["n"]
+            item["sum"] += r["rating"] * r["n"]
+        item["total"] += r["n"]
+        item["published"] += r["published"]
+    ratings = sorted(ratings.values(), key=lambda i: -i["total"])
+    for item in ratings:
+        item["avg"] = item["sum"] / item["total"] if item["total"] else 0
+
+    total_leads = sum(d["leads"] for d in days)
+    return render_template(
+        "admin_analytics.html",
+        date_from=date_from,
+        date_to=date_to,
+        days=days,
+        max_day=max((d["leads"] + d["bots"] for d in days), default=0),
+        total_leads=total_leads,
+        total_bots=sum(d["bots"] for d in days),
+        tariffs=tariffs,
+        levels=levels,
+        ratings=ratings,
+    )
+
+
 # ================== АДМИНКА: ЗАЯВКИ ==================
 
+ENROLLS_PAGE_SIZE = 50
+ENROLL_LEVELS = ["Никогда не изучал(а)", "Знаю алфавит", "Могу поддержать простой диалог"]
+
+
+def fts_query(text):
+    """Пользовательский ввод → безопасный запрос FTS5: все слова, по префиксу."""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def has_fts(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def encode_cursor(created_at, row_id):
+    return f"{created_at}~{row_id}"
+
+
+def decode_cursor(value):
+    """'2024-01-31 10:00:00~123' → ('2024-01-31 10:00:00', 123) или None."""
+    created_at, sep, row_id = (value or "").rpartition("~")
+    if not sep or not row_id.isdigit():
+        return None
+    return created_at, int(row_id)
+
+
+def enroll_filters(args, alias="e"):
+    """Фильтры списка заявок из query string → (кусок WHERE, параметры)."""
+    where, params = [], []
+    if args.get("tariff"):
+        where.append(f"{alias}.tariff = ?")
+        params.append(args["tariff"])
+    if args.get("level"):
+        where.append(f"{alias}.level = ?")
+        params.append(args["level"])
+    if args.get("is_bot") in ("0", "1"):
+        where.append(f"COALESCE({alias}.is_bot, 0) = ?")
+        params.append(int(args["is_bot"]))
+    if args.get("date_from"):
+        where.append(f"{alias}.created_at >= ?")
+        params.append(args["date_from"])
+    if args.get("date_to"):
+        # дата «по» включительно
+        where.append(f"{alias}.created_at < date(?, '+1 day')")
+        params.append(args["date_to"])
+    return where, params
+
+
+def enroll_search(conn, args):
+    """
+    Фильтры и поиск по заявкам из query string → (FROM, условия, параметры).
+    Общие для списка в админке и CSV-экспорта.
+    """
+    where, params = enroll_filters(args)
+    source = "enrolls e"
+    q = (args.get("q") or "").strip()
+    if q:
+        if has_fts(conn, "enrolls_fts") and fts_query(q):
+            source = "enrolls_fts f JOIN enrolls e ON e.id = f.rowid"
+            where.append("enrolls_fts MATCH ?")
+            params.append(fts_query(q))
+        else:
+            where.append(
+                "(e.name LIKE ? OR e.contact LIKE ? OR e.comment LIKE ? OR e.admin_note LIKE ?)"
+            )
+            params += [f"%{q}%"] * 4
+    return source, where, params
+
+
 @app.get("/admin/enrolls")
 @login_required
 def admin_enrolls():
+    """
+    Заявки постранично, от новых к старым. Пагинация по ключу
+    (created_at, id): «дальше» — строки меньше последней на странице,
+    «назад» — больше первой, так что каждая страница читает только
+    ENROLLS_PAGE_SIZE строк индекса, как бы далеко ни листали.
+    """
+    args = request.args
     conn = get_db()
-    enrolls = conn.execute("""
+    source, where, params = enroll_search(conn, args)
+
+    before = decode_cursor(args.get("before"))
+    after = decode_cursor(args.get("after"))
+    order = "DESC"
+    if before:
+        where.append("(e.created_at, e.id) < (?, ?)")
+        params += list(before)
+    elif after:
+        where.append("(e.created_at, e.id) > (?, ?)")
+        params += list(after)
+        order = "ASC"
+
+    rows = conn.execute(
+        f"""
         SELECT
-            id,
-            created_at,
-            ip,
-            name,
-            contact,
-            tariff,
-            level,
-            comment,
-            admin_note,
-            is_bot
-        FROM enrolls
-        ORDER BY created_at DESC
-    """).fetchall()
+            e.id,
+            e.created_at,
+            e.ip,
+            e.name,
+            e.contact,
+            e.tariff,
+            e.level,
+            e.comment,
+            e.admin_note,
+            e.is_bot
+        FROM {source}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY e.created_at {order}, e.id {order}
+        LIMIT ?
+        """,
+        params + [ENROLLS_PAGE_SIZE + 1],
+    ).fetchall()
 
+    has_more = len(rows) > ENROLLS_PAGE_SIZE
+    enrolls = rows[:ENROLLS_PAGE_SIZE]
+    if after:
+        enrolls.reverse()
+
+    # курсор «дальше» есть, если за страницей что-то осталось (или мы пришли «назад»)
+    filters = {k: v for k, v in args.items() if k not in ("before", "after") and v}
+    next_url = prev_url = None
+    if enrolls and (has_more or after):
+        last = enrolls[-1]
+        next_url = url_for("admin_enrolls", before=encode_cursor(last["created_at"], last["id"]), **filters)
+    if enrolls and (before or (after and has_more)):
+        first = enrolls[0]
+        prev_url = url_for("admin_enrolls", after=encode_cursor(first["created_at"], first["id"]), **filters)
+
+    tariffs = [r["title"] for r in conn.execute("SELECT title FROM courses ORDER BY title")]
     conn.close()
-    return render_template("admin_enrolls.html", enrolls=enrolls)
+    return render_template(
+        "admin_enrolls.html",
+        enrolls=enrolls,
+        filters=filters,
+        tariffs=tariffs,
+        levels=ENROLL_LEVELS,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
+def redirect_back(endpoint):
+    """После POST — обратно на ту же страницу списка (return_to из формы)."""
+    default = url_for(endpoint)
+    back = request.form.get("return_to") or ""
+    if back.startswith(default):
+        return redirect(back)
+    return redirect(default)
+
+
+def admin_enrolls_return():
+    return redirect_back("admin_enrolls")
+
+
+ENROLL_CSV_COLUMNS = [
+    ("id", "id"),
+    ("created_at", "created_at"),
+    ("ip", "ip"),
+    ("name", "name"),
+    ("contact", "contact"),
+    ("tariff", "tariff"),
+    ("level", "level"),
+    ("comment", "comment"),
+    ("admin_note", "admin_note"),
+    ("is_bot", "is_bot"),
+]
+
+
+def encode_change_cursor(seq):
+    return base64.urlsafe_b64encode(f"enrolls:{seq}".encode()).decode().rstrip("=")
+
+
+def decode_change_cursor(value):
+    """Непрозрачный курсор из X-Next-Cursor → номер изменения или None."""
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    name, _, seq = raw.partition(":")
+    if name != "enrolls" or not seq.isdigit():
+        return None
+    return int(seq)
+
 
+def current_change_seq(conn, name="enrolls"):
+    row = conn.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()
+    return row["value"] if row else 0
+
+
+# Записи об удалениях нужны только курсорам, которые ещё могут прийти.
+# Курсор старше TOMBSTONE_KEEP_DAYS получает полную выгрузку заново.
+TOMBSTONE_KEEP_DAYS = int(os.getenv("TOMBSTONE_KEEP_DAYS", "30"))
+TOMBSTONE_TABLES = {
+    "enroll_deletions": "enrolls",
+    "student_item_deletions": "student_items",
+}
+
+
+def pruned_change_seq(conn, name="enrolls"):
+    """До какого номера записи об удалениях вычищены: курсор ниже — устарел."""
+    return current_change_seq(conn, f"{name}_pruned")
+
+
+def prune_tombstones(conn, keep_days=TOMBSTONE_KEEP_DAYS):
+    """
+    Удаляет записи об удалениях старше keep_days и запоминает в sequences
+    ('<счётчик>_pruned') последний вычищенный номер. Возвращает
+    {таблица: сколько удалено}.
+    """
+    removed = {}
+    for table, name in TOMBSTONE_TABLES.items():
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            upto = conn.execute(
+                f"SELECT MAX(change_seq) FROM {table} WHERE deleted_at < datetime('now', ?)",
+                (f"-{keep_days} days",),
+            ).fetchone()[0]
+            if upto is None:
+                conn.rollback()
+                removed[table] = 0
+                continue
+            # по номеру, а не по дате: ниже отметки не остаётся ничего
+            removed[table] = conn.execute(
+                f"DELETE FROM {table} WHERE change_seq <= ?", (upto,)
+            ).rowcount
+            conn.execute(
+                """
+                INSERT INTO sequences (name, value) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+                """,
+                (f"{name}_pruned", upto),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return removed
 
 
 @app.get("/admin/enrolls/export")
 @login_required
 def admin_enrolls_export():
     """
-    Экспорт заявок в CSV (с admin_note и is_bot).
+    Экспорт заявок в CSV (с admin_note и is_bot). Понимает те же фильтры,
+    что и список (q, tariff, level, is_bot, date_from, date_to), и
+    columns=id,name,contact — какие колонки выгрузить.
+
+    В заголовке X-Next-Cursor приходит курсор. С since=<курсор> выгружаются
+    только заявки, добавленные или изменённые после него, и удалённые —
+    с deleted=1 и пустыми полями. Фильтры в этом режиме не применяются.
+    Курсор старше TOMBSTONE_KEEP_DAYS — 410: нужна полная выгрузка.
     """
     conn = get_db()
-    conn.row_factory = sqlite3.Row
-
-    rows = conn.execute(
+    columns = csv_columns(ENROLL_CSV_COLUMNS, request.args.get("columns"))
+    # снимок счётчика до выборки: всё, что изменится во время выгрузки,
+    # получит номер больше и приедет в следующий раз
+    upto = current_change_seq(conn)
+
+    since_raw = request.args.get("since")
+    if since_raw is not None:
+        since = decode_change_cursor(since_raw)
+        if since is None:
+            conn.close()
+            return "Некорректный курсор", 400
+        if since < pruned_change_seq(conn):
+            # удаления после курсора уже вычищены — дельта была бы неполной
+            conn.close()
+            return "Курсор устарел, выгрузите заявки полностью (без since)", 410
+
+        if ("id", "id") not in columns:
+            columns.insert(0, ("id", "id"))
+        columns.append(("deleted", "deleted"))
+        sql = """
+            SELECT
+                e.change_seq,
+                e.id,
+                e.created_at,
+                e.ip,
+                e.name,
+                e.contact,
+                e.tariff,
+                e.level,
+                e.comment,
+                COALESCE(e.admin_note, '') AS admin_note,
+                CASE WHEN e.is_bot THEN 1 ELSE 0 END AS is_bot,
+                0 AS deleted
+            FROM enrolls e
+            WHERE e.change_seq > ? AND e.change_seq <= ?
+            UNION ALL
+            SELECT
+                d.change_seq, d.enroll_id,
+                NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+                1
+            FROM enroll_deletions d
+            WHERE d.change_seq > ? AND d.change_seq <= ?
+            ORDER BY 1
         """
-        SELECT
-            id,
-            created_at,
-            ip,
-            name,
-            contact,
-            tariff,
-            level,
-            comment,
-            COALESCE(admin_note, '') AS admin_note,
-            COALESCE(is_bot, 0)      AS is_bot
-        FROM enrolls
-        ORDER BY created_at DESC
+        resp = stream_csv(conn, sql, [since, upto, since, upto], columns, "enrolls_delta.csv")
+    else:
+        source, where, params = enroll_search(conn, request.args)
+        sql = f"""
+            SELECT
+                e.id,
+                e.created_at,
+                e.ip,
+                e.name,
+                e.contact,
+                e.tariff,
+                e.level,
+                e.comment,
+                COALESCE(e.admin_note, '') AS admin_note,
+                CASE WHEN e.is_bot THEN 1 ELSE 0 END AS is_bot
+            FROM {source}
+            {"WHERE " + " AND ".join(where) if where else ""}
+            ORDER BY e.created_at DESC, e.id DESC
         """
-    ).fetchall()
-
-    conn.close()
+        resp = stream_csv(conn, sql, params, columns, "enrolls.csv")
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-
-    writer.writerow([
-        "id",
-        "created_at",
-        "ip",
-        "name",
-        "contact",
-        "tariff",
-        "level",
-        "comment",
-        "admin_note",
-        "is_bot",
-    ])
-
-    for r in rows:
-        writer.writerow([
-            r["id"],
-            r["created_at"] or "",
-            r["ip"] or "",
-            r["name"] or "",
-            r["contact"] or "",
-            r["tariff"] or "",
-            r["level"] or "",
-            r["comment"] or "",
-            r["admin_note"] or "",
-            1 if (r["is_bot"] or 0) else 0,
-        ])
-
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode("utf-8-sig")),
-        mimetype="text/csv; charset=utf-8",
-        as_attachment=True,
-        download_name="enrolls.csv",
-    )
+    resp.headers["X-Next-Cursor"] = encode_change_cursor(upto)
+    return resp
 
 
 
@@ -701,82 +3620,345 @@ def admin_enroll_note(enroll_id: int):
     conn.commit()
     conn.close()
 
-    return redirect(url_for("admin_enrolls"))
-
+    return admin_enrolls_return()
+
+
+
+
+
+
+
+@app.post("/admin/enrolls/<int:enroll_id>/bot")
+@login_required
+def admin_enroll_bot(enroll_id: int):
+    value = 1 if (request.form.get("value") == "1") else 0
+
+    conn = get_db()
+    conn.execute(
+        "UPDATE enrolls SET is_bot = ? WHERE id = ?",
+        (value, enroll_id),
+    )
+    conn.commit()
+    conn.close()
+
+    return admin_enrolls_return()
 
 
+def like_pattern(pattern):
+    """'*@mail.ru' → '%@mail.ru' для LIKE ... ESCAPE '\\'."""
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
 
 
+def enroll_bulk_target(data):
+    """
+    Какие заявки трогать: явный список ids или фильтр (ip, contact с * как
+    маской, created_from / created_to). Возвращает (условие, параметры)
+    или None, если не задано ни то, ни другое — «все заявки» не бывает.
+    None и на кривой JSON: ids не списком, filter не объектом, не строки в нём.
+    """
+    if not isinstance(data, dict):
+        return None
+    ids = data.get("ids")
+    if ids:
+        if not isinstance(ids, list):
+            return None
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            return None
+        # один параметр вместо тысячи ?, ?, ?
+        return "id IN (SELECT value FROM json_each(?))", [json.dumps(ids)]
+
+    where, params = [], []
+    flt = data.get("filter") or {}
+    if not isinstance(flt, dict) or any(
+        value is not None and not isinstance(value, str) for value in flt.values()
+    ):
+        return None
+    if flt.get("ip"):
+        where.append("ip = ?")
+        params.append(flt["ip"].strip())
+    if flt.get("contact"):
+        where.append("contact LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(flt["contact"].strip()))
+    if flt.get("created_from"):
+        where.append("created_at >= ?")
+        params.append(flt["created_from"].strip())
+    if flt.get("created_to"):
+        where.append("created_at <= ?")
+        params.append(flt["created_to"].strip())
+    if not where:
+        return None
+    return " AND ".join(where), params
 
 
-@app.post("/admin/enrolls/<int:enroll_id>/bot")
+@app.post("/admin/enrolls/bulk")
 @login_required
-def admin_enroll_bot(enroll_id: int):
-    value = 1 if (request.form.get("value") == "1") else 0
+def admin_enrolls_bulk():
+    """
+    Массовая разметка заявок одной транзакцией.
+
+    JSON: {"ids": [1, 2], "is_bot": 1, "admin_note": "спам", "delete": false}
+    или {"filter": {"ip": "...", "contact": "*@spam.ru",
+                    "created_from": "2025-01-01 00:00", "created_to": "..."}, ...}
+    Форма: те же поля, ids — несколько значений, фильтр — filter_ip и т.д.
+
+    На JSON отвечает новыми значениями затронутых строк — таблица в
+    админке обновляется на месте, без перезагрузки.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+    else:
+        form = request.form
+        data = {
+            "ids": form.getlist("ids"),
+            "filter": {
+                key: form.get(f"filter_{key}")
+                for key in ("ip", "contact", "created_from", "created_to")
+            },
+            "delete": form.get("delete") == "1",
+        }
+        if form.get("is_bot") in ("0", "1"):
+            data["is_bot"] = form.get("is_bot")
+        if form.get("set_note"):
+            data["admin_note"] = form.get("bulk_note", "")
+        elif "admin_note" in form:
+            data["admin_note"] = form.get("admin_note")
+
+    target = enroll_bulk_target(data)
+    if target is None:
+        if request.is_json:
+            return jsonify({"ok": False, "error": "ids or filter required"}), 400
+        return admin_enrolls_return()
+    where, params = target
+
+    sets, set_params = [], []
+    if data.get("is_bot") is not None and str(data["is_bot"]) in ("0", "1"):
+        sets.append("is_bot = ?")
+        set_params.append(int(data["is_bot"]))
+    if data.get("admin_note") is not None:
+        if not isinstance(data["admin_note"], str):
+            return jsonify({"ok": False, "error": "admin_note must be a string"}), 400
+        sets.append("admin_note = ?")
+        set_params.append((data["admin_note"] or "").strip() or None)
 
     conn = get_db()
-    conn.execute(
-        "UPDATE enrolls SET is_bot = ? WHERE id = ?",
-        (value, enroll_id),
-    )
-    conn.commit()
+    try:
+        if data.get("delete"):
+            rows = conn.execute(
+                f"DELETE FROM enrolls WHERE {where} RETURNING id", params
+            ).fetchall()
+            result = {"deleted": [r["id"] for r in rows]}
+        elif sets:
+            rows = conn.execute(
+                f"""
+                UPDATE enrolls SET {", ".join(sets)}
+                WHERE {where}
+                RETURNING id, COALESCE(is_bot, 0) AS is_bot, admin_note
+                """,
+                set_params + params,
+            ).fetchall()
+            result = {"updated": [dict(r) for r in rows]}
+        else:
+            conn.close()
+            if request.is_json:
+                return jsonify({"ok": False, "error": "nothing to do"}), 400
+            return admin_enrolls_return()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
     conn.close()
 
-    return redirect(url_for("admin_enrolls"))
+    log.info(
+        "enrolls bulk triage",
+        extra={"affected": len(rows), "delete": bool(data.get("delete")), "by_filter": not data.get("ids")},
+    )
+    if request.is_json:
+        return jsonify({"ok": True, "affected": len(rows), **result})
+    return admin_enrolls_return()
 
 
 
 # ================== АДМИНКА: ОТЗЫВЫ ==================
 
+REVIEWS_PAGE_SIZE = 30
+REVIEW_STATUSES = {"pending": 0, "approved": 1}
+
+
 @app.get("/admin/reviews")
 @login_required
 def admin_reviews():
+    """
+    Очередь модерации: status=pending (по умолчанию) / approved / all,
+    поиск q по имени, пакету и тексту, пагинация по (created_at, id),
+    как у заявок.
+    """
+    args = request.args
+    status = args.get("status", "pending")
     conn = get_db()
-    reviews = conn.execute(
-        """
-        SELECT id, created_at, name, package, rating, text, approved
-        FROM reviews
-        ORDER BY created_at DESC
-        LIMIT 500
-        """
+
+    where, params = [], []
+    if status in REVIEW_STATUSES:
+        where.append("r.approved = ?")
+        params.append(REVIEW_STATUSES[status])
+
+    source = "reviews r"
+    q = (args.get("q") or "").strip()
+    if q:
+        if has_fts(conn, "reviews_fts") and fts_query(q):
+            source = "reviews_fts f JOIN reviews r ON r.id = f.rowid"
+            where.append("reviews_fts MATCH ?")
+            params.append(fts_query(q))
+        else:
+            where.append("(r.name LIKE ? OR r.package LIKE ? OR r.text LIKE ?)")
+            params += [f"%{q}%"] * 3
+
+    before = decode_cursor(args.get("before"))
+    after = decode_cursor(args.get("after"))
+    order = "DESC"
+    if before:
+        where.append("(r.created_at, r.id) < (?, ?)")
+        params += list(before)
+    elif after:
+        where.append("(r.created_at, r.id) > (?, ?)")
+        params += list(after)
+        order = "ASC"
+
+    rows = conn.execute(
+        f"""
+        SELECT r.id, r.created_at, r.name, r.package, r.rating, r.text, r.approved
+        FROM {source}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY r.created_at {order}, r.id {order}
+        LIMIT ?
+        """,
+        params + [REVIEWS_PAGE_SIZE + 1],
     ).fetchall()
+
+    has_more = len(rows) > REVIEWS_PAGE_SIZE
+    reviews = rows[:REVIEWS_PAGE_SIZE]
+    if after:
+        reviews.reverse()
+
+    filters = {k: v for k, v in args.items() if k not in ("before", "after") and v}
+    next_url = prev_url = None
+    if reviews and (has_more or after):
+        last = reviews[-1]
+        next_url = url_for("admin_reviews", before=encode_cursor(last["created_at"], last["id"]), **filters)
+    if reviews and (before or (after and has_more)):
+        first = reviews[0]
+        prev_url = url_for("admin_reviews", after=encode_cursor(first["created_at"], first["id"]), **filters)
+
+    # счётчики вкладок — по индексу (approved, created_at), без чтения строк
+    counts = {
+        name: conn.execute("SELECT COUNT(*) FROM reviews WHERE approved = ?", (value,)).fetchone()[0]
+        for name, value in REVIEW_STATUSES.items()
+    }
+    conn.close()
+    return render_template(
+        "admin_reviews.html",
+        reviews=reviews,
+        status=status,
+        q=q,
+        counts=counts,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
+def moderate_reviews(conn, ids, action):
+    """approve / hide / delete для списка id в текущей транзакции. Возвращает затронутые id."""
+    ids_json = json.dumps(ids)
+    if action == "delete":
+        sql = "DELETE FROM reviews WHERE id IN (SELECT value FROM json_each(?)) RETURNING id"
+    else:
+        approved = 1 if action == "approve" else 0
+        sql = f"""
+            UPDATE reviews SET approved = {approved}
+            WHERE id IN (SELECT value FROM json_each(?)) AND approved IS NOT {approved}
+            RETURNING id
+        """
+    return [r["id"] for r in conn.execute(sql, (ids_json,)).fetchall()]
+
+
+@app.post("/admin/reviews/bulk")
+@login_required
+def admin_reviews_bulk():
+    """
+    Пакетная модерация: {"ids": [...], "action": "approve" | "hide" | "delete"}
+    (JSON или форма с несколькими ids). Одна транзакция и один сброс кэша
+    главной на весь пакет.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            data = {}
+        ids, action = data.get("ids") or [], data.get("action")
+    else:
+        ids, action = request.form.getlist("ids"), request.form.get("action")
+
+    # строка "123" — не список: иначе она разошлась бы на id 1, 2, 3
+    if not isinstance(ids, list):
+        ids = []
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        ids = []
+    if not ids or action not in ("approve", "hide", "delete"):
+        if request.is_json:
+            return jsonify({"ok": False, "error": "ids and action required"}), 400
+        return redirect_back("admin_reviews")
+
+    conn = get_db()
+    try:
+        changed = moderate_reviews(conn, ids, action)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
     conn.close()
-    return render_template("admin_reviews.html", reviews=reviews)
+
+    if changed:
+        bump_content_version()
+    if request.is_json:
+        return jsonify({"ok": True, "action": action, "changed": changed})
+    return redirect_back("admin_reviews")
 
 
 @app.post("/admin/reviews/<int:review_id>/approve")
 @login_required
 def admin_review_approve(review_id: int):
     conn = get_db()
-    conn.execute(
-        "UPDATE reviews SET approved = 1 WHERE id = ?",
-        (review_id,),
-    )
+    moderate_reviews(conn, [review_id], "approve")
     conn.commit()
     conn.close()
-    return redirect(url_for("admin_reviews"))
+    bump_content_version()
+    return redirect_back("admin_reviews")
 
 
 @app.post("/admin/reviews/<int:review_id>/hide")
 @login_required
 def admin_review_hide(review_id: int):
     conn = get_db()
-    conn.execute(
-        "UPDATE reviews SET approved = 0 WHERE id = ?",
-        (review_id,),
-    )
+    moderate_reviews(conn, [review_id], "hide")
     conn.commit()
     conn.close()
-    return redirect(url_for("admin_reviews"))
+    bump_content_version()
+    return redirect_back("admin_reviews")
 
 @app.post("/admin/reviews/<int:review_id>/delete")
 @login_required
 def admin_review_delete(review_id: int):
     conn = get_db()
-    conn.execute("DELETE FROM reviews WHERE id = ?", (review_id,))
+    moderate_reviews(conn, [review_id], "delete")
     conn.commit()
     conn.close()
-    return redirect(url_for("admin_reviews"))
+    bump_content_version()
+    return redirect_back("admin_reviews")
 
 
 # ----- СПИСОК ПРЕПОДАВАТЕЛЕЙ -----
@@ -817,6 +3999,8 @@ def admin_teachers_add():
     )
     conn.commit()
     conn.close()
+    bump_content_version()
+    schedule_image_variants(TEACHER_UPLOAD, photo)
     return redirect(url_for("admin_teachers"))
 
 
@@ -852,7 +4036,8 @@ def admin_teachers_edit(tid):
             conn.execute(
                 """
                 UPDATE teachers
-                SET name = ?, role = ?, bio = ?, photo = ?, highlights = ?, badges = ?
+                SET name = ?, role = ?, bio = ?, photo = ?, photo_variants = NULL,
+                    highlights = ?, badges = ?
                 WHERE id = ?
                 """,
                 (name, role, bio, new_photo, highlights, badges, tid),
@@ -869,6 +4054,8 @@ def admin_teachers_edit(tid):
 
         conn.commit()
         conn.close()
+        bump_content_version()
+        schedule_image_variants(TEACHER_UPLOAD, new_photo)
         return redirect(url_for("admin_teachers"))
 
     # GET-запрос — просто показать форму
@@ -886,6 +4073,7 @@ def admin_teachers_delete(tid):
     conn.execute("DELETE FROM teachers WHERE id = ?", (tid,))
     conn.commit()
     conn.close()
+    bump_content_version()
     return redirect(url_for("admin_teachers"))
 
 
@@ -929,6 +4117,8 @@ def admin_courses_add():
     )
     conn.commit()
     conn.close()
+    bump_content_version()
+    schedule_image_variants(COURSE_UPLOAD, photo)
 
     return redirect(url_for("admin_courses"))
 
@@ -940,6 +4130,7 @@ def admin_courses_delete(cid):
     conn.execute("DELETE FROM courses WHERE id=?", (cid,))
     conn.commit()
     conn.close()
+    bump_content_version()
     return redirect(url_for("admin_courses"))
 
 @app.route("/admin/courses/<int:cid>/edit", methods=["GET", "POST"])
@@ -970,7 +4161,7 @@ def admin_courses_edit(cid):
         if new_photo:
             conn.execute("""
                 UPDATE courses
-                SET title=?, price=?, lessons=?, description=?, photo=?, hero_tags = ?
+                SET title=?, price=?, lessons=?, description=?, photo=?, photo_variants=NULL, hero_tags = ?
                 WHERE id=?
             """, (title, price, lessons, description, new_photo, hero_tags, cid))
         else:
@@ -982,6 +4173,8 @@ def admin_courses_edit(cid):
 
         conn.commit()
         conn.close()
+        bump_content_version()
+        schedule_image_variants(COURSE_UPLOAD, new_photo)
         return redirect(url_for("admin_courses"))
 
     conn.close()
@@ -999,9 +4192,7 @@ def admin_gallery():
         conn.close()
         return render_template("admin_gallery.html", images=images)
     except Exception as e:
-        import traceback
-        print("ERROR in /admin/gallery:", e)
-        traceback.print_exc()  # полный стэк в консоль
+        log.exception("admin gallery failed")
         return f"Ошибка в галерее: {e}", 500
 
 
@@ -1025,6 +4216,8 @@ def admin_gallery_add():
     )
     conn.commit()
     conn.close()
+    bump_content_version()
+    schedule_image_variants(GALLERY_UPLOAD, photo)
     return redirect(url_for("admin_gallery"))
 
 
@@ -1035,6 +4228,7 @@ def admin_gallery_delete(gid):
     conn.execute("DELETE FROM gallery WHERE id=?", (gid,))
     conn.commit()
     conn.close()
+    bump_content_version()
     return redirect(url_for("admin_gallery"))
 
 
@@ -1065,21 +4259,33 @@ def teacher_logout():
 
 @app.get("/teacher/students")
 @teacher_login_required
+@conditional_get(teacher_students_validator, private=True)
 def teacher_students():
     conn = get_db()
     conn.row_factory = sqlite3.Row
 
+    # счётчики — из student_stats (ведут триггеры), по одному PK-поиску на ученика
     students = conn.execute("""
         SELECT
             s.*,
-            t.name AS teacher_name
+            t.name AS teacher_name,
+            COALESCE(st.lessons_done, 0) + COALESCE(st.lessons_archived, 0) AS lessons_done,
+            COALESCE(st.lessons_planned, 0) AS lessons_planned,
+            st.next_lesson_at,
+            COALESCE(st.hw_new, 0) AS hw_new,
+            COALESCE(st.hw_assigned, 0) AS hw_assigned
         FROM student_accounts AS s
         LEFT JOIN teachers AS t ON t.id = s.teacher_id
+        LEFT JOIN student_stats AS st ON st.student_id = s.id
         ORDER BY s.name COLLATE NOCASE
     """).fetchall()
 
     conn.close()
-    return render_template("teacher_students.html", students=students)
+    return render_template(
+        "teacher_students.html",
+        students=students,
+        now=datetime.now().strftime("%Y-%m-%d %H:%M"),
+    )
 
 
 @app.route("/teacher/homework/<int:hw_id>", methods=["GET", "POST"])
@@ -1140,6 +4346,7 @@ def teacher_homework_review(hw_id):
         ))
         conn.commit()
         conn.close()
+        invalidate_student(hw["student_id"])
 
         flash("Домашнее задание обновлено", "success")
         return redirect(url_for("teacher_homework_list"))
@@ -1162,9 +4369,8 @@ def teacher_students_add():
         comment = (request.form.get("comment") or "").strip()
         teacher_id = request.form.get("teacher_id") or None
 
-        code = generate_student_code()
-
         conn = get_db()
+        code = generate_student_code(conn)
         conn.execute(
             """
             INSERT INTO student_accounts (
@@ -1264,12 +4470,10 @@ def teacher_students_edit(sid):
         )
         conn.commit()
         conn.close()
+        invalidate_student(sid)
         return redirect(url_for("teacher_students"))
 
-
-    conn.close()
     # подтягиваем список преподавателей
-    conn = get_db()
     teachers = conn.execute("SELECT id, name FROM teachers ORDER BY name").fetchall()
     conn.close()
 
@@ -1288,22 +4492,17 @@ def teacher_students_delete(sid):
     conn.execute("DELETE FROM student_accounts WHERE id = ?", (sid,))
     conn.commit()
     conn.close()
+    invalidate_student(sid)
     return redirect(url_for("teacher_students"))
 
 
 @app.route("/student", methods=["GET", "POST"])
+@conditional_get(student_dashboard_validator, private=True)
 def student_dashboard():
     code = None
-    student = None
+    dashboard = None
     not_found = False
 
-    # сразу заводим списки, чтобы шаблон всегда их видел
-    lessons_planned = []
-    lessons_rescheduled = []
-    lessons_done = []
-    lessons_canceled = []
-    homework_list = []
-
     # --- 1. Определяем, какой это POST: ввод кода или загрузка ДЗ ---
     if request.method == "POST" and request.form.get("action") != "upload_homework":
         # это обычный ввод 6-значного ID
@@ -1315,47 +4514,15 @@ def student_dashboard():
     conn = get_db()
     conn.row_factory = sqlite3.Row
 
-    # --- 2. Ищем ученика по public_code ---
+    # --- 2. Ищем ученика по public_code (повторные просмотры — из кэша) ---
     if code:
-        student = conn.execute(
-            "SELECT * FROM student_accounts WHERE public_code = ?",
-            (code,),
-        ).fetchone()
-        if not student:
+        dashboard = student_dashboard_data(conn, code)
+        if dashboard is None:
             not_found = True
 
-    # --- 3. Если ученик найден — подтягиваем его расписание ---
-    if student:
-        rows = conn.execute(
-            """
-            SELECT *
-            FROM student_lessons
-            WHERE student_id = ?
-            ORDER BY start_at
-            """,
-            (student["id"],),
-        ).fetchall()
-
-        for r in rows:
-            status = (r["status"] or "").lower() if "status" in r.keys() else ""
-            # если вдруг нет статуса — считаем по умолчанию "planned"
-            if not status:
-                status = "planned"
-
-            if status == "planned":
-                lessons_planned.append(r)
-            elif status == "rescheduled":
-                lessons_rescheduled.append(r)
-            elif status == "done":
-                lessons_done.append(r)
-            elif status == "canceled":
-                lessons_canceled.append(r)
-            else:
-                # неизвестный статус — можно тоже считать запланированным
-                lessons_planned.append(r)
-
-    # --- 4. Обработка загрузки домашнего задания ---
-    if student and request.method == "POST" and request.form.get("action") == "upload_homework":
+    # --- 3. Обработка загрузки домашнего задания ---
+    if dashboard and request.method == "POST" and request.form.get("action") == "upload_homework":
+        student = dashboard["student"]
         file = request.files.get("hw_file")
         title = (request.form.get("hw_title") or "").strip()
         comment = (request.form.get("hw_comment") or "").strip()
@@ -1414,48 +4581,229 @@ def student_dashboard():
                 ))
 
             conn.commit()
+            invalidate_student(student["id"])
 
-
-        # после загрузки — обновим список ДЗ
-        homework_list = conn.execute(
-            """
-            SELECT *
-            FROM student_homework
-            WHERE student_id = ?
-            ORDER BY created_at DESC
-            """,
-            (student["id"],),
-        ).fetchall()
-
-    elif student:
-        # просто просмотр — подтягиваем список домашних
-        homework_list = conn.execute(
-            """
-            SELECT *
-            FROM student_homework
-            WHERE student_id = ?
-            ORDER BY created_at DESC
-            """,
-            (student["id"],),
-        ).fetchall()
+            # после загрузки — обновим список ДЗ
+            dashboard = student_dashboard_data(conn, code)
 
     conn.close()
 
+    if dashboard is None:
+        # сразу заводим списки, чтобы шаблон всегда их видел
+        dashboard = {
+            "student": None,
+            "lessons_planned": [],
+            "lessons_rescheduled": [],
+            "lessons_history": [],
+            "history_next": None,
+            "lessons_done_total": 0,
+            "homework_list": [],
+            "cursor": None,
+        }
+
     return render_template(
         "student_dashboard.html",
         code=code,
-        student=student,
+        cursor=dashboard["cursor"],
+        student=dashboard["student"],
         not_found=not_found,
-        homework_list=homework_list,
-        lessons_planned=lessons_planned,
-        lessons_rescheduled=lessons_rescheduled,
-        lessons_done=lessons_done,
-        lessons_canceled=lessons_canceled,
+        homework_list=dashboard["homework_list"],
+        lessons_planned=dashboard["lessons_planned"],
+        lessons_rescheduled=dashboard["lessons_rescheduled"],
+        lessons_history=dashboard["lessons_history"],
+        history_next=dashboard["history_next"],
+        lessons_done_total=dashboard["lessons_done_total"],
+    )
+
+
+@app.get("/student/lessons")
+def student_lessons_more():
+    """Следующая страница прошедших занятий для «Показать ещё» в кабинете."""
+    code = (request.args.get("code") or "").strip()
+    conn = get_db()
+    conn.row_factory = sqlite3.Row
+    student = conn.execute(
+        "SELECT id, public_code FROM student_accounts WHERE public_code = ?",
+        (code,),
+    ).fetchone()
+    if not student:
+        conn.close()
+        return "Ученик не найден", 404
+    history, history_next = lesson_history(
+        conn, student["id"], before=decode_cursor(request.args.get("before"))
+    )
+    conn.close()
+    return render_template(
+        "_student_lesson_history.html",
+        student=student,
+        lessons_history=history,
+        history_next=history_next,
+    )
+
+
+def encode_student_cursor(version_key, seq):
+    """Курсор опроса кабинета: версия ученика (student:<id>:<n>) + номер изменения."""
+    return base64.urlsafe_b64encode(f"{version_key}@{seq}".encode()).decode().rstrip("=")
+
+
+def decode_student_cursor(value):
+    """Курсор из /api/student → (версия, номер изменения) или None."""
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    key, _, seq = raw.rpartition("@")
+    if not key.startswith("student:") or not seq.isdigit():
+        return None
+    return key, int(seq)
+
+
+STUDENT_LESSON_FIELDS = ("id", "start_at", "status", "rescheduled_to", "topic", "comment", "updated_at")
+STUDENT_HOMEWORK_FIELDS = (
+    "id", "title", "comment", "status", "file_name", "teacher_comment",
+    "teacher_file_name", "created_at", "checked_at",
+)
+STUDENT_CARD_FIELDS = (
+    "public_code", "name", "course", "lessons_total", "lessons_left",
+    "last_payment_date", "last_payment_amount", "comment",
+)
+
+
+def _homework_json(r):
+    item = {f: r[f] for f in STUDENT_HOMEWORK_FIELDS}
+    item["file_url"] = url_for("static", filename=r["file_path"]) if r["file_path"] else None
+    item["teacher_file_url"] = (
+        url_for("static", filename=r["teacher_file_path"]) if r["teacher_file_path"] else None
     )
+    return item
+
+
+@app.get("/api/student")
+@rate_limited("api_student", 0.5, burst=60, on_limit=_json_too_many)
+@conditional_get(student_dashboard_validator, private=True)
+def api_student():
+    """
+    Уроки и домашки ученика для опроса со страницы. Без since — всё;
+    since=<cursor> из прошлого ответа — только изменённое после него
+    (по change_seq) и id удалённого. Если у ученика ничего не менялось,
+    ответ — один запрос по индексу (или ни одного, если кабинет в кэше);
+    с If-None-Match — 304. html=1 — заодно готовая разметка, чтобы /student
+    обновился без перезагрузки: в полном ответе — блоки целиком (карточка,
+    занятия, домашки), в дельте — карточка и только изменённые строки.
+    """
+    code = (request.args.get("code") or "").strip()
+    if not code:
+        return jsonify({"ok": False, "error": "code required"}), 400
+    validated = student_dashboard_validator()
+    if validated is None:
+        return jsonify({"ok": False, "error": "not found"}), 404
+    version_key = validated[0]
+    student_id = int(version_key.split(":")[1])
+
+    since = decode_student_cursor(request.args.get("since") or "")
+    if since and since[0] == version_key:
+        return jsonify({"ok": True, "changed": False, "cursor": request.args["since"]})
+
+    conn = get_db()
+    conn.row_factory = sqlite3.Row
+    if (
+        since
+        and since[0].startswith(f"student:{student_id}:")
+        and student_version_layout(since[0]) == student_version_layout(version_key)
+        and since[1] >= pruned_change_seq(conn, "student_items")
+    ):
+        # дельта: всё по индексам (student_id, change_seq). Если с курсора
+        # прошёл перенесённый слот, раскладка другая — отдаём всё заново;
+        # так же и со слишком старым курсором: его удаления уже вычищены
+        seq = current_change_seq(conn, "student_items")
+        lessons = conn.execute(
+            "SELECT * FROM student_lessons WHERE student_id = ? AND change_seq > ? ORDER BY start_at",
+            (student_id, since[1]),
+        ).fetchall()
+        homework = conn.execute(
+            "SELECT * FROM student_homework WHERE student_id = ? AND change_seq > ? "
+            "ORDER BY created_at DESC",
+            (student_id, since[1]),
+        ).fetchall()
+        deleted = {"lesson": [], "homework": []}
+        for r in conn.execute(
+            "SELECT kind, item_id FROM student_item_deletions WHERE student_id = ? AND change_seq > ?",
+            (student_id, since[1]),
+        ):
+            deleted[r["kind"]].append(r["item_id"])
+        card = conn.execute(
+            "SELECT * FROM student_accounts WHERE id = ?", (student_id,)
+        ).fetchone()
+        full = False
+        cursor = encode_student_cursor(version_key, seq)
+    else:
+        dashboard = student_dashboard_data(conn, code)
+        if dashboard is None:
+            conn.close()
+            return jsonify({"ok": False, "error": "not found"}), 404
+        card = dashboard["student"]
+        # предстоящие + окно прошедших, как на странице; старше — /student/lessons
+        lessons = sorted(
+            dashboard["lessons_planned"] + dashboard["lessons_rescheduled"]
+            + dashboard["lessons_history"],
+            key=lambda r: r["start_at"] or "",
+        )
+        homework = dashboard["homework_list"]
+        deleted = {"lesson": [], "homework": []}
+        full = True
+        cursor = dashboard["cursor"]
+
+    result = {
+        "ok": True,
+        "changed": True,
+        "full": full,
+        "cursor": cursor,
+        "student": {f: card[f] for f in STUDENT_CARD_FIELDS} if card else None,
+        "lessons": [{f: r[f] for f in STUDENT_LESSON_FIELDS} for r in lessons],
+        "homework": [_homework_json(r) for r in homework],
+        "deleted": {"lessons": deleted["lesson"], "homework": deleted["homework"]},
+    }
+    if request.args.get("html") and card:
+        if full:
+            result["html"] = {
+                "summary": render_template("_student_summary.html", **dashboard),
+                "lessons": render_template("_student_lessons.html", **dashboard),
+                "homework": render_template("_student_homework.html", **dashboard),
+            }
+        else:
+            # дельта: карточка целиком (она маленькая) и только изменённые
+            # строки — страница вставит их на место по секции и data-sort
+            stats = conn.execute(
+                "SELECT lessons_done + lessons_archived FROM student_stats WHERE student_id = ?",
+                (student_id,),
+            ).fetchone()
+            now = lesson_now()
+            result["html"] = {
+                "summary": render_template(
+                    "_student_summary.html",
+                    student=card,
+                    lessons_done_total=stats[0] if stats else 0,
+                ),
+                "lesson_rows": [
+                    {
+                        "id": r["id"],
+                        "section": lesson_section(r, now),
+                        "html": render_template("_student_lesson_row.html", l=r),
+                    }
+                    for r in lessons
+                ],
+                "homework_items": [
+                    {"id": r["id"], "html": render_template("_student_homework_item.html", hw=r)}
+                    for r in homework
+                ],
+            }
+    conn.close()
+    return jsonify(result)
 
 
 @app.route("/teacher/homework")
 @teacher_login_required  # или login_required, как тебе надо
+@conditional_get(lambda: table_versions("student_homework", "student_accounts"), private=True)
 def teacher_homework_list():
     conn = get_db()
     conn.row_factory = sqlite3.Row
@@ -1478,7 +4826,7 @@ def teacher_homework_delete(hw_id):
     conn.row_factory = sqlite3.Row
 
     hw = conn.execute(
-        "SELECT file_path, teacher_file_path FROM student_homework WHERE id = ?",
+        "SELECT student_id, file_path, teacher_file_path FROM student_homework WHERE id = ?",
         (hw_id,),
     ).fetchone()
 
@@ -1507,6 +4855,7 @@ def teacher_homework_delete(hw_id):
     conn.execute("DELETE FROM student_homework WHERE id = ?", (hw_id,))
     conn.commit()
     conn.close()
+    invalidate_student(hw["student_id"])
 
     flash("Домашнее задание удалено", "success")
     return redirect(url_for("teacher_homework_list"))
@@ -1569,6 +4918,7 @@ def teacher_homework_add():
         ))
         conn.commit()
         conn.close()
+        invalidate_student(student_id)
         return redirect(url_for("teacher_homework_list"))
 
     conn.close()
@@ -1579,15 +4929,12 @@ def teacher_homework_add():
 
 @app.errorhandler(500)
 def internal_error_handler(error):
-    print("\n" + "="*60)
-    print("🔥 INTERNAL SERVER ERROR")
-    print("-"*60)
-    traceback.print_exc()
-    print("="*60 + "\n")
+    # стек уже записан Flask-ом (app.log_exception) — в общий лог, с request_id
     return "Произошла внутренняя ошибка сервера. Ошибка записана в лог.", 500
 
 @app.get("/teacher/students/<int:sid>/lessons")
 @teacher_login_required
+@conditional_get(lambda sid: student_version(sid), private=True)
 def teacher_student_lessons(sid):
     conn = get_db()
     conn.row_factory = sqlite3.Row
@@ -1600,20 +4947,20 @@ def teacher_student_lessons(sid):
         conn.close()
         return redirect(url_for("teacher_students"))
 
-    lessons = conn.execute(
-        """
-        SELECT * FROM student_lessons
-        WHERE student_id = ?
-        ORDER BY start_at
-        """,
-        (sid,),
-    ).fetchall()
+    # первая страница — все предстоящие и последние прошедшие,
+    # дальше (?before=) — только прошедшие, включая архив
+    before = decode_cursor(request.args.get("before"))
+    now = lesson_now()
+    upcoming = [] if before else upcoming_lessons(conn, sid, now=now)
+    history, history_next = lesson_history(conn, sid, before=before, now=now)
     conn.close()
 
     return render_template(
         "teacher_lessons.html",
         student=student,
-        lessons=lessons,
+        lessons=upcoming + history,
+        next_url=url_for("teacher_student_lessons", sid=sid, before=history_next) if history_next else None,
+        first_url=url_for("teacher_student_lessons", sid=sid) if before else None,
     )
 
 @app.route("/teacher/students/<int:sid>/lessons/add", methods=["GET", "POST"])
@@ -1652,6 +4999,7 @@ def teacher_student_lesson_add(sid):
         )
         conn.commit()
         conn.close()
+        invalidate_student(sid)
         return redirect(url_for("teacher_student_lessons", sid=sid))
 
     conn.close()
@@ -1701,6 +5049,7 @@ def teacher_lesson_edit(lid):
         )
         conn.commit()
         conn.close()
+        invalidate_student(lesson["student_id"])
         return redirect(url_for("teacher_student_lessons", sid=lesson["student_id"]))
 
     conn.close()
@@ -1804,62 +5153,290 @@ def teacher_schedule():
         weeks=weeks,
     )
 
+STUDENT_CSV_COLUMNS = [
+    ("id", "ID"),
+    ("public_code", "Публичный код"),
+    ("name", "Имя"),
+    ("course", "Курс"),
+    ("teacher_name", "Преподаватель"),
+    ("lessons_total", "Всего занятий"),
+    ("lessons_left", "Осталось занятий"),
+    ("last_payment_date", "Последняя оплата (дата)"),
+    ("last_payment_amount", "Последняя оплата (₽)"),
+    ("comment", "Комментарий"),
+]
+
+
 @app.get("/teacher/students/export")
 @teacher_login_required
 def teacher_students_export():
-    conn = get_db()
-    conn.row_factory = sqlite3.Row
-
-    rows = conn.execute("""
+    """
+    CSV со всеми учениками. date_from / date_to — по дате последней оплаты,
+    columns=public_code,name,... — какие колонки выгрузить.
+    """
+    where, params = [], []
+    if request.args.get("date_from"):
+        where.append("s.last_payment_date >= ?")
+        params.append(request.args["date_from"])
+    if request.args.get("date_to"):
+        where.append("s.last_payment_date <= ?")
+        params.append(request.args["date_to"])
+    columns = csv_columns(STUDENT_CSV_COLUMNS, request.args.get("columns"))
+
+    sql = f"""
         SELECT
-            s.*,
-            t.name AS teacher_name
+            s.id,
+            s.public_code,
+            s.name,
+            s.course,
+            t.name AS teacher_name,
+            NULLIF(s.lessons_total, 0) AS lessons_total,
+            NULLIF(s.lessons_left, 0) AS lessons_left,
+            s.last_payment_date,
+            NULLIF(s.last_payment_amount, 0) AS last_payment_amount,
+            s.comment
         FROM student_accounts AS s
         LEFT JOIN teachers AS t ON t.id = s.teacher_id
+        {"WHERE " + " AND ".join(where) if where else ""}
         ORDER BY s.name COLLATE NOCASE
-    """).fetchall()
+    """
+    return stream_csv(get_db(), sql, params, columns, f"students_{datetime.now().date()}.csv")
+
+
+# Импорт понимает заголовки экспорта (русские) и ключи колонок (name, course, ...),
+# так что выгрузку можно поправить в Excel и залить обратно. ID и публичный код
+# из файла игнорируются — новым ученикам коды выдаются заново.
+STUDENT_IMPORT_HEADERS = {
+    **{title.lower(): key for key, title in STUDENT_CSV_COLUMNS},
+    **{key: key for key, _ in STUDENT_CSV_COLUMNS},
+    "teacher": "teacher_name",
+    "teacher_id": "teacher_name",
+}
+STUDENT_IMPORT_INT_FIELDS = ("lessons_total", "lessons_left", "last_payment_amount")
+STUDENT_IMPORT_MAX_ROWS = 5000
+STUDENT_IMPORT_INT_MAX = 10**9  # больше — явно опечатка, да и в INTEGER SQLite не влезет
+
+
+def read_student_sheet(filename, data):
+    """
+    Строки таблицы учеников из CSV (разделитель ; , или таб, UTF-8 или
+    cp1251 — как сохраняет Excel) или XLSX (первый лист). Возвращает
+    [(номер строки в файле, {ключ: значение}), ...]; пустые строки пропускаются.
+    """
+    if filename.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValueError("openpyxl не установлен — сохраните таблицу как CSV")
+        try:
+            wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        except Exception:
+            raise ValueError("не получилось открыть XLSX")
+        rows = list(wb.worksheets[0].iter_rows(values_only=True))
+        wb.close()
+    else:
+        try:
+            text = data.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = data.decode("cp1251")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=";,\t")
+        except csv.Error:
+            dialect = "excel"
+        rows = list(csv.reader(io.StringIO(text), dialect))
+
+    if not rows:
+        raise ValueError("файл пустой")
+    header = [
+        STUDENT_IMPORT_HEADERS.get(str(h or "").strip().lower())
+        for h in rows[0]
+    ]
+    if "name" not in header:
+        raise ValueError("нет колонки «Имя» (или name)")
+
+    result = []
+    for line, values in enumerate(rows[1:], start=2):
+        record = {
+            key: value
+            for key, value in zip(header, values)
+            if key and key not in ("id", "public_code")
+        }
+        if all(v is None or str(v).strip() == "" for v in record.values()):
+            continue
+        result.append((line, record))
+    if len(result) > STUDENT_IMPORT_MAX_ROWS:
+        raise ValueError(f"больше {STUDENT_IMPORT_MAX_ROWS} строк — разбейте файл")
+    return result
+
+
+def _import_date(value):
+    """datetime из XLSX, ГГГГ-ММ-ДД или ДД.ММ.ГГГГ → ГГГГ-ММ-ДД."""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    value = str(value).strip()
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"дата «{value}» не в формате ГГГГ-ММ-ДД")
+
+
+def _import_int(value, title):
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        text = str(value).replace("\xa0", "").replace(" ", "").replace(",", ".")
+        try:
+            number = float(text)
+        except ValueError:
+            raise ValueError(f"{title}: «{value}» — не число")
+    # nan и inf float() пропускает, а int() на них падает
+    if isinstance(number, float) and math.isnan(number):
+        raise ValueError(f"{title}: «{value}» — не число")
+    if number > STUDENT_IMPORT_INT_MAX:
+        raise ValueError(f"{title}: слишком большое число")
+    if number < 0 or number != int(number):
+        raise ValueError(f"{title}: ожидается целое неотрицательное число")
+    return int(number)
+
+
+def validate_student_rows(conn, rows):
+    """
+    Проверяет строки из read_student_sheet. Возвращает (students, errors):
+    students — dict'ы с готовыми к INSERT значениями (+ line и teacher_name),
+    errors — [(номер строки, текст), ...].
+    """
+    teachers = conn.execute("SELECT id, name FROM teachers").fetchall()
+    by_id = {t["id"]: t["name"] for t in teachers}
+    by_name = {}
+    for t in teachers:
+        by_name.setdefault((t["name"] or "").strip().lower(), []).append(t["id"])
+    titles = dict(STUDENT_CSV_COLUMNS)
+
+    students, errors = [], []
+    for line, record in rows:
+        clean = {k: ("" if v is None else v) for k, v in record.items()}
+        text = {k: str(v).strip() for k, v in clean.items()}
+        row_errors = []
+        student = {
+            "line": line,
+            "name": text.get("name") or None,
+            "course": text.get("course") or None,
+            "comment": text.get("comment") or None,
+            "last_payment_date": None,
+            "teacher_id": None,
+            "teacher_name": None,
+        }
+        if not student["name"]:
+            row_errors.append("не указано имя")
+
+        for key in STUDENT_IMPORT_INT_FIELDS:
+            student[key] = None
+            if text.get(key):
+                try:
+                    student[key] = _import_int(clean[key], titles[key])
+                except ValueError as e:
+                    row_errors.append(str(e))
+        if (
+            student["lessons_total"] is not None
+            and student["lessons_left"] is not None
+            and student["lessons_left"] > student["lessons_total"]
+        ):
+            row_errors.append("осталось занятий больше, чем всего")
+
+        if text.get("last_payment_date"):
+            try:
+                student["last_payment_date"] = _import_date(clean["last_payment_date"])
+            except ValueError as e:
+                row_errors.append(str(e))
+
+        teacher = text.get("teacher_name")
+        if teacher:
+            ids = [int(teacher)] if teacher.isdigit() and int(teacher) in by_id \
+                else by_name.get(teacher.lower(), [])
+            if not ids:
+                row_errors.append(f"преподаватель «{teacher}» не найден")
+            elif len(ids) > 1:
+                row_errors.append(f"преподавателей «{teacher}» несколько — укажите ID")
+            else:
+                student["teacher_id"] = ids[0]
+                student["teacher_name"] = by_id[ids[0]]
+
+        if row_errors:
+            errors.extend((line, msg) for msg in row_errors)
+        else:
+            students.append(student)
+    return students, errors
+
+
+def import_students(conn, rows, dry_run=False):
+    """
+    Всё или ничего: если хоть одна строка с ошибкой — не вставляется ничего.
+    Иначе коды выдаются одним проходом и все ученики пишутся одним
+    executemany в одной транзакции: сдвиг счётчика кодов и вставка
+    коммитятся или откатываются вместе.
+    Возвращает (students, errors); при успешном импорте у students есть public_code.
+    """
+    students, errors = validate_student_rows(conn, rows)
+    if errors or dry_run or not students:
+        return students, errors
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        codes = allocate_student_codes(conn, len(students))
+        for student, code in zip(students, codes):
+            student["public_code"] = code
+        conn.executemany(
+            """
+            INSERT INTO student_accounts (
+                public_code, name, course, last_payment_date, last_payment_amount,
+                lessons_total, lessons_left, comment, teacher_id
+            )
+            VALUES (
+                :public_code, :name, :course, :last_payment_date, :last_payment_amount,
+                :lessons_total, :lessons_left, :comment, :teacher_id
+            )
+            """,
+            students,
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    log.info("students imported", extra={"count": len(students)})
+    return students, errors
 
-    conn.close()
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-
-    writer.writerow([
-        "ID",
-        "Публичный код",
-        "Имя",
-        "Курс",
-        "Преподаватель",
-        "Всего занятий",
-        "Осталось занятий",
-        "Последняя оплата (дата)",
-        "Последняя оплата (₽)",
-        "Комментарий",
-    ])
-
-    for r in rows:
-        writer.writerow([
-            r["id"],
-            r["public_code"] or "",
-            r["name"] or "",
-            r["course"] or "",
-            r["teacher_name"] or "",
-            r["lessons_total"] or "",
-            r["lessons_left"] or "",
-            r["last_payment_date"] or "",
-            r["last_payment_amount"] or "",
-            r["comment"] or "",
-        ])
-
-    data = output.getvalue().encode("utf-8-sig")  # BOM, чтобы Excel нормально понял UTF-8
-    buf = io.BytesIO(data)
-    buf.seek(0)
-
-    return send_file(
-        buf,
-        mimetype="text/csv; charset=utf-8",
-        as_attachment=True,
-        download_name=f"students_{datetime.now().date()}.csv",
+@app.route("/teacher/students/import", methods=["GET", "POST"])
+@teacher_login_required
+def teacher_students_import():
+    """
+    Загрузка таблицы учеников (CSV/XLSX). «Только проверить» — разбор
+    и проверка без записи в базу.
+    """
+    context = {"dry_run": True, "students": None, "errors": [], "filename": None}
+    if request.method == "POST":
+        upload = request.files.get("file")
+        context["dry_run"] = bool(request.form.get("dry_run"))
+        if not upload or not upload.filename:
+            context["errors"] = [(None, "выберите файл")]
+        else:
+            context["filename"] = upload.filename
+            conn = get_db()
+            try:
+                rows = read_student_sheet(upload.filename, upload.read())
+                context["students"], context["errors"] = import_students(
+                    conn, rows, dry_run=context["dry_run"]
+                )
+            except ValueError as e:
+                context["errors"] = [(None, str(e))]
+            conn.close()
+    conn = get_db()
+    context["code_usage"] = student_code_usage(conn)
+    conn.close()
+    return render_template(
+        "teacher_students_import.html",
+        xlsx_supported=openpyxl is not None,
+        **context,
     )
 
 
@@ -1879,10 +5456,184 @@ def teacher_lesson_delete(lid):
     conn.execute("DELETE FROM student_lessons WHERE id = ?", (lid,))
     conn.commit()
     conn.close()
+    invalidate_student(sid)
     return redirect(url_for("teacher_student_lessons", sid=sid))
 
 
+# ================== КОМАНДЫ ==================
+
+@app.cli.command("rebuild-images")
+def rebuild_images_command():
+    """Пересобрать варианты всех загруженных фото: flask --app app rebuild-images"""
+    if Image is None:
+        print("Pillow не установлен — варианты не собрать")
+        return
+    conn = get_db()
+    for folder, table in IMAGE_TABLES.items():
+        rows = conn.execute(f"SELECT id, photo FROM {table} WHERE photo IS NOT NULL").fetchall()
+        for r in rows:
+            if not os.path.exists(os.path.join(folder, r["photo"])):
+                print(f"[!] {table}#{r['id']}: нет файла {r['photo']}")
+                continue
+            if strip_image_metadata(os.path.join(folder, r["photo"])):
+                print(f"[~] {table}#{r['id']}: из оригинала убраны метаданные")
+            variants = build_image_variants(folder, r["photo"])
+            conn.execute(
+                f"UPDATE {table} SET photo_variants = ? WHERE id = ?",
+                (json.dumps(variants), r["id"]),
+            )
+            print(f"[✔] {table}#{r['id']}: {', '.join(variants)}")
+    conn.commit()
+    conn.close()
+    bump_content_version()
+
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics_command():
+    """Пересчитать сводки аналитики из заявок и отзывов: flask --app app rebuild-analytics"""
+    conn = get_db()
+    rebuild_analytics(conn.cursor())
+    conn.commit()
+    days = conn.execute("SELECT COUNT(DISTINCT day) FROM enroll_daily").fetchone()[0]
+    packages = conn.execute("SELECT COUNT(DISTINCT package) FROM review_ratings").fetchone()[0]
+    conn.close()
+    print(f"Готово: дней с заявками {days}, пакетов с отзывами {packages}")
+
+
+@app.cli.command("student-stats")
+@click.option("--rebuild", is_flag=True, help="пересчитать student_stats с нуля")
+def student_stats_command(rebuild):
+    """Сверить счётчики учеников с уроками и домашками: flask --app app student-stats [--rebuild]"""
+    conn = get_db()
+    fields = ["lessons_done", "lessons_planned", "next_lesson_at", "hw_new", "hw_assigned"]
+    mismatches = conn.execute(f"""
+        SELECT e.student_id, {", ".join(f"e.{f} AS exp_{f}, st.{f} AS got_{f}" for f in fields)}
+        FROM ({STUDENT_STATS_SQL}) e
+        LEFT JOIN student_stats st ON st.student_id = e.student_id
+        WHERE st.student_id IS NULL
+           OR {" OR ".join(f"e.{f} IS NOT st.{f}" for f in fields)}
+    """).fetchall()
+
+    for r in mismatches[:20]:
+        diff = ", ".join(
+            f"{f}: {r['got_' + f]} → {r['exp_' + f]}"
+            for f in fields if r["got_" + f] != r["exp_" + f]
+        )
+        print(f"[!] ученик #{r['student_id']}: {diff}")
+    if len(mismatches) > 20:
+        print(f"... и ещё {len(mismatches) - 20}")
+    archived = conn.execute("""
+        SELECT COUNT(*) FROM student_stats st
+        WHERE st.lessons_archived IS NOT (
+            SELECT COUNT(*) FROM student_lessons_archive a
+            WHERE a.student_id = st.student_id AND a.status = 'done'
+        )
+    """).fetchone()[0]
+    if archived:
+        print(f"[!] lessons_archived не сходится с архивом у {archived} учеников")
+
+    if rebuild:
+        cur = conn.cursor()
+        rebuild_student_stats(cur)
+        rebuild_archive_stats(cur)
+        conn.commit()
+        print("student_stats пересчитана")
+    elif mismatches or archived:
+        print(f"Расхождений: {len(mismatches) + archived}. Починить: flask --app app student-stats --rebuild")
+    else:
+        print("Счётчики сходятся")
+    conn.close()
+
+
+@app.cli.command("archive-lessons")
+@click.option("--days", type=int, default=LESSON_ARCHIVE_DAYS, show_default=True,
+              help="переносить прошедшие занятия старше стольких дней")
+def archive_lessons_command(days):
+    """Перенести давно прошедшие занятия в архив: flask --app app archive-lessons [--days 180]"""
+    conn = get_db()
+    moved, students = archive_lessons(conn, older_than_days=days)
+    conn.close()
+    print(f"В архив перенесено занятий: {moved}, учеников: {students}")
+
+
+@app.cli.command("prune-tombstones")
+@click.option("--days", type=int, default=TOMBSTONE_KEEP_DAYS, show_default=True,
+              help="хранить записи об удалениях столько дней")
+def prune_tombstones_command(days):
+    """Вычистить старые записи об удалениях (для дельт): flask --app app prune-tombstones [--days 30]"""
+    conn = get_db()
+    removed = prune_tombstones(conn, keep_days=days)
+    conn.close()
+    for table, n in removed.items():
+        print(f"{table}: удалено {n}")
+
+
+@app.cli.command("import-students")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="только проверить, ничего не записывать")
+def import_students_command(path, dry_run):
+    """Завести учеников из CSV/XLSX: flask --app app import-students students.xlsx [--dry-run]"""
+    with open(path, "rb") as f:
+        data = f.read()
+    conn = get_db()
+    try:
+        students, errors = import_students(
+            conn, read_student_sheet(path, data), dry_run=dry_run
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        conn.close()
+
+    for line, msg in errors:
+        print(f"[!] строка {line}: {msg}")
+    if errors:
+        raise click.ClickException(f"ошибок: {len(errors)}, ничего не импортировано")
+    if dry_run:
+        print(f"Проверено: {len(students)} учеников, ошибок нет")
+        return
+    for s in students:
+        print(f"{s['public_code']}  {s['name']}")
+    print(f"Импортировано: {len(students)}")
+
+
+@app.cli.command("student-codes")
+def student_codes_command():
+    """Заполненность пространства кодов учеников: flask --app app student-codes"""
+    conn = get_db()
+    usage = student_code_usage(conn)
+    conn.close()
+    print(
+        f"Выдано кодов: {usage['issued']} из {usage['space']} ({usage['used_pct']}%), "
+        f"осталось {usage['left']}, у учеников сейчас {usage['active']}"
+    )
+
+
+@app.cli.command("outbox-dispatch")
+def outbox_dispatch_command():
+    """Разослать накопившиеся уведомления один раз: flask --app app outbox-dispatch"""
+    total = 0
+    while True:
+        sent = dispatch_outbox()
+        if not sent:
+            break
+        total += sent
+    print(f"Отправлено уведомлений: {total}")
+
+
+@app.cli.command("build-static")
+def build_static_command():
+    """Пересжать статику (.gz/.br) перед деплоем: flask --app app build-static"""
+    manifest = build_static_manifest(force=True)
+    for rel, hashed in sorted(manifest.items()):
+        print(f"{rel} -> {hashed}")
+    if brotli is None:
+        print("[!] brotli не установлен — собраны только .gz")
+
+
 # ================== DEV-запуск ==================
 
 if __name__ == "__main__":
+    # в разработке CSS правится на лету — без хэшей и вечного кэша
+    app.config["STATIC_FINGERPRINT"] = False
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк настоящих роутов Flask через test client.
+
+Для каждого endpoint-а меряет p50/p95 задержки, число SQL-запросов на
+HTTP-запрос (из SQL-статистики app.py) и пик памяти Python (tracemalloc).
+Результат пишется в JSON; с --compare сравнивает с прошлым прогоном и
+возвращает код 1, если p95 вырос больше допустимого.
+
+    python gen_synthetic_db.py --db /tmp/soul_bench.db
+    python bench_routes.py --db /tmp/soul_bench.db --out bench_before.json
+    python bench_routes.py --db /tmp/soul_bench.db --compare bench_before.json
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def build_targets(db_path):
+    """Какие URL дёргаем. Параметры берём из самой базы."""
+    conn = sqlite3.connect(db_path)
+    teacher = conn.execute(
+        "SELECT teacher_id FROM student_accounts WHERE teacher_id IS NOT NULL "
+        "GROUP BY teacher_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    # самый «тяжёлый» ученик — с наибольшим числом уроков
+    student = conn.execute(
+        "SELECT s.public_code FROM student_lessons l "
+        "JOIN student_accounts s ON s.id = l.student_id "
+        "GROUP BY l.student_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    conn.close()
+
+    month = datetime.utcnow().strftime("%Y-%m")
+    targets = {
+        "index": "/",
+        "admin_enrolls": "/admin/enrolls",
+        "admin_reviews": "/admin/reviews",
+        "teacher_students": "/teacher/students",
+        "teacher_homework_list": "/teacher/homework",
+    }
+    if teacher:
+        targets["teacher_schedule"] = f"/teacher/schedule?teacher_id={teacher[0]}&month={month}"
+    if student:
+        targets["student_dashboard"] = f"/student?code={student[0]}"
+    return targets
+
+
+def run(args):
+    os.environ["SOUL_DB_PATH"] = os.path.abspath(args.db)
+    os.environ.setdefault("FLASK_SECRET_KEY", "bench")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as soul
+
+    soul.app.config["DB_POOL"] = not args.no_pool
+    soul.app.config["SQL_STATS"] = True
+    soul.app.config["SQL_SLOW_MS"] = float("inf")  # в бенчмарке лог не нужен
+
+    client = soul.app.test_client()
+    with client.session_transaction() as sess:
+        sess["admin_logged_in"] = True
+
+    targets = build_targets(args.db)
+    if args.only:
+        targets = {k: v for k, v in targets.items() if k in args.only}
+
+    results = {}
+    for name, url in targets.items():
+        for _ in range(args.warmup):
+            client.get(url)
+
+        with soul._sql_stats_lock:
+            soul._sql_stats.clear()
+
+        timings = []
+        status = None
+        for _ in range(args.requests):
+            t0 = time.perf_counter()
+            resp = client.get(url)
+            timings.append((time.perf_counter() - t0) * 1000)
+            status = resp.status_code
+            size = len(resp.data)
+
+        stats = {ep["endpoint"]: ep for ep in soul.sql_stats_snapshot()}.get(name)
+        queries = stats["queries"] / stats["requests"] if stats and stats["requests"] else 0
+
+        # память меряем отдельным запросом: tracemalloc сильно замедляет код
+        tracemalloc.start()
+        client.get(url)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[name] = {
+            "url": url,
+            "status": status,
+            "bytes": size,
+            "requests": args.requests,
+            "p50_ms": round(percentile(timings, 50), 3),
+            "p95_ms": round(percentile(timings, 95), 3),
+            "mean_ms": round(statistics.fmean(timings), 3),
+            "queries_per_request": round(queries, 2),
+            "peak_mem_kb": round(peak / 1024, 1),
+        }
+        r = results[name]
+        print(f"{name:>22}: p50 {r['p50_ms']:9.2f} мс  p95 {r['p95_ms']:9.2f} мс  "
+              f"SQL/запрос {r['queries_per_request']:5.1f}  пик {r['peak_mem_kb']:9.1f} КБ  "
+              f"[{status}, {size} Б]")
+
+    conn = sqlite3.connect(args.db)
+    scale = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("enrolls", "reviews", "student_accounts", "student_lessons", "student_homework")
+    }
+    conn.close()
+
+    return {
+        "meta": {
+            "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "db": os.path.abspath(args.db),
+            "scale": scale,
+            "db_pool": soul.app.config["DB_POOL"],
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "endpoints": results,
+    }
+
+
+def compare(current, baseline_path, max_regression):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    failed = []
+    print(f"\nСравнение с {baseline_path} (допустимо ×{max_regression} по p95):")
+    for name, cur in current["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            print(f"{name:>22}: нет в базовом прогоне")
+            continue
+        ratio = cur["p95_ms"] / base["p95_ms"] if base["p95_ms"] else 1.0
+        mark = "OK"
+        if ratio > max_regression:
+            mark = "РЕГРЕССИЯ"
+            failed.append(name)
+        print(f"{name:>22}: p95 {base['p95_ms']:.2f} → {cur['p95_ms']:.2f} мс (×{ratio:.2f}), "
+              f"SQL {base['queries_per_request']} → {cur['queries_per_request']}  {mark}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк роутов Soul")
+    parser.add_argument("--db", required=True, help="база, например из gen_synthetic_db.py")
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--only", nargs="*", help="только эти endpoint-ы")
+    parser.add_argument("--no-pool", action="store_true", help="DB_POOL=0: новый connect на каждый get_db()")
+    parser.add_argument("--out", help="куда сохранить JSON с результатами")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=1.25)
+    args = parser.parse_args()
+
+    result = run(args)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.out}")
+
+    if args.compare:
+        failed = compare(result, args.compare, args.max_regression)
+        if failed:
+            print(f"\nРегрессия p95: {', '.join(failed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Сборка урезанных CSS-бандлов под реальные шаблоны.
+
+Смотрит, какие классы и id встречаются в templates/*.html (атрибуты
+class/id, строки во встроенных <script> и в выражениях Jinja), выкидывает
+из исходных таблиц стилей правила, которые не могут ничего выбрать, и
+пишет минифицированные бандлы в static/dist/<бандл>.min.css.
+
+Шаблоны подключают бандл через css_bundle() из app.py; пока бандла нет,
+подключается исходный файл целиком.
+
+    python build_css.py            # собрать и показать экономию
+    python build_css.py --check    # только проверить, что бандлы свежие
+
+Если класс/id, который есть в шаблоне и в исходном CSS, пропал из
+бандла — скрипт падает с кодом 1 и списком потерянных селекторов.
+"""
+import argparse
+import fnmatch
+import gzip
+import os
+import re
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+
+# бандл -> исходные таблицы стилей и страницы, которые его подключают
+BUNDLES = {
+    "public": {
+        "sources": ["style_light.css"],
+        "pages": ["index.html", "teacher_login.html"],
+    },
+    "student": {
+        "sources": ["style_light.css"],
+        "pages": ["student_dashboard.html"],
+    },
+    "admin": {
+        "sources": ["style.css"],
+        "pages": ["admin_*.html", "teacher_*.html", "thank_you.html"],
+        "exclude": ["teacher_login.html"],
+    },
+}
+
+# классы, которые собираются в JS по кусочкам и текстом в шаблоне не встречаются
+SAFELIST = {
+    "active", "visible", "collapsed", "expanded", "hovered",
+    "modal-open", "nav-open", "header-visible", "header-scrolled",
+}
+
+# at-правила, внутри которых обычные правила — чистим рекурсивно
+NESTED_AT_RULES = {"media", "supports", "layer", "container", "document"}
+
+TOKEN_RE = re.compile(r"-?[A-Za-z_][\w-]*")
+ATTR_RE = re.compile(r"""\b(?:class|id)\s*=\s*(?:"([^"]*)"|'([^']*)')""", re.S)
+SCRIPT_RE = re.compile(r"<script\b[^>]*>(.*?)</script>", re.S | re.I)
+JINJA_RE = re.compile(r"\{\{.*?\}\}|\{%.*?%\}", re.S)
+STRING_RE = re.compile(r""""(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`(?:\\.|[^`\\])*`""", re.S)
+EXTENDS_RE = re.compile(r"""\{%-?\s*(?:extends|include)\s+["']([^"']+)["']""")
+
+
+# ---------- шаблоны ----------
+
+def expand_pages(patterns, exclude=()):
+    names = sorted(os.listdir(TEMPLATES_DIR))
+    pages = []
+    for pattern in patterns:
+        for name in names:
+            if fnmatch.fnmatch(name, pattern) and name not in exclude and name not in pages:
+                pages.append(name)
+    return pages
+
+
+def template_closure(name, seen=None):
+    """Шаблон плюс всё, что он extends/include."""
+    seen = seen if seen is not None else []
+    if name in seen:
+        return seen
+    path = os.path.join(TEMPLATES_DIR, name)
+    if not os.path.exists(path):  # {% include ... ignore missing %}
+        return seen
+    seen.append(name)
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    for parent in EXTENDS_RE.findall(text):
+        template_closure(parent, seen)
+    return seen
+
+
+def used_names(template_names):
+    """Множество имён, которые могут оказаться классом или id на странице."""
+    used = set(SAFELIST)
+    for name in template_names:
+        with open(os.path.join(TEMPLATES_DIR, name), encoding="utf-8") as f:
+            text = f.read()
+        for m in ATTR_RE.finditer(text):
+            used.update(TOKEN_RE.findall(m.group(1) or m.group(2) or ""))
+        for block in SCRIPT_RE.findall(text):
+            for literal in STRING_RE.findall(block):
+                used.update(TOKEN_RE.findall(literal))
+        for expr in JINJA_RE.findall(text):
+            for literal in STRING_RE.findall(expr):
+                used.update(TOKEN_RE.findall(literal))
+    return used
+
+
+# ---------- разбор CSS ----------
+
+def strip_comments(css):
+    out, i, n = [], 0, len(css)
+    while i < n:
+        c = css[i]
+        if c in "\"'":
+            j = i + 1
+            while j < n and css[j] != c:
+                j += 2 if css[j] == "\\" else 1
+            out.append(css[i:j + 1])
+            i = j + 1
+        elif css.startswith("/*", i):
+            end = css.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+def _scan_until(css, i, stops):
+    """Индекс первого символа из stops вне строк и скобок."""
+    depth, n = 0, len(css)
+    while i < n:
+        c = css[i]
+        if c in "\"'":
+            i += 1
+            while i < n and css[i] != c:
+                i += 2 if css[i] == "\\" else 1
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif depth == 0 and c in stops:
+            return i
+        i += 1
+    return n
+
+
+def _matching_brace(css, i):
+    """css[i] == '{' -> индекс парной '}'."""
+    depth, n = 0, len(css)
+    while i < n:
+        c = css[i]
+        if c in "\"'":
+            i += 1
+            while i < n and css[i] != c:
+                i += 2 if css[i] == "\\" else 1
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise ValueError("незакрытая фигурная скобка в CSS")
+
+
+def parse(css):
+    """
+    Список узлов:
+      ("rule", селектор, тело)
+      ("block", прелюдия @-правила, [узлы])  — @media и т.п.
+      ("raw", прелюдия, тело)               — @keyframes, @font-face
+      ("stmt", текст)                       — @import, @charset
+    """
+    nodes, i, n = [], 0, len(css)
+    while i < n:
+        while i < n and css[i].isspace():
+            i += 1
+        if i >= n:
+            break
+        stop = _scan_until(css, i, "{;}")
+        if stop >= n:
+            break
+        head = css[i:stop].strip()
+        if css[stop] == "}":      # мусорная закрывающая скобка — пропускаем
+            i = stop + 1
+            continue
+        if css[stop] == ";":
+            if head:
+                nodes.append(("stmt", head))
+            i = stop + 1
+            continue
+        end = _matching_brace(css, stop)
+        body = css[stop + 1:end]
+        if head.startswith("@"):
+            at_name = head[1:].split(None, 1)[0].split("(")[0].lower()
+            if at_name in NESTED_AT_RULES:
+                nodes.append(("block", head, parse(body)))
+            else:
+                nodes.append(("raw", head, body))
+        else:
+            nodes.append(("rule", head, body))
+        i = end + 1
+    return nodes
+
+
+# ---------- отбор селекторов ----------
+
+SELECTOR_NOISE_RE = re.compile(r"\[[^\]]*\]|:not\((?:[^()]|\([^()]*\))*\)")
+SELECTOR_NAME_RE = re.compile(r"[.#](-?[A-Za-z_][\w-]*)")
+
+
+def split_selectors(selector_text):
+    parts, i, start, n = [], 0, 0, len(selector_text)
+    while i < n:
+        i = _scan_until(selector_text, i, ",")
+        parts.append(selector_text[start:i].strip())
+        i += 1
+        start = i
+    return [p for p in parts if p]
+
+
+def selector_names(selector):
+    # :not(.x) и [class*=...] не требуют, чтобы .x был на странице
+    return SELECTOR_NAME_RE.findall(SELECTOR_NOISE_RE.sub("", selector))
+
+
+def selector_alive(selector, used):
+    return all(name in used for name in selector_names(selector))
+
+
+def prune(nodes, used):
+    out = []
+    for node in nodes:
+        kind = node[0]
+        if kind == "rule":
+            kept = [s for s in split_selectors(node[1]) if selector_alive(s, used)]
+            if kept:
+                out.append(("rule", ",".join(kept), node[2]))
+        elif kind == "block":
+            children = prune(node[2], used)
+            if children:
+                out.append(("block", node[1], children))
+        else:
+            out.append(node)
+    return out
+
+
+def alive_names(nodes, used, acc=None):
+    """Имена из селекторов, которые обязаны дожить до бандла."""
+    acc = acc if acc is not None else set()
+    for node in nodes:
+        if node[0] == "rule":
+            for s in split_selectors(node[1]):
+                if selector_alive(s, used):
+                    acc.update(selector_names(s))
+        elif node[0] == "block":
+            alive_names(node[2], used, acc)
+    return acc
+
+
+# ---------- минификация ----------
+
+def _collapse(text, tight):
+    """Сжимает пробелы вне строк; вокруг символов из tight убирает совсем."""
+    out, i, n = [], 0, len(text)
+    while i < n:
+        c = text[i]
+        if c in "\"'":
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+            continue
+        if c.isspace():
+            while i < n and text[i].isspace():
+                i += 1
+            prev = out[-1][-1] if out and out[-1] else ""
+            nxt = text[i] if i < n else ""
+            if prev and nxt and prev not in tight and nxt not in tight:
+                out.append(" ")
+            continue
+        out.append(c)
+        i += 1
+    return "".join(out)
+
+
+def minify_body(body):
+    body = _collapse(body, "{};:,")
+    body = body.replace(";}", "}").rstrip(";")
+    return body
+
+
+def minify_selector(selector):
+    return _collapse(selector, ",>+~")
+
+
+def serialize(nodes):
+    out = []
+    for node in nodes:
+        kind = node[0]
+        if kind == "rule":
+            out.append(f"{minify_selector(node[1])}{{{minify_body(node[2])}}}")
+        elif kind == "block":
+            out.append(f"{_collapse(node[1], ',')}{{{serialize(node[2])}}}")
+        elif kind == "raw":
+            out.append(f"{_collapse(node[1], ',')}{{{minify_body(node[2])}}}")
+        else:
+            out.append(f"{_collapse(node[1], ',')};")
+    return "".join(out)
+
+
+def names_in_css(css):
+    names = set()
+    for node_selectors in _all_selectors(parse(css)):
+        for s in split_selectors(node_selectors):
+            names.update(selector_names(s))
+    return names
+
+
+def _all_selectors(nodes):
+    for node in nodes:
+        if node[0] == "rule":
+            yield node[1]
+        elif node[0] == "block":
+            yield from _all_selectors(node[2])
+
+
+# ---------- сборка ----------
+
+def build_bundle(name, config):
+    pages = expand_pages(config["pages"], config.get("exclude", ()))
+    templates = []
+    for page in pages:
+        template_closure(page, templates)
+    used = used_names(templates)
+
+    source_css = ""
+    for src in config["sources"]:
+        with open(os.path.join(STATIC_DIR, src), encoding="utf-8") as f:
+            source_css += f.read() + "\n"
+
+    nodes = parse(strip_comments(source_css))
+    result = serialize(prune(nodes, used))
+
+    # контроль: всё, что используется и было в исходнике, должно остаться
+    lost = sorted(alive_names(nodes, used) - names_in_css(result))
+    return {
+        "name": name,
+        "pages": pages,
+        "css": result,
+        "source_bytes": len(source_css.encode("utf-8")),
+        "bytes": len(result.encode("utf-8")),
+        "gzip_source": len(gzip.compress(source_css.encode("utf-8"), 9)),
+        "gzip_bytes": len(gzip.compress(result.encode("utf-8"), 9)),
+        "lost": lost,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Урезанные CSS-бандлы под шаблоны")
+    parser.add_argument("--check", action="store_true",
+                        help="не писать файлы, упасть, если бандлы устарели")
+    args = parser.parse_args()
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    failed = False
+    for name, config in BUNDLES.items():
+        bundle = build_bundle(name, config)
+        path = os.path.join(DIST_DIR, f"{name}.min.css")
+
+        if bundle["lost"]:
+            failed = True
+            print(f"[!] {name}: из бандла пропали используемые селекторы: "
+                  f"{', '.join(bundle['lost'])}")
+            continue
+
+        if args.check:
+            current = open(path, encoding="utf-8").read() if os.path.exists(path) else None
+            if current != bundle["css"]:
+                failed = True
+                print(f"[!] {name}: static/dist/{name}.min.css устарел — запустите build_css.py")
+            continue
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(bundle["css"])
+
+        saved = 100 - bundle["bytes"] * 100 / bundle["source_bytes"]
+        print(f"[✔] {name}.min.css ({len(bundle['pages'])} стр.): "
+              f"{bundle['source_bytes']} → {bundle['bytes']} Б (−{saved:.0f}%), "
+              f"gzip {bundle['gzip_source']} → {bundle['gzip_bytes']} Б")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Генератор синтетической базы для нагрузочных тестов.
+
+Создаёт отдельный файл БД (боевой soul.db не трогает), прогоняет на нём
+миграции из app.py и заливает заявки, отзывы, учеников, уроки и домашки
+в нужном масштабе.
+
+    python gen_synthetic_db.py --db /tmp/soul_bench.db \
+        --enrolls 100000 --students 10000 --lessons 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+FIRST_NAMES = [
+    "Анна", "Мария", "Екатерина", "Алина", "Дарья", "Полина", "Софья",
+    "Виктория", "Ксения", "Елизавета", "Иван", "Алексей", "Дмитрий",
+    "Максим", "Артём", "Никита", "Егор", "Кирилл", "Михаил", "Сергей",
+]
+LAST_NAMES = [
+    "Иванова", "Смирнова", "Кузнецова", "Попова", "Ким", "Пак", "Ли",
+    "Соколов", "Лебедев", "Новиков", "Морозов", "Волков", "Зайцев",
+]
+COURSES = [
+    ("Корейский с нуля", 6400, 8),
+    ("Разговорный клуб", 4800, 8),
+    ("Подготовка к TOPIK", 9600, 12),
+    ("Индивидуальные занятия", 12000, 8),
+]
+LEVELS = ["Никогда не изучал(а)", "Знаю алфавит", "Могу поддержать простой диалог"]
+TEACHERS = [
+    ("Ли Минджи", "Преподаватель корейского"),
+    ("Ким Соён", "Носитель языка"),
+    ("Анна Пак", "Методист, TOPIK II"),
+    ("Юна Чхве", "Разговорный клуб"),
+    ("Дарья Ли", "Преподаватель корейского"),
+    ("Пак Джихун", "Носитель языка"),
+]
+COMMENTS = [
+    "", "", "", "Хочу заниматься по вечерам", "Удобно только по выходным",
+    "Готовлюсь к поездке в Сеул", "Смотрю дорамы, хочу понимать без субтитров",
+    "Нужен TOPIK к лету", "Перезвоните, пожалуйста",
+]
+REVIEW_TEXTS = [
+    "Очень понравились занятия, всё понятно объясняют.",
+    "За три месяца начала читать и понимать простые фразы!",
+    "Удобное расписание, дружелюбные преподаватели.",
+    "Домашки иногда большие, но результат того стоит.",
+    "Рекомендую всем, кто начинает с нуля.",
+]
+TOPICS = [
+    "Хангыль: гласные", "Хангыль: согласные", "Числа", "Знакомство",
+    "Падежные частицы", "Прошедшее время", "Вежливый стиль", "Аудирование",
+]
+
+BATCH = 10000
+
+
+def person():
+    return f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}"
+
+
+def contact():
+    if random.random() < 0.6:
+        return f"@user{random.randint(1000, 9999999)}"
+    return f"+79{random.randint(100000000, 999999999)}"
+
+
+def ts(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def random_moment(start, end):
+    return start + timedelta(seconds=random.randint(0, int((end - start).total_seconds())))
+
+
+def batched(rows, size=BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert(conn, sql, rows):
+    total = 0
+    for batch in batched(rows):
+        conn.executemany(sql, batch)
+        total += len(batch)
+    return total
+
+
+def gen_enrolls(n, start, end):
+    ips = [f"10.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(1, 254)}"
+           for _ in range(max(1, n // 3))]
+    for _ in range(n):
+        yield (
+            random.choice(ips),
+            person(),
+            contact(),
+            random.choice(COURSES)[0],
+            random.choice(LEVELS),
+            random.choice(COMMENTS) or None,
+            ts(random_moment(start, end)),
+            1 if random.random() < 0.05 else 0,
+            "спам" if random.random() < 0.02 else None,
+        )
+
+
+def gen_reviews(n, start, end):
+    for _ in range(n):
+        yield (
+            random.choice(FIRST_NAMES),
+            random.choice(COURSES)[0],
+            random.choices([5, 4, 3, 2, 1], weights=[60, 25, 8, 4, 3])[0],
+            random.choice(REVIEW_TEXTS),
+            1 if random.random() < 0.7 else 0,
+            ts(random_moment(start, end)),
+        )
+
+
+def gen_students(n, teacher_ids):
+    codes = random.sample(range(1_000_000), n)
+    for code in codes:
+        course, price, lessons = random.choice(COURSES)
+        yield (
+            f"{code:06d}",
+            person(),
+            course,
+            (datetime.utcnow() - timedelta(days=random.randint(0, 60))).strftime("%Y-%m-%d"),
+            price,
+            lessons,
+            random.randint(0, lessons),
+            random.choice(teacher_ids),
+        )
+
+
+def gen_lessons(n, student_ids, now):
+    # у «старых» учеников уроков больше — распределение с длинным хвостом
+    weights = [random.paretovariate(1.5) for _ in student_ids]
+    picks = random.choices(student_ids, weights=weights, k=n)
+    for sid in picks:
+        start = now + timedelta(days=random.randint(-730, 60), hours=random.randint(9, 21))
+        if start > now:
+            status = "planned" if random.random() < 0.9 else "rescheduled"
+        else:
+            status = random.choices(["done", "canceled", "rescheduled"], weights=[85, 10, 5])[0]
+        yield (
+            sid,
+            start.strftime("%Y-%m-%d %H:00"),
+            status,
+            random.choice(TOPICS),
+            ts(start),
+        )
+
+
+def gen_homework(n, student_ids, now):
+    for _ in range(n):
+        created = now - timedelta(days=random.randint(0, 365), minutes=random.randint(0, 1440))
+        status = random.choices(["assigned", "new", "checked"], weights=[15, 15, 70])[0]
+        has_file = status != "assigned"
+        yield (
+            random.choice(student_ids),
+            random.choice(TOPICS),
+            "Сделал(а) упражнения" if has_file else None,
+            "answers.pdf" if has_file else None,
+            "uploads/homework/answers.pdf" if has_file else None,
+            status,
+            "Отлично!" if status == "checked" else None,
+            ts(created),
+            ts(created + timedelta(days=2)) if status == "checked" else None,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетическая база soul.db для бенчмарков")
+    parser.add_argument("--db", required=True, help="путь к новой базе (будет перезаписана)")
+    parser.add_argument("--enrolls", type=int, default=100_000)
+    parser.add_argument("--reviews", type=int, default=5_000)
+    parser.add_argument("--students", type=int, default=10_000)
+    parser.add_argument("--lessons", type=int, default=1_000_000)
+    parser.add_argument("--homework", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    db_path = os.path.abspath(args.db)
+    here = os.path.dirname(os.path.abspath(__file__))
+    if db_path == os.path.join(here, "soul.db"):
+        sys.exit("Отказываюсь перезаписывать боевой soul.db — укажите другой --db")
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    # схему создают миграции приложения при импорте
+    os.environ["SOUL_DB_PATH"] = db_path
+    sys.path.insert(0, here)
+    import app  # noqa: F401
+
+    random.seed(args.seed)
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    two_years_ago = now - timedelta(days=730)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous = OFF")
+    t0 = time.perf_counter()
+
+    conn.executemany(
+        "INSERT INTO teachers (name, role, bio) VALUES (?, ?, ?)",
+        [(name, role, "Опыт преподавания более 3 лет.") for name, role in TEACHERS],
+    )
+    conn.executemany(
+        "INSERT INTO courses (title, price, lessons, description, hero_tags) VALUES (?, ?, ?, ?, ?)",
+        [(title, price, lessons, f"Курс «{title}».", "онлайн, мини-группы")
+         for title, price, lessons in COURSES],
+    )
+    teacher_ids = [r[0] for r in conn.execute("SELECT id FROM teachers")]
+
+    counts = {}
+    counts["enrolls"] = insert(conn, """
+        INSERT INTO enrolls (ip, name, contact, tariff, level, comment, created_at, is_bot, admin_note)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, gen_enrolls(args.enrolls, two_years_ago, now))
+    counts["reviews"] = insert(conn, """
+        INSERT INTO reviews (name, package, rating, text, approved, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, gen_reviews(args.reviews, two_years_ago, now))
+    counts["student_accounts"] = insert(conn, """
+        INSERT INTO student_accounts (
+            public_code, name, course, last_payment_date, last_payment_amount,
+            lessons_total, lessons_left, teacher_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, gen_students(args.students, teacher_ids))
+
+    student_ids = [r[0] for r in conn.execute("SELECT id FROM student_accounts")]
+    if student_ids:
+        counts["student_lessons"] = insert(conn, """
+            INSERT INTO student_lessons (student_id, start_at, status, topic, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, gen_lessons(args.lessons, student_ids, now))
+        counts["student_homework"] = insert(conn, """
+            INSERT INTO student_homework (
+                student_id, title, comment, file_name, file_path, status,
+                teacher_comment, created_at, checked_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, gen_homework(args.homework, student_ids, now))
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+    elapsed = time.perf_counter() - t0
+    for table, n in counts.items():
+        print(f"{table:>18}: {n}")
+    size_mb = os.path.getsize(db_path) / 1024 / 1024
+    print(f"Готово за {elapsed:.1f} с, {db_path} ({size_mb:.1f} МБ)")
+
+
+if __name__ == "__main__":
+    main()
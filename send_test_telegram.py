@@ -1,18 +1,23 @@
-import requests
+"""
+Проверка бота: шлёт тестовое сообщение тем же клиентом, что и сайт.
+Приложение (миграции, статику) не поднимает — только telegram_api.
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+    TELEGRAM_BOT_TOKEN=... TELEGRAM_CHAT_ID=... python send_test_telegram.py
+"""
+import os
 
-url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+from telegram_api import TelegramClient, TelegramError
 
-resp = requests.post(
-    url,
-    json={
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": "Тестовое сообщение от Soul-сайта ✅",
-    },
-    timeout=10,
-)
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
-print("Status:", resp.status_code)
-print("Response:", resp.text)
+try:
+    resp = TelegramClient(TELEGRAM_BOT_TOKEN).send_message(
+        TELEGRAM_CHAT_ID,
+        "Тестовое сообщение от Soul-сайта ✅",
+        parse_mode=None,
+    )
+except TelegramError as e:
+    print("Error:", e)
+else:
+    print("Response:", resp)
@@ -0,0 +1,87 @@
+"""
+Клиент Telegram Bot API без побочных эффектов при импорте: его берут и
+сайт (app.py), и скрипты вроде send_test_telegram.py — тем не нужно
+поднимать всё приложение с миграциями и статикой.
+"""
+import os
+import threading
+import time
+
+import requests
+
+# можно направить на локальный стенд вместо настоящего API
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+
+class TelegramError(Exception):
+    """Ошибка отправки. retryable=False — повторять бессмысленно (400/403)."""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after  # сколько секунд просит подождать Telegram (429)
+
+
+class TelegramClient:
+    """
+    Клиент Bot API поверх одной requests.Session: TLS-соединение
+    переиспользуется между сообщениями, а не открывается на каждое.
+
+    Telegram разрешает примерно одно сообщение в секунду в чат, поэтому
+    перед отправкой клиент выдерживает паузу per-chat. Если всё же пришёл
+    429, запоминается retry_after и до его истечения в этот чат не шлём.
+    """
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL, min_interval=1.0, timeout=10):
+        self.token = token
+        self.api_url = api_url
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._next_allowed = {}  # chat_id -> time.monotonic(), раньше которого не шлём
+        self._lock = threading.Lock()
+
+    def _wait_turn(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_allowed.get(chat_id, 0.0))
+            self._next_allowed[chat_id] = at + self.min_interval
+        if at > now:
+            time.sleep(at - now)
+
+    def send_message(self, chat_id, text, parse_mode="Markdown"):
+        """Бросает TelegramError, если не получилось."""
+        data = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        self._wait_turn(chat_id)
+        try:
+            resp = self.session.post(
+                f"{self.api_url}/bot{self.token}/sendMessage",
+                json=data,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            raise TelegramError(f"request failed: {e}") from e
+
+        if resp.status_code == 200:
+            return resp.json()
+
+        retry_after = None
+        if resp.status_code == 429:
+            try:
+                retry_after = float(resp.json()["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                retry_after = 30.0
+            with self._lock:
+                self._next_allowed[chat_id] = time.monotonic() + retry_after
+        # 429 и 5xx — временные, 400/401/403/404 — повтор не поможет
+        retryable = resp.status_code == 429 or resp.status_code >= 500
+        raise TelegramError(
+            f"HTTP {resp.status_code}: {resp.text[:300]}",
+            retryable=retryable,
+            retry_after=retry_after,
+        )
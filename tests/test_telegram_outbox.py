@@ -0,0 +1,238 @@
+"""
+Outbox и клиент Telegram против локального стенда Bot API (http.server).
+Приложение поднимается на временной базе, фоновый диспетчер выключен —
+проходы делаем вручную через dispatch_outbox().
+
+    python -m pytest -q tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "test-token"
+CHAT_ID = "42"
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    """Отвечает по очереди из server.replies, по умолчанию — 200 ok."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.calls.append((self.path, body))
+        status, payload = (
+            self.server.replies.pop(0) if self.server.replies else (200, {"ok": True, "result": {}})
+        )
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+server = None
+tmpdir = None
+soul = None
+
+
+def setUpModule():
+    global server, tmpdir, soul
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBotAPI)
+    server.calls, server.replies = [], []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ.update({
+        "SOUL_DB_PATH": os.path.join(tmpdir, "soul.db"),
+        "FLASK_SECRET_KEY": "test",
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "TELEGRAM_CHAT_ID": CHAT_ID,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{server.server_port}",
+        "OUTBOX_DISPATCHER": "0",
+        "STATIC_FINGERPRINT": "0",
+        "LOG_LEVEL": "CRITICAL",
+    })
+    sys.path.insert(0, ROOT)
+    import app
+
+    soul = app
+
+
+def tearDownModule():
+    server.shutdown()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        server.calls.clear()
+        server.replies.clear()
+        # без паузы в секунду между сообщениями в один чат
+        soul.telegram_client = soul.TelegramClient(TOKEN, min_interval=0, timeout=5)
+        soul.app.config["TELEGRAM_DIGEST_SECONDS"] = 0
+        self.conn = soul.get_db()
+        self.conn.execute("DELETE FROM notification_outbox")
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def enqueue(self, name="Аня"):
+        soul.enqueue_notification(
+            self.conn, "enroll", {"name": name, "contact": "@anya", "tariff": "4 занятия"}
+        )
+        self.conn.commit()
+
+    def rows(self):
+        return self.conn.execute(
+            "SELECT * FROM notification_outbox ORDER BY id"
+        ).fetchall()
+
+    def test_delivers_and_marks_sent(self):
+        self.enqueue()
+
+        self.assertEqual(soul.dispatch_outbox(), 1)
+
+        self.assertEqual(len(server.calls), 1)
+        path, body = server.calls[0]
+        self.assertEqual(path, f"/bot{TOKEN}/sendMessage")
+        self.assertEqual(body["chat_id"], CHAT_ID)
+        self.assertIn("Аня", body["text"])
+        [row] = self.rows()
+        self.assertEqual(row["status"], "sent")
+        self.assertIsNone(row["last_error"])
+
+    def test_5xx_backs_off_exponentially(self):
+        self.enqueue()
+        base = soul.OUTBOX_BACKOFF_BASE
+
+        for attempt in (1, 2, 3):
+            server.replies.append((502, {"ok": False}))
+            now = time.time()
+            self.assertEqual(soul.dispatch_outbox(), 0)
+
+            [row] = self.rows()
+            self.assertEqual(row["status"], "pending")
+            self.assertEqual(row["attempts"], attempt)
+            self.assertIn("HTTP 502", row["last_error"])
+            delay = row["next_attempt_at"] - now
+            expected = base * 2 ** (attempt - 1)
+            self.assertGreaterEqual(delay, expected * 0.8 - 1)
+            self.assertLessEqual(delay, expected * 1.2 + 1)
+            # не ждём паузу — сразу делаем строку готовой к следующей попытке
+            self.conn.execute("UPDATE notification_outbox SET next_attempt_at = ?", (time.time(),))
+            self.conn.commit()
+
+        self.assertEqual(soul.dispatch_outbox(), 1)
+        self.assertEqual(self.rows()[0]["status"], "sent")
+
+    def test_429_honours_retry_after(self):
+        self.enqueue("Первая")
+        self.enqueue("Вторая")
+        server.replies.append((429, {"ok": False, "parameters": {"retry_after": 7}}))
+        now = time.time()
+
+        self.assertEqual(soul.dispatch_outbox(), 0)
+
+        # после 429 в этот проход больше ничего не шлём
+        self.assertEqual(len(server.calls), 1)
+        first, second = self.rows()
+        self.assertEqual(first["status"], "pending")
+        self.assertEqual(first["attempts"], 1)
+        self.assertAlmostEqual(first["next_attempt_at"] - now, 7, delta=1)
+        # вторую отложили на то же время, попытку ей не засчитали
+        self.assertEqual(second["status"], "pending")
+        self.assertEqual(second["attempts"], 0)
+        self.assertAlmostEqual(second["next_attempt_at"] - now, 7, delta=1)
+        # и клиент сам не пустит в этот чат раньше срока
+        self.assertGreater(soul.telegram_client._next_allowed[CHAT_ID], time.monotonic() + 5)
+
+    def test_400_and_403_go_to_dead(self):
+        for status in (400, 403):
+            with self.subTest(status=status):
+                self.conn.execute("DELETE FROM notification_outbox")
+                self.conn.commit()
+                self.enqueue()
+                server.replies.append((status, {"ok": False, "description": "Forbidden"}))
+
+                self.assertEqual(soul.dispatch_outbox(), 0)
+
+                [row] = self.rows()
+                self.assertEqual(row["status"], "dead")
+                self.assertEqual(row["attempts"], 1)
+                self.assertIn(f"HTTP {status}", row["last_error"])
+                # повторный проход мёртвую строку не трогает
+                self.assertEqual(soul.dispatch_outbox(), 0)
+
+    def test_digest_sends_window_as_one_message(self):
+        soul.app.config["TELEGRAM_DIGEST_SECONDS"] = 60
+        for name in ("Аня", "Боря", "Вера"):
+            self.enqueue(name)
+
+        # окно дайджеста ещё не закрылось
+        self.assertEqual(soul.dispatch_outbox(), 0)
+        self.assertEqual(server.calls, [])
+
+        first_id = self.rows()[0]["id"]
+        self.conn.execute(
+            "UPDATE notification_outbox SET next_attempt_at = ? WHERE id = ?",
+            (time.time() - 1, first_id),
+        )
+        self.conn.commit()
+
+        self.assertEqual(soul.dispatch_outbox(), 3)
+        self.assertEqual(len(server.calls), 1)
+        text = server.calls[0][1]["text"]
+        self.assertTrue(text.startswith("📬 *Уведомлений: 3*"))
+        for name in ("Аня", "Боря", "Вера"):
+            self.assertIn(name, text)
+        self.assertEqual({r["status"] for r in self.rows()}, {"sent"})
+
+    def test_markdown_in_names_is_escaped(self):
+        self.enqueue("@ivan_petrov *[vip]*")
+
+        self.assertEqual(soul.dispatch_outbox(), 1)
+
+        text = server.calls[0][1]["text"]
+        self.assertIn(r"@ivan\_petrov \*\[vip]\*", text)
+
+    def test_rejected_digest_falls_back_to_single_messages(self):
+        soul.app.config["TELEGRAM_DIGEST_SECONDS"] = 60
+        for name in ("Аня", "Боря", "Вера"):
+            self.enqueue(name)
+        self.conn.execute("UPDATE notification_outbox SET next_attempt_at = ?", (time.time() - 1,))
+        self.conn.commit()
+        server.replies.append((400, {"ok": False, "description": "can't parse entities"}))
+
+        self.assertEqual(soul.dispatch_outbox(), 3)
+
+        # дайджест отвергнут, затем каждая заметка ушла отдельно
+        self.assertEqual(len(server.calls), 4)
+        self.assertTrue(server.calls[0][1]["text"].startswith("📬"))
+        for (_, body), name in zip(server.calls[1:], ("Аня", "Боря", "Вера")):
+            self.assertIn(name, body["text"])
+        self.assertEqual({r["status"] for r in self.rows()}, {"sent"})
+
+    def test_digest_splits_at_text_limit(self):
+        text = "x" * (soul.TELEGRAM_MAX_TEXT // 3)
+        messages = soul.group_for_digest([(i, text) for i in range(5)])
+
+        self.assertEqual([rows for _, rows in messages], [[0, 1], [2, 3], [4]])
+        for message, _ in messages:
+            self.assertLessEqual(len(message), soul.TELEGRAM_MAX_TEXT)
+        # одиночное сообщение уходит без заголовка дайджеста
+        self.assertEqual(messages[-1][0], text)
+
+
+if __name__ == "__main__":
+    unittest.main()